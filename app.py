@@ -3,240 +3,596 @@ import json
 import chess
 import chess.engine
 import chess.pgn
-from flask import Flask, request, jsonify, send_from_directory
+import chess.polyglot
+from flask import Flask, Response, request, jsonify, g
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from datetime import datetime
+import cProfile
+import functools
 import io
-import platform
 import uuid
 import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import core
+from core import (
+    ANALYSIS_MAX_MULTIPV, ANALYSIS_MAX_TIME, ANALYSIS_UPDATE_INTERVAL, ENGINE_HEALTH_INTERVAL, ENGINE_PONDER,
+    ENGINE_POOL_SIZE, ENGINE_QUEUE_WAIT, ENGINE_RESTART_MAX_DELAY, ENGINE_RESTART_MIN_DELAY,
+    ENGINE_WARMUP_POSITIONS, ENGINE_WARMUP_TIME, EVAL_BATCH_MAX_POSITIONS, EVENT_LATENCY, HTTP_LATENCY,
+    PGN_PAGE_SIZE, PONDER_MAX_TIME, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, PRIORITY_NAMES,
+    PRIORITY_SUGGEST, PROFILE_TOKEN, SPECTATOR_UPDATE_INTERVAL, STOCKFISH_PATH, AnalysisJobBase, EngineBusy,
+    EngineOptionError, EnginePoolBase, MultiplayerGame, PgnDatabase, PreAnalysisJobBase, batch_limit,
+    batch_positions, batch_report, batch_summary, book_reply, claim_spectator_flush, config, count_ponder,
+    drop_player, engine_busy, engine_option_limits, engine_profile, engine_reply, explorer_stats,
+    game_positions, game_rooms, game_summary, get_legal_move_map, new_game_totals, open_pgn_database,
+    parse_config, parse_think_time, ply_report, ponder_target, pre_analysis_wanted, print_profile, render_metrics,
+    search_entry, searches_needed, session_store, spectator_room, spectator_update, terminal_entry, track_player,
+    untrack_player
+)
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+# A message queue (e.g. redis://) lets several worker processes share rooms
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading',
+                    message_queue=os.environ.get('SOCKETIO_MESSAGE_QUEUE'))
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-# Store active games
-active_games = {}
+# Game store, caches and front-end assets, shared with app_async.py
+core.init()
 
-# Auto-detect Stockfish path in local directory
-def find_stockfish_path():
+class EngineWorker:
+    def __init__(self, worker_id, path, options):
+        self.worker_id = worker_id
+        self.engine = chess.engine.SimpleEngine.popen_uci(path)
+        self.options = {}
+        self.searches = 0
+        self.since = time.monotonic()  # start of the current idle or busy span
+        self.pondering = None  # (session id, Zobrist hash of the expected position)
+        self.ticket = None  # request the worker is checked out for
+        self.preempted = False  # set when a more urgent request wants the worker back
+        self.configure(options)
+
+    def configure(self, options):
+        # Only send options that actually changed so the hash table survives
+        changed = {name: value for name, value in options.items() if self.options.get(name) != value}
+        if changed:
+            self.engine.configure(changed)
+            self.options.update(changed)
+
+    def warm(self, positions, limit):
+        for fen in positions:
+            self.engine.analyse(chess.Board(fen), limit)
+
+    def quit(self):
+        try:
+            self.engine.quit()
+        except Exception:
+            pass
+
+
+class EnginePool(EnginePoolBase):
     """
-    Find Stockfish executable in the local directory structure
+    Fixed-size pool of Stockfish processes with checkout/return semantics.
+    Callers wait in a bounded queue when every worker is busy and are
+    served in EngineScheduler order. Workers are started, health-checked
+    and replaced by a supervisor thread, so neither startup nor a crash
+    blocks the request that happens to see it.
     """
-    system = platform.system().lower()
-    
-    # Get the directory where this script is located
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    
-    # Stockfish executable names by platform
-    if system == "windows":
-        exe_names = ["stockfish.exe", "stockfish_15_win_x64_avx2.exe", "stockfish_15_x64_avx2.exe"]
-    else:  # Linux/Mac
-        exe_names = ["stockfish", "stockfish_15_linux_x64_avx2", "stockfish_15"]
-    
-    # Search paths relative to script directory
-    search_paths = [
-        script_dir,  # Same directory as script
-        os.path.join(script_dir, "stockfish"),  # stockfish subdirectory
-        os.path.join(script_dir, "engines"),    # engines subdirectory
-        os.path.join(script_dir, "bin"),        # bin subdirectory
-    ]
-    
-    # Search for Stockfish executable
-    for path in search_paths:
-        for exe_name in exe_names:
-            full_path = os.path.join(path, exe_name)
-            if os.path.isfile(full_path):
-                # On Unix systems, check if file is executable
-                if system != "windows":
-                    if os.access(full_path, os.X_OK):
-                        print(f"Found Stockfish at: {full_path}")
-                        return full_path
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cond = threading.Condition()
+        self.wake = threading.Event()
+        self.supervisor = None
+
+    def start(self):
+        # Returns at once; workers come up in the background
+        with self.cond:
+            if self.supervisor:
+                return
+            self.missing = self.size
+            self.supervisor = threading.Thread(target=self._supervise, name='engine-supervisor', daemon=True)
+        self.supervisor.start()
+
+    def wait_ready(self, timeout=None):
+        with self.cond:
+            return bool(self.cond.wait_for(lambda: self.idle or self.busy or self.closed, timeout)) and not self.closed
+
+    def status(self):
+        with self.cond:
+            return self._status()
+
+    def _spawn(self):
+        with self.cond:
+            self.next_id += 1
+            worker_id = self.next_id
+            options = dict(self.options)
+        worker = None
+        try:
+            worker = EngineWorker(worker_id, self.path, options)
+            self.limits = engine_option_limits(worker.engine.options)
+            # Readiness probe, then fill the hash table before taking requests
+            worker.engine.ping()
+            worker.warm(self.warmup, chess.engine.Limit(time=ENGINE_WARMUP_TIME))
+            return worker
+        except Exception as e:
+            print(f"Error starting engine worker {worker_id}: {e}")
+            if worker:
+                worker.quit()
+            return None
+
+    def _restore(self):
+        # Start every missing worker in parallel; returns how many came up
+        with self.cond:
+            count = self.missing
+        workers = [None] * count
+        def spawn(slot):
+            workers[slot] = self._spawn()
+        threads = [threading.Thread(target=spawn, args=(slot,), daemon=True) for slot in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        started = [worker for worker in workers if worker]
+        with self.cond:
+            closed = self.closed
+            if not closed:
+                self.idle.extend(started)
+                self.missing -= len(started)
+                self.cond.notify_all()
+                self._dispatch()
+        if closed:
+            for worker in started:
+                worker.quit()
+        return len(started)
+
+    def _health_check(self):
+        # Ponder searches are left alone unless the player has gone quiet
+        with self.cond:
+            now = time.monotonic()
+            workers = self.idle + [worker for worker in self.pondering.values()
+                                   if now - worker.since > PONDER_MAX_TIME]
+        for worker in workers:
+            self._ping(worker)
+
+    def _ping(self, worker):
+        with self.cond:
+            if not self._hold(worker):
+                return
+        self._check(worker)
+
+    def _check(self, worker):
+        # The worker is held; any command ends a ponder search, so this also stops one
+        try:
+            worker.engine.ping()
+        except Exception:
+            print(f"Engine worker {worker.worker_id} failed its health check")
+            self.checkin(worker, broken=True)
+            return
+        with self.cond:
+            self._return(worker, searched=False)
+
+    def stop_pondering(self, session_id):
+        with self.cond:
+            worker = self.pondering.get(session_id)
+        if worker is not None:
+            self._ping(worker)
+
+    def _supervise(self):
+        delay = 0
+        while not self.closed:
+            if self.missing:
+                self._restore()
+                self.retrying = bool(self.missing)
+                if self.missing:
+                    delay = min(max(delay * 2, ENGINE_RESTART_MIN_DELAY), ENGINE_RESTART_MAX_DELAY)
+                    print(f"{self.missing} engine worker(s) failed to start; retrying in {delay:.0f}s")
                 else:
-                    print(f"Found Stockfish at: {full_path}")
-                    return full_path
-    
-    return None
-
-# Find Stockfish in local directory
-STOCKFISH_PATH = find_stockfish_path()
-
-if not STOCKFISH_PATH:
-    print("=" * 60)
-    print("WARNING: Stockfish engine not found!")
-    print("Please place the Stockfish executable in one of these locations:")
-    print(f"1. Same directory as app.py: {os.path.dirname(os.path.abspath(__file__))}")
-    print(f"2. In a 'stockfish' subdirectory: {os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stockfish')}")
-    if platform.system().lower() == "windows":
-        print("   Expected filename: stockfish.exe")
-    else:
-        print("   Expected filename: stockfish (make sure it's executable)")
-    print("Download from: https://stockfishchess.org/download/")
-    print("=" * 60)
-else:
-    print(f"Using Stockfish engine at: {STOCKFISH_PATH}")
-
-engine = None
-board = chess.Board()
-game_history = []
-config = {
-    'time': 1.0,
-    'threads': 1,
-    'memory': 128,  # MB for hash table
-    'player_color': 'white',
-    'mode': 'suggest'  # 'suggest', 'play', or 'multiplayer'
-}
-
-class MultiplayerGame:
-    def __init__(self, game_id):
-        self.game_id = game_id
-        self.board = chess.Board()
-        self.players = {'white': None, 'black': None}
-        self.spectators = []
-        self.history = []
-        self.status = 'waiting'  # waiting, active, finished
-        
-    def add_player(self, player_id, color=None):
-        if color and not self.players[color]:
-            self.players[color] = player_id
-            if self.players['white'] and self.players['black']:
-                self.status = 'active'
-            return color
-        elif not self.players['white']:
-            self.players['white'] = player_id
-            return 'white'
-        elif not self.players['black']:
-            self.players['black'] = player_id
-            self.status = 'active'
-            return 'black'
-        else:
-            self.spectators.append(player_id)
-            return 'spectator'
-    
-    def remove_player(self, player_id):
-        for color, pid in self.players.items():
-            if pid == player_id:
-                self.players[color] = None
-                self.status = 'waiting'
+                    delay = 0
+            self.wake.wait(delay if self.missing else ENGINE_HEALTH_INTERVAL)
+            self.wake.clear()
+            if not self.missing and not self.closed:
+                self._health_check()
+
+    def checkout(self, timeout=None, session_id=None, priority=PRIORITY_INTERACTIVE, preemptible=False):
+        """
+        Wait for a worker in scheduler order. A session's play-mode reply
+        gets back the worker pondering for it if no one else took it;
+        other requests get the worker EngineAffinity picks, set up with
+        the session's own Threads and Hash.
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        started = time.monotonic()
+        options = dict(self.options, **self.profile(session_id))
+        with self.cond:
+            if self.closed:
+                raise EngineBusy('Engine pool is shut down')
+            if not self.idle and timeout == 0:
+                raise EngineBusy('No idle engine')
+            ticket = self._ticket(session_id, priority, preemptible, options, started)
+            worker = self._claim(ticket)
+            if worker is not None:
+                self._assign(ticket, worker)
+            else:
+                self.scheduler.enqueue(ticket)
+                self._dispatch()
+                if ticket.worker is None and timeout == 0:
+                    self.scheduler.remove(ticket)
+                    raise EngineBusy('No idle engine')
+                if ticket.worker is None:
+                    self._preempt(ticket)
+                if not self.cond.wait_for(lambda: ticket.worker is not None or self.closed, timeout):
+                    self.scheduler.remove(ticket)
+                    raise engine_busy('timeout', 'Timed out waiting for an engine')
+                if ticket.worker is None:
+                    self.scheduler.remove(ticket)
+                    raise EngineBusy('Engine pool is shut down')
+            worker = ticket.worker
+        ENGINE_QUEUE_WAIT.observe(time.monotonic() - started, PRIORITY_NAMES[ticket.priority])
+        try:
+            worker.configure(options)
+        except chess.engine.EngineTerminatedError as e:
+            print(f"Engine worker {worker.worker_id} failed to configure: {e}")
+            self.checkin(worker, broken=True)
+            raise EngineBusy('Engine worker unavailable')
+        except chess.engine.EngineError as e:
+            # Rejected before it reached the engine, which is still healthy
+            self.checkin(worker)
+            raise EngineOptionError(f'Invalid engine settings: {e}')
+        except Exception as e:
+            print(f"Engine worker {worker.worker_id} failed to configure: {e}")
+            self.checkin(worker, broken=True)
+            raise EngineBusy('Engine worker unavailable')
+        return worker
+
+    def _handed(self, ticket):
+        # Caller holds the lock
+        self.cond.notify_all()
+
+    def checkin(self, worker, broken=False, pondering=None):
+        if not broken:
+            with self.cond:
+                returned = not self.closed
+                replaced = self._return(worker, pondering) if returned else None
+            if replaced is not None:
+                # The session's older ponder search, stopped outside the lock
+                self._check(replaced)
+            if returned:
                 return
-        if player_id in self.spectators:
-            self.spectators.remove(player_id)
-    
-    def get_current_turn(self):
-        return 'white' if self.board.turn == chess.WHITE else 'black'
-    
-    def make_move(self, from_square, to_square, promotion=None):
+        with self.cond:
+            self._release(worker)
+            self.affinity.forget(worker)
+            self._dispatch()
+        worker.quit()
+        if self.closed:
+            return
+        print(f"Replacing crashed engine worker {worker.worker_id}")
+        with self.cond:
+            self.missing += 1
+            self.restarts += 1
+        self.wake.set()
+
+    @contextmanager
+    def acquire(self, timeout=None, session_id=None, priority=PRIORITY_INTERACTIVE, preemptible=False):
+        worker = self.checkout(timeout, session_id, priority, preemptible)
         try:
-            move_uci = from_square + to_square + (promotion.lower() if promotion else '')
-            move = chess.Move.from_uci(move_uci)
-            
-            if move in self.board.legal_moves:
-                san = self.board.san(move)
-                self.board.push(move)
-                self.history.append({
-                    'move': san,
-                    'fen': self.board.fen(),
-                    'from': from_square,
-                    'to': to_square
-                })
-                
-                if self.board.is_game_over():
-                    self.status = 'finished'
-                
-                return True
-            return False
-        except:
-            return False
-    
-    def get_state(self):
-        return {
-            'game_id': self.game_id,
-            'fen': self.board.fen(),
-            'players': self.players,
-            'current_turn': self.get_current_turn(),
-            'status': self.status,
-            'history': self.get_move_history(),
-            'game_over': self.board.is_game_over(),
-            'result': self.board.result() if self.board.is_game_over() else None
-        }
-    
-    def get_move_history(self):
-        moves = []
-        for i in range(0, len(self.history), 2):
-            move_num = i // 2 + 1
-            white_move = self.history[i]['move'] if i < len(self.history) else ''
-            black_move = self.history[i + 1]['move'] if i + 1 < len(self.history) else ''
-            moves.append({
-                'number': move_num,
-                'white': white_move,
-                'black': black_move
-            })
-        return moves
+            yield worker
+        except (chess.engine.EngineTerminatedError, chess.engine.EngineError, TimeoutError):
+            self.checkin(worker, broken=True)
+            raise
+        except BaseException:
+            self.checkin(worker)
+            raise
+        else:
+            self.checkin(worker)
+
+    def check_quota(self, session_id, searches, limit):
+        with self.cond:
+            super().check_quota(session_id, searches, limit)
+
+    def stats(self):
+        with self.cond:
+            return super().stats()
+
+    def utilisation(self):
+        with self.cond:
+            return super().utilisation()
+
+    def close(self):
+        with self.cond:
+            workers = self._shutdown()
+            self.cond.notify_all()
+        self.wake.set()
+        for worker in workers:
+            worker.quit()
+
+def schedule_spectator_update(game_id, seen):
+    if claim_spectator_flush(game_id, seen):
+        socketio.start_background_task(flush_spectator_update, game_id)
+
+def flush_spectator_update(game_id):
+    socketio.sleep(SPECTATOR_UPDATE_INTERVAL)
+    update = spectator_update(game_id)
+    if update:
+        socketio.emit('spectator_update', update, room=spectator_room(game_id))
+
+class AnalysisJob(AnalysisJobBase):
+    """Streams engine.analysis() output to one Socket.IO client from a background thread."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stopped = True
+        self.stop_event.set()
+
+    def run(self):
+        lines = {}
+        started = time.monotonic()
+        try:
+            best = None
+            while best is None:
+                with engine_pool.acquire(session_id=self.session_id, priority=PRIORITY_BACKGROUND,
+                                         preemptible=True) as worker:
+                    best = self.search(worker, self.remaining_limit(time.monotonic() - started), lines)
+        except EngineBusy as e:
+            socketio.emit('analysis_error', {'analysis_id': self.analysis_id, 'error': str(e)}, to=self.sid)
+            return
+        except Exception as e:
+            print(f"Engine error: {e}")
+            socketio.emit('analysis_error', {'analysis_id': self.analysis_id, 'error': 'Analysis failed'}, to=self.sid)
+            return
+        finally:
+            with analysis_lock:
+                if analysis_jobs.get(self.sid) is self:
+                    del analysis_jobs[self.sid]
+        
+        self.finish(lines, best, time.monotonic() - started)
+        self.emit_lines('analysis_done', lines, bestmove=best.move.uci() if best.move else None)
+
+    def search(self, worker, limit, lines):
+        # Returns the engine's best move, or None if the search was preempted
+        preempted = False
+        with worker.engine.analysis(self.board, limit, multipv=self.multipv) as analysis:
+            finished = False
+            dirty = False
+            while not finished:
+                # Drain whatever arrived since the last flush
+                while not analysis.would_block():
+                    try:
+                        info = analysis.get()
+                    except chess.engine.AnalysisComplete:
+                        finished = True
+                        break
+                    dirty = self.collect(lines, info) or dirty
+                if dirty:
+                    self.emit_lines('analysis_update', lines)
+                    dirty = False
+                if finished:
+                    break
+                if self.stop_event.wait(ANALYSIS_UPDATE_INTERVAL):
+                    analysis.stop()
+                    self.stop_event.clear()
+                elif worker.preempted and not preempted:
+                    analysis.stop()
+                    preempted = True
+            best = analysis.wait()
+        return None if preempted and not self.stopped else best
+
+    def emit_lines(self, event, lines, **extra):
+        socketio.emit(event, self.payload(lines, **extra), to=self.sid)
+
+analysis_jobs = {}
+analysis_lock = threading.Lock()
+
+def stop_analysis(sid):
+    with analysis_lock:
+        job = analysis_jobs.pop(sid, None)
+    if job:
+        job.stop()
+
+
+class PreAnalysisJob(PreAnalysisJobBase):
+    """Think Ahead search run in a background thread."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stop_event = threading.Event()
+        self.done = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        if self.previous:
+            self.previous.done.wait()
+            self.previous = None
+        try:
+            if not self.stop_event.is_set() and self.needed():
+                self.search()
+        except EngineBusy:
+            pass  # No idle engine; the suggestion is searched on demand
+        except Exception as e:
+            print(f"Engine error: {e}")
+        finally:
+            with pre_analysis_lock:
+                if pre_analysis_jobs.get(self.session_id) is self:
+                    del pre_analysis_jobs[self.session_id]
+            self.done.set()
+
+    def search(self):
+        with engine_pool.acquire(timeout=0, session_id=self.session_id, priority=PRIORITY_BACKGROUND,
+                                 preemptible=True) as worker:
+            self.started = time.monotonic()
+            with worker.engine.analysis(self.board, self.limit) as analysis:
+                finished = False
+                while not finished:
+                    while not analysis.would_block():
+                        try:
+                            analysis.get()
+                        except chess.engine.AnalysisComplete:
+                            finished = True
+                            break
+                    if not finished and (self.stop_event.wait(ANALYSIS_UPDATE_INTERVAL) or worker.preempted
+                                         or engine_pool.waiting):
+                        # Superseded, or a request needs the engine
+                        analysis.stop()
+                        break
+                best = analysis.wait()
+                info = analysis.info
+        self.store(best, info, finished)
+
+pre_analysis_jobs = {}
+pre_analysis_lock = threading.Lock()
+
+def start_pre_analysis(session):
+    """Replace the session's background search with one of its current position."""
+    job = None
+    with pre_analysis_lock:
+        old = pre_analysis_jobs.pop(session.session_id, None)
+        if pre_analysis_wanted(session, engine_pool):
+            job = PreAnalysisJob(session.session_id, session.game_board(),
+                                 chess.engine.Limit(time=session.config['time']), old)
+            pre_analysis_jobs[session.session_id] = job
+    if old:
+        old.stop()
+    if job:
+        socketio.start_background_task(job.run)
+
+def wait_for_pre_analysis(session_id, board, think_time):
+    """
+    Let a background search of board use up the rest of its budget, so the
+    suggestion comes from the cache instead of a search from scratch.
+    """
+    with pre_analysis_lock:
+        job = pre_analysis_jobs.get(session_id)
+    if job and job.covers(board, think_time):
+        job.done.wait(think_time)
+
+engine_pool = None
+engine_init_lock = threading.Lock()
 
 def init_engine():
-    global engine
-    try:
-        if not STOCKFISH_PATH:
-            print("Cannot initialize engine: Stockfish not found")
-            return False
-            
-        if engine:
-            engine.quit()
-        engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
-        # Configure engine with current settings
-        engine.configure({
-            "Threads": config['threads'],
-            "Hash": config['memory']
-        })
-        print(f"Engine initialized successfully with {STOCKFISH_PATH}")
-        return True
-    except Exception as e:
-        print(f"Error initializing engine: {e}")
+    """
+    Start the engine pool in the background. Safe to call repeatedly: a
+    running pool (and its warm hash tables) is kept as it is.
+    """
+    global engine_pool
+    if not STOCKFISH_PATH:
+        print("Cannot initialize engine: Stockfish not found")
         return False
+    
+    with engine_init_lock:
+        if engine_pool is None or engine_pool.closed:
+            # Configure every worker with current settings
+            engine_pool = EnginePool(STOCKFISH_PATH, ENGINE_POOL_SIZE, {
+                "Threads": config['threads'],
+                "Hash": config['memory']
+            }, warmup=ENGINE_WARMUP_POSITIONS, profile=engine_profile)
+            engine_pool.start()
+            print(f"Starting engine pool with {ENGINE_POOL_SIZE} workers using {STOCKFISH_PATH}")
+    return True
+
+def engine_status():
+    return engine_pool.status() if engine_pool else 'unavailable'
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if PROFILE_TOKEN and request.headers.get('X-Profile') == PROFILE_TOKEN:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            g.profiler = profiler
+        except ValueError:
+            # Only one profiler can run at a time
+            pass
+
+@app.after_request
+def record_request(response):
+    elapsed = time.perf_counter() - g.get('request_started', time.perf_counter())
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    HTTP_LATENCY.observe(elapsed, route, request.method, str(response.status_code))
+    profiler = g.get('profiler')
+    if profiler:
+        profiler.disable()
+        print_profile(profiler, f'{request.method} {request.path}', elapsed)
+        response.headers['Server-Timing'] = f'total;dur={elapsed * 1000:.1f}'
+    return response
+
+def timed_event(handler):
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            event = getattr(request, 'event', None)
+            EVENT_LATENCY.observe(time.perf_counter() - started, event['message'] if event else handler.__name__)
+    return wrapper
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(engine_pool), mimetype='text/plain; version=0.0.4')
+
+# Serve static files (HTML, CSS, JS) from memory
+def asset_response(asset, immutable=False):
+    status, headers, body = asset.respond(request.headers.get('If-None-Match'),
+                                          request.headers.get('Accept-Encoding'), immutable)
+    return Response(body, status=status, headers=headers)
 
-# Serve static files (HTML, CSS, JS)
 @app.route('/')
 def index():
-    return send_from_directory('.', 'index.html')
+    return asset_response(core.static_assets.source('index.html'))
 
 @app.route('/styles.css')
 def styles():
-    return send_from_directory('.', 'styles.css')
+    return asset_response(core.static_assets.source('styles.css'))
 
 @app.route('/script.js')
 def script():
-    return send_from_directory('.', 'script.js')
+    return asset_response(core.static_assets.source('script.js'))
+
+@app.route('/assets/<name>')
+def hashed_asset(name):
+    asset = core.static_assets.hashed.get(name)
+    if asset is None:
+        return jsonify({'success': False, 'error': 'Not found'}), 404
+    return asset_response(asset, immutable=True)
 
 # WebSocket events for multiplayer
 @socketio.on('connect')
-def handle_connect():
+@timed_event
+def handle_connect(auth=None):
     print(f'Client connected: {request.sid}')
     emit('connected', {'player_id': request.sid})
 
 @socketio.on('disconnect')
-def handle_disconnect():
+@timed_event
+def handle_disconnect(reason=None):
     print(f'Client disconnected: {request.sid}')
-    # Remove player from any active games
-    for game_id, game in list(active_games.items()):
-        game.remove_player(request.sid)
-        if game.status == 'waiting':
-            socketio.emit('player_left', game.get_state(), room=game_id)
-        if not game.players['white'] and not game.players['black'] and not game.spectators:
-            del active_games[game_id]
-            print(f'Game {game_id} deleted - no players')
+    stop_analysis(request.sid)
+    # Remove player from the games they joined
+    for game_id, state in drop_player(request.sid):
+        socketio.emit('player_left', state, room=game_rooms(game_id))
 
 @socketio.on('create_game')
+@timed_event
 def handle_create_game(data):
     game_id = str(uuid.uuid4())[:8]
     game = MultiplayerGame(game_id)
-    active_games[game_id] = game
     
     color = data.get('color', None)
     assigned_color = game.add_player(request.sid, color)
+    core.game_store.add(game)
+    track_player(request.sid, game_id)
     
     join_room(game_id)
     emit('game_created', {
@@ -247,167 +603,261 @@ def handle_create_game(data):
     print(f'Game created: {game_id}')
 
 @socketio.on('join_game')
+@timed_event
 def handle_join_game(data):
     game_id = data['game_id']
-    if game_id not in active_games:
-        emit('error', {'message': 'Game not found'})
-        return
-    
-    game = active_games[game_id]
-    color = data.get('color', None)
-    assigned_color = game.add_player(request.sid, color)
+    with core.game_store.locked(game_id) as game:
+        if game is None:
+            emit('error', {'message': 'Game not found'})
+            return
+        
+        color = data.get('color', None)
+        assigned_color = game.add_player(request.sid, color)
+        core.game_store.save(game)
+        state = game.get_state()
+    track_player(request.sid, game_id)
     
-    join_room(game_id)
+    join_room(spectator_room(game_id) if assigned_color == 'spectator' else game_id)
     emit('game_joined', {
         'game_id': game_id,
         'color': assigned_color,
-        'state': game.get_state()
+        'state': state
     })
     
-    # Notify all players in the room
-    socketio.emit('player_joined', game.get_state(), room=game_id)
+    # Notify players and spectators
+    socketio.emit('player_joined', state, room=game_rooms(game_id))
     print(f'Player {request.sid} joined game {game_id} as {assigned_color}')
 
 @socketio.on('make_multiplayer_move')
+@timed_event
 def handle_multiplayer_move(data):
     game_id = data['game_id']
-    if game_id not in active_games:
-        emit('error', {'message': 'Game not found'})
-        return
-    
-    game = active_games[game_id]
-    
-    # Verify it's the player's turn
-    current_turn = game.get_current_turn()
-    if game.players[current_turn] != request.sid:
-        emit('error', {'message': 'Not your turn'})
-        return
-    
-    # Make the move
-    success = game.make_move(data['from'], data['to'], data.get('promotion'))
-    
-    if success:
-        state = game.get_state()
-        socketio.emit('move_made', state, room=game_id)
+    with core.game_store.locked(game_id) as game:
+        if game is None:
+            emit('error', {'message': 'Game not found'})
+            return
         
-        # Play sound notification for the opponent
-        socketio.emit('play_sound', {'sound': 'move'}, room=game_id, skip_sid=request.sid)
-    else:
-        emit('error', {'message': 'Invalid move'})
+        # Verify it's the player's turn
+        current_turn = game.get_current_turn()
+        if game.players[current_turn] != request.sid:
+            emit('error', {'message': 'Not your turn'})
+            return
+        
+        # Make the move
+        delta = game.make_move(data['from'], data['to'], data.get('promotion'))
+        
+        if delta:
+            core.game_store.save(game)
+            # Only the new ply goes out; clients that miss one ask for a resync.
+            # The opponent plays the sound, the mover skips it by color.
+            delta.update(game.get_status())
+            delta['sound'] = 'move'
+            delta['by'] = current_turn
+            socketio.emit('move_made', delta, room=game_id)
+            if game.spectators:
+                schedule_spectator_update(game_id, delta['seq'] - 1)
+        else:
+            emit('error', {'message': 'Invalid move'})
+
+@socketio.on('resync_game')
+@timed_event
+def handle_resync_game(data):
+    game_id = data['game_id']
+    with core.game_store.locked(game_id) as game:
+        if game is None:
+            emit('error', {'message': 'Game not found'})
+            return
+        
+        try:
+            since = int(data.get('since', 0))
+        except (TypeError, ValueError):
+            since = -1
+        if 0 <= since <= len(game.moves):
+            resync = game.get_status()
+            resync['moves'] = game.get_move_deltas(since)
+            emit('game_resync', resync)
+        else:
+            emit('game_state', game.get_state())
 
 @socketio.on('get_game_state')
+@timed_event
 def handle_get_game_state(data):
     game_id = data['game_id']
-    if game_id not in active_games:
-        emit('error', {'message': 'Game not found'})
-        return
-    
-    game = active_games[game_id]
-    emit('game_state', game.get_state())
+    with core.game_store.locked(game_id) as game:
+        if game is None:
+            emit('error', {'message': 'Game not found'})
+            return
+        
+        emit('game_state', game.get_state())
 
 @socketio.on('leave_game')
+@timed_event
 def handle_leave_game(data):
     game_id = data['game_id']
-    if game_id in active_games:
-        game = active_games[game_id]
-        game.remove_player(request.sid)
-        leave_room(game_id)
-        socketio.emit('player_left', game.get_state(), room=game_id)
-        print(f'Player {request.sid} left game {game_id}')
-
-# Single player endpoints (unchanged)
+    with core.game_store.locked(game_id) as game:
+        if game is not None:
+            game.remove_player(request.sid)
+            core.game_store.save(game)
+            untrack_player(request.sid, game_id)
+            leave_room(game_id)
+            leave_room(spectator_room(game_id))
+            socketio.emit('player_left', game.get_state(), room=game_rooms(game_id))
+            print(f'Player {request.sid} left game {game_id}')
+
+@socketio.on('start_analysis')
+@timed_event
+def handle_start_analysis(data):
+    if not engine_pool:
+        emit('analysis_error', {'error': 'Engine not initialized'})
+        return
+    
+    try:
+        if not isinstance(data, dict):
+            raise TypeError('expected an object')
+        if data.get('session_id'):
+            with session_store.locked(data['session_id']) as session:
+                board = session.game_board()
+        else:
+            board = chess.Board(data.get('fen'))
+        think_time = parse_think_time(data.get('time') or ANALYSIS_MAX_TIME)
+        depth = max(1, int(data['depth'])) if data.get('depth') else None
+        multipv = max(1, min(int(data.get('multipv', 1)), ANALYSIS_MAX_MULTIPV))
+    except (TypeError, ValueError, OverflowError) as e:
+        emit('analysis_error', {'error': f'Invalid analysis request: {str(e)}'})
+        return
+    
+    # One running analysis per client; a new request replaces the old one
+    stop_analysis(request.sid)
+    job = AnalysisJob(request.sid, board, chess.engine.Limit(time=think_time, depth=depth), multipv,
+                      data.get('session_id'))
+    with analysis_lock:
+        analysis_jobs[request.sid] = job
+    socketio.start_background_task(job.run)
+    emit('analysis_started', {'analysis_id': job.analysis_id, 'fen': board.fen()})
+
+@socketio.on('stop_analysis')
+@timed_event
+def handle_stop_analysis(data=None):
+    stop_analysis(request.sid)
+
+def get_session_id():
+    # Clients send X-Session-ID; plain browsers fall back to a cookie
+    session_id = request.headers.get('X-Session-ID') or request.cookies.get('session_id')
+    if not session_id or len(session_id) > 64:
+        session_id = g.get('new_session_id') or uuid.uuid4().hex
+        g.new_session_id = session_id
+    return session_id
+
+@app.after_request
+def set_session_cookie(response):
+    if g.get('new_session_id'):
+        response.set_cookie('session_id', g.new_session_id, httponly=True, samesite='Lax')
+    return response
+
+# Single player endpoints (state is kept per browser session)
 @app.route('/api/init', methods=['POST'])
 def initialize():
+    # Only starts the engine if nothing has yet; never waits for it
     success = init_engine()
-    if not success and not STOCKFISH_PATH:
+    with session_store.locked(get_session_id()) as session:
+        if not success and not STOCKFISH_PATH:
+            return jsonify({
+                'success': False,
+                'error': 'Stockfish engine not found. Please install Stockfish and ensure it is accessible.',
+                'engine': engine_status(),
+                'session_id': session.session_id,
+                'fen': session.board.fen(),
+                'legal_moves': get_legal_move_map(session.board),
+                'config': session.config
+            })
         return jsonify({
-            'success': False,
-            'error': 'Stockfish engine not found. Please install Stockfish and ensure it is accessible.',
-            'fen': board.fen(),
-            'config': config
+            'success': success,
+            'engine': engine_status(),
+            'session_id': session.session_id,
+            'fen': session.board.fen(),
+            'legal_moves': get_legal_move_map(session.board),
+            'move_history': session.get_move_history(),
+            'config': session.config
         })
-    return jsonify({
-        'success': success,
-        'fen': board.fen(),
-        'config': config
-    })
 
 @app.route('/api/config', methods=['POST'])
 def set_config():
-    global config, engine
-    data = request.json
-    config.update(data)
-    
-    # Update engine configuration if threads or memory changed
-    if engine and ('threads' in data or 'memory' in data):
-        engine.configure({
-            "Threads": config['threads'],
-            "Hash": config['memory']
-        })
-    
-    return jsonify({'success': True, 'config': config})
+    try:
+        updates = parse_config(request.json, engine_pool.limits if engine_pool else None)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    with session_store.locked(get_session_id()) as session:
+        session.config.update(updates)
+        if {'mode', 'player_color', 'preanalyze', 'time'} & set(updates):
+            position_changed(session)
+        # Threads and memory apply from the session's next search; engines
+        # other sessions are using are left as they are
+        return jsonify({'success': True, 'config': session.config})
 
 @app.route('/api/move', methods=['POST'])
 def make_move():
-    global board, game_history
     data = request.json
     
-    try:
-        # Parse move
-        from_square = data.get('from')
-        to_square = data.get('to')
-        promotion = data.get('promotion')
-        
-        # Create move
-        move_uci = from_square + to_square + (promotion.lower() if promotion else '')
-        move = chess.Move.from_uci(move_uci)
-        
-        # Validate move
-        if move in board.legal_moves:
-            # Record move in algebraic notation
-            san = board.san(move)
-            board.push(move)
-            game_history.append({
-                'move': san,
-                'fen': board.fen(),
-                'from': from_square,
-                'to': to_square
-            })
-            
-            # Get computer move if in play mode
-            computer_move = None
-            if config['mode'] == 'play' and not board.is_game_over():
-                is_computer_turn = (board.turn == chess.WHITE and config['player_color'] == 'black') or \
-                                 (board.turn == chess.BLACK and config['player_color'] == 'white')
-                if is_computer_turn:
-                    computer_move = get_best_move()
-                    if computer_move:
-                        san = board.san(computer_move['move'])
-                        board.push(computer_move['move'])
-                        game_history.append({
-                            'move': san,
-                            'fen': board.fen(),
-                            'from': computer_move['from'],
-                            'to': computer_move['to']
-                        })
+    with session_store.locked(get_session_id()) as session:
+        board = session.board
+        session_config = session.config
+        try:
+            # Parse move
+            from_square = data.get('from')
+            to_square = data.get('to')
+            promotion = data.get('promotion')
             
-            return jsonify({
-                'success': True,
-                'fen': board.fen(),
-                'move_history': get_move_history(),
-                'computer_move': computer_move,
-                'game_over': board.is_game_over(),
-                'result': board.result() if board.is_game_over() else None
-            })
-        else:
-            return jsonify({'success': False, 'error': 'Illegal move'}), 400
+            # Create move
+            move_uci = from_square + to_square + (promotion.lower() if promotion else '')
+            move = chess.Move.from_uci(move_uci)
             
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 400
+            # Validate move
+            if move in board.legal_moves:
+                # Record move in algebraic notation
+                session.push_move(move)
+                
+                # Get computer move if in play mode
+                computer_move = None
+                engine_error = None
+                if session_config['mode'] == 'play' and not board.is_game_over():
+                    if session.is_computer_turn():
+                        try:
+                            computer_move = get_best_move(session.game_board(), session_config['time'], session.session_id)
+                        except EngineBusy as e:
+                            # Keep the player's move; the client can retry the reply
+                            engine_error = str(e)
+                        if computer_move:
+                            session.push_move(computer_move['move'])
+                start_pre_analysis(session)
+                
+                return jsonify({
+                    'success': True,
+                    'fen': board.fen(),
+                    'legal_moves': get_legal_move_map(board),
+                    'move_history': session.get_move_history(),
+                    'computer_move': computer_move,
+                    'engine_error': engine_error,
+                    'game_over': board.is_game_over(),
+                    'result': board.result() if board.is_game_over() else None
+                })
+            else:
+                return jsonify({'success': False, 'error': 'Illegal move'}), 400
+                
+        except Exception as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
 
 @app.route('/api/suggest', methods=['POST'])
 def suggest_move():
-    best_move = get_best_move()
+    # Search on a copy so the session lock is not held for the whole search
+    with session_store.locked(get_session_id()) as session:
+        session_id = session.session_id
+        board = session.game_board()
+        think_time = session.config['time']
+    try:
+        wait_for_pre_analysis(session_id, board, think_time)
+        best_move = get_best_move(board, think_time, session_id, PRIORITY_SUGGEST)
+    except EngineBusy as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
     return jsonify({
         'success': True if best_move else False,
         'suggestion': best_move
@@ -415,196 +865,480 @@ def suggest_move():
 
 @app.route('/api/fen', methods=['GET', 'POST'])
 def handle_fen():
-    global board, game_history
-    
-    if request.method == 'GET':
-        return jsonify({'fen': board.fen()})
-    else:
-        data = request.json
-        fen = data.get('fen')
-        try:
-            board = chess.Board(fen)
-            game_history = []  # Reset history when loading new position
-            return jsonify({'success': True, 'fen': board.fen()})
-        except Exception as e:
-            return jsonify({'success': False, 'error': f'Invalid FEN: {str(e)}'}), 400
+    with session_store.locked(get_session_id()) as session:
+        if request.method == 'GET':
+            return jsonify({'fen': session.board.fen(), 'legal_moves': get_legal_move_map(session.board)})
+        else:
+            data = request.json
+            fen = data.get('fen')
+            try:
+                session.reset(chess.Board(fen))  # Reset history when loading new position
+                position_changed(session)
+                return jsonify({
+                    'success': True,
+                    'fen': session.board.fen(),
+                    'legal_moves': get_legal_move_map(session.board)
+                })
+            except Exception as e:
+                return jsonify({'success': False, 'error': f'Invalid FEN: {str(e)}'}), 400
 
 @app.route('/api/reset', methods=['POST'])
 def reset_game():
-    global board, game_history
-    board = chess.Board()
-    game_history = []
-    return jsonify({
-        'success': True,
-        'fen': board.fen(),
-        'move_history': []
-    })
-
-@app.route('/api/undo', methods=['POST'])
-def undo_move():
-    global board, game_history
-    
-    if board.move_stack:
-        board.pop()
-        if game_history:
-            game_history.pop()
-        
-        # If in play mode and it's computer's turn, undo computer's move too
-        if config['mode'] == 'play' and board.move_stack:
-            is_computer_turn = (board.turn == chess.WHITE and config['player_color'] == 'black') or \
-                             (board.turn == chess.BLACK and config['player_color'] == 'white')
-            if is_computer_turn:
-                board.pop()
-                if game_history:
-                    game_history.pop()
-        
+    with session_store.locked(get_session_id()) as session:
+        session.reset()
+        position_changed(session)
         return jsonify({
             'success': True,
-            'fen': board.fen(),
-            'move_history': get_move_history()
+            'fen': session.board.fen(),
+            'legal_moves': get_legal_move_map(session.board),
+            'move_history': []
         })
-    else:
-        return jsonify({'success': False, 'error': 'No moves to undo'}), 400
+
+@app.route('/api/undo', methods=['POST'])
+def undo_move():
+    with session_store.locked(get_session_id()) as session:
+        if session.moves:
+            session.pop_move()
+            
+            # If in play mode and it's computer's turn, undo computer's move too
+            if session.config['mode'] == 'play' and session.moves and session.is_computer_turn():
+                session.pop_move()
+            position_changed(session)
+            board = session.board
+            
+            return jsonify({
+                'success': True,
+                'fen': board.fen(),
+                'legal_moves': get_legal_move_map(board),
+                'move_history': session.get_move_history()
+            })
+        else:
+            return jsonify({'success': False, 'error': 'No moves to undo'}), 400
 
 @app.route('/api/save', methods=['POST'])
 def save_game():
     data = request.json
     format_type = data.get('format', 'pgn')
     
-    if format_type == 'pgn':
-        game = chess.pgn.Game()
-        game.headers["Event"] = "Chess Assistant Game"
-        game.headers["Date"] = datetime.now().strftime("%Y.%m.%d")
-        game.headers["White"] = "Player" if config['player_color'] == 'white' else "Computer"
-        game.headers["Black"] = "Computer" if config['player_color'] == 'white' else "Player"
-        
-        node = game
-        temp_board = chess.Board()
-        for move in board.move_stack:
-            node = node.add_variation(move)
-            temp_board.push(move)
-        
-        pgn_string = str(game)
-        return jsonify({
-            'success': True,
-            'data': pgn_string,
-            'filename': f"game_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pgn"
-        })
-    else:
-        return jsonify({
-            'success': True,
-            'data': board.fen(),
-            'filename': f"position_{datetime.now().strftime('%Y%m%d_%H%M%S')}.fen"
-        })
+    with session_store.locked(get_session_id()) as session:
+        board = session.board
+        if format_type == 'pgn':
+            game = chess.pgn.Game()
+            game.headers["Event"] = "Chess Assistant Game"
+            game.headers["Date"] = datetime.now().strftime("%Y.%m.%d")
+            game.headers["White"] = "Player" if session.config['player_color'] == 'white' else "Computer"
+            game.headers["Black"] = "Computer" if session.config['player_color'] == 'white' else "Player"
+            
+            node = game
+            temp_board = chess.Board()
+            for move in session.moves.moves():
+                node = node.add_variation(move)
+                temp_board.push(move)
+            
+            pgn_string = str(game)
+            return jsonify({
+                'success': True,
+                'data': pgn_string,
+                'filename': f"game_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pgn"
+            })
+        else:
+            return jsonify({
+                'success': True,
+                'data': board.fen(),
+                'filename': f"position_{datetime.now().strftime('%Y%m%d_%H%M%S')}.fen"
+            })
 
 @app.route('/api/load', methods=['POST'])
 def load_game():
-    global board, game_history
     data = request.json
     content = data.get('content')
     format_type = data.get('format', 'pgn')
     
-    try:
-        if format_type == 'pgn':
-            pgn = io.StringIO(content)
-            game = chess.pgn.read_game(pgn)
-            if game:
-                board = game.board()
-                for move in game.mainline_moves():
-                    board.push(move)
-                game_history = []  # Reset history
+    with session_store.locked(get_session_id()) as session:
+        try:
+            if format_type == 'pgn':
+                pgn = io.StringIO(content)
+                game = chess.pgn.read_game(pgn)
+                if game:
+                    session.reset(game.board())
+                    for move in game.mainline_moves():
+                        session.push_move(move)
+                else:
+                    return jsonify({'success': False, 'error': 'Could not parse PGN'}), 400
             else:
-                return jsonify({'success': False, 'error': 'Could not parse PGN'}), 400
-        else:
-            board = chess.Board(content)
-            game_history = []
-        
+                session.reset(chess.Board(content))
+            position_changed(session)
+            
+            return jsonify({
+                'success': True,
+                'fen': session.board.fen(),
+                'legal_moves': get_legal_move_map(session.board),
+                'move_history': session.get_move_history()
+            })
+        except Exception as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/pgn/upload', methods=['POST'])
+def upload_pgn():
+    # Raw PGN body or multipart file; either way it is streamed to disk
+    upload = request.files.get('file')
+    try:
+        database = PgnDatabase.create(upload.stream if upload else request.stream)
+        total, games = database.find(limit=PGN_PAGE_SIZE)
+    except (OSError, sqlite3.Error) as e:
+        return jsonify({'success': False, 'error': f'Could not store PGN: {str(e)}'}), 500
+    return jsonify({
+        'success': True,
+        'database_id': database.database_id,
+        'total': total,
+        'games': games
+    })
+
+@app.route('/api/pgn/<database_id>/games', methods=['GET'])
+def find_pgn_games(database_id):
+    database = open_pgn_database(database_id)
+    if not database:
+        return jsonify({'success': False, 'error': 'PGN database not found'}), 404
+    
+    args = request.args
+    try:
+        offset = max(0, int(args.get('offset', 0)))
+        limit = max(1, min(int(args.get('limit', PGN_PAGE_SIZE)), PGN_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid offset or limit'}), 400
+    total, games = database.find(
+        player=args.get('player'),
+        white=args.get('white'),
+        black=args.get('black'),
+        date=args.get('date'),
+        result=args.get('result'),
+        offset=offset,
+        limit=limit
+    )
+    return jsonify({'success': True, 'total': total, 'games': games})
+
+@app.route('/api/pgn/<database_id>/load', methods=['POST'])
+def load_pgn_game(database_id):
+    database = open_pgn_database(database_id)
+    if not database:
+        return jsonify({'success': False, 'error': 'PGN database not found'}), 404
+    
+    data = request.json or {}
+    try:
+        game = database.read_game(int(data.get('number', 1)))
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    if not game:
+        return jsonify({'success': False, 'error': 'Game not found'}), 404
+    
+    with session_store.locked(get_session_id()) as session:
+        session.reset(game.board())
+        for move in game.mainline_moves():
+            session.push_move(move)
+        position_changed(session)
         return jsonify({
             'success': True,
-            'fen': board.fen()
+            'fen': session.board.fen(),
+            'legal_moves': get_legal_move_map(session.board),
+            'move_history': session.get_move_history(),
+            'headers': dict(game.headers)
         })
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 400
 
 @app.route('/api/legal_moves', methods=['POST'])
 def get_legal_moves():
     data = request.json
     square = data.get('square')
     
-    if square:
-        try:
-            square_obj = chess.parse_square(square)
-            legal_moves = [move.uci() for move in board.legal_moves if move.from_square == square_obj]
+    with session_store.locked(get_session_id()) as session:
+        board = session.board
+        if square:
+            try:
+                square_obj = chess.parse_square(square)
+                legal_moves = [move.uci() for move in board.legal_moves if move.from_square == square_obj]
+                return jsonify({
+                    'success': True,
+                    'moves': legal_moves
+                })
+            except ValueError:
+                return jsonify({'success': False, 'error': 'Invalid square'}), 400
+        else:
             return jsonify({
                 'success': True,
-                'moves': legal_moves
+                'moves': [move.uci() for move in board.legal_moves]
             })
-        except ValueError:
-            return jsonify({'success': False, 'error': 'Invalid square'}), 400
+
+@app.route('/api/explorer', methods=['GET'])
+def explore_position():
+    if core.opening_explorer is None:
+        return jsonify({'success': False, 'error': 'No opening explorer index configured'}), 404
+    
+    # Any position by FEN, otherwise the session's board
+    fen = request.args.get('fen')
+    if fen:
+        try:
+            board = chess.Board(fen)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': f'Invalid FEN: {str(e)}'}), 400
     else:
-        return jsonify({
-            'success': True,
-            'moves': [move.uci() for move in board.legal_moves]
-        })
+        with session_store.locked(get_session_id()) as session:
+            board = session.board.copy(stack=False)
+    return jsonify(dict(success=True, **explorer_stats(board)))
+
+@app.route('/api/analyze_game', methods=['POST'])
+def analyze_game():
+    if not engine_pool:
+        return jsonify({'success': False, 'error': 'Engine not initialized'}), 503
+    data = request.json or {}
+    
+    with session_store.locked(get_session_id()) as session:
+        try:
+            think_time = parse_think_time(data.get('time') or session.config['time'])
+            if data.get('pgn'):
+                game = chess.pgn.read_game(io.StringIO(data['pgn']))
+                if not game:
+                    return jsonify({'success': False, 'error': 'Could not parse PGN'}), 400
+                start_board = game.board()
+                moves = list(game.mainline_moves())
+            else:
+                start_board = session.moves.start_board()
+                moves = session.moves.moves()
+            session_id = session.session_id
+        except (TypeError, ValueError) as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+    limit = chess.engine.Limit(time=think_time)
+    try:
+        engine_pool.check_quota(session_id, searches_needed(game_positions(start_board, moves), limit), limit)
+    except EngineBusy as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    
+    def generate():
+        try:
+            for report in analyse_game(start_board, moves, limit, session_id):
+                yield json.dumps(report) + '\n'
+        except EngineBusy as e:
+            yield json.dumps({'type': 'error', 'error': str(e)}) + '\n'
+        except Exception as e:
+            print(f"Engine error: {e}")
+            yield json.dumps({'type': 'error', 'error': 'Analysis failed'}) + '\n'
+    
+    # One JSON object per line, in ply order, followed by the summary
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/api/evaluate', methods=['POST'])
+def evaluate_positions():
+    if not engine_pool:
+        return jsonify({'success': False, 'error': 'Engine not initialized'}), 503
+    data = request.json or {}
+    
+    entries = data.get('positions')
+    if not isinstance(entries, list) or not entries:
+        return jsonify({'success': False, 'error': 'positions must be a list of FEN or EPD strings'}), 400
+    if len(entries) > EVAL_BATCH_MAX_POSITIONS:
+        return jsonify({'success': False, 'error': f'At most {EVAL_BATCH_MAX_POSITIONS} positions per request'}), 400
+    with session_store.locked(get_session_id()) as session:
+        session_id = session.session_id
+        default_time = session.config['time']
+    try:
+        limit = batch_limit(data, default_time)
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    positions, errors = batch_positions(entries)
+    try:
+        engine_pool.check_quota(session_id, searches_needed([board for board, _ in positions], limit), limit)
+    except EngineBusy as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    
+    def generate():
+        for report in errors:
+            yield json.dumps(report) + '\n'
+        cached = 0
+        for report in evaluate_batch(positions, limit, session_id):
+            cached += report.get('cached', False)
+            yield json.dumps(report) + '\n'
+        yield json.dumps(batch_summary(entries, positions, errors, cached)) + '\n'
+    
+    # One JSON object per unique position, in completion order, then a summary
+    return Response(generate(), mimetype='application/x-ndjson')
 
 @app.route('/api/active_games', methods=['GET'])
 def get_active_games():
     games_list = []
-    for game_id, game in active_games.items():
+    for game in core.game_store.all_games():
         games_list.append({
-            'game_id': game_id,
+            'game_id': game.game_id,
             'status': game.status,
             'players': game.players,
             'spectators_count': len(game.spectators)
         })
     return jsonify({'games': games_list})
 
-def get_best_move():
-    if not engine:
-        return None
+def evaluate_position(board, limit, session_id=None, priority=PRIORITY_INTERACTIVE):
+    """
+    Return the cached search result for board, searching on a pooled engine
+    when the cache cannot satisfy limit. The second value tells whether the
+    result came from the cache.
+    """
+    entry = core.eval_cache.get(board, limit)
+    if entry is not None:
+        return entry, True
+    if not engine_pool:
+        return None, False
     
-    try:
-        result = engine.play(
+    with engine_pool.acquire(session_id=session_id, priority=priority) as worker:
+        result = worker.engine.play(
             board, 
-            chess.engine.Limit(time=config['time'])
+            limit,
+            info=chess.engine.INFO_BASIC | chess.engine.INFO_SCORE | chess.engine.INFO_PV
         )
-        
-        if result.move:
-            return {
-                'move': result.move,
-                'from': chess.square_name(result.move.from_square),
-                'to': chess.square_name(result.move.to_square),
-                'uci': result.move.uci()
-            }
+    return search_entry(board, limit, result), False
+
+def ponder_position(session_id, board, limit):
+    """
+    evaluate_position for the computer's reply in play mode. The search
+    runs on the worker that pondered for this session if it is still idle;
+    when the player made the expected move python-chess turns the ponder
+    search into a ponderhit and the reply comes back almost at once. The
+    worker then ponders the player's next expected move.
+    """
+    entry = core.eval_cache.get(board, limit)
+    if entry is not None:
+        engine_pool.stop_pondering(session_id)
+        return entry, True
+    
+    worker = engine_pool.checkout(session_id=session_id, priority=PRIORITY_INTERACTIVE)
+    count_ponder(worker, session_id, board)
+    try:
+        result = worker.engine.play(
+            board,
+            limit,
+            ponder=True,
+            info=chess.engine.INFO_BASIC | chess.engine.INFO_SCORE | chess.engine.INFO_PV
+        )
+    except (chess.engine.EngineTerminatedError, chess.engine.EngineError, TimeoutError):
+        engine_pool.checkin(worker, broken=True)
+        raise
+    except BaseException:
+        engine_pool.checkin(worker)
+        raise
+    engine_pool.checkin(worker, pondering=ponder_target(session_id, board, result))
+    return search_entry(board, limit, result), False
+
+def stop_pondering(session_id):
+    if engine_pool:
+        engine_pool.stop_pondering(session_id)
+
+def position_changed(session):
+    # The board was replaced or taken back: drop work on the old position
+    stop_pondering(session.session_id)
+    start_pre_analysis(session)
+
+def get_best_move(board, think_time, session_id=None, priority=PRIORITY_INTERACTIVE):
+    """
+    The engine's move for board, searched at priority on behalf of
+    session_id. The computer's own moves in play mode (interactive, with a
+    session) also ponder.
+    """
+    book_move = book_reply(board)
+    if book_move:
+        if session_id is not None and priority == PRIORITY_INTERACTIVE:
+            stop_pondering(session_id)
+        return book_move
+    
+    try:
+        limit = chess.engine.Limit(time=think_time)
+        if session_id is not None and priority == PRIORITY_INTERACTIVE and ENGINE_PONDER and engine_pool:
+            entry, cached = ponder_position(session_id, board, limit)
+        else:
+            entry, cached = evaluate_position(board, limit, session_id, priority)
+    except EngineBusy:
+        raise
     except Exception as e:
         print(f"Engine error: {e}")
         return None
+    if entry is None:
+        return None
+    return engine_reply(entry, cached)
 
-def get_move_history():
-    moves = []
-    for i in range(0, len(game_history), 2):
-        move_num = i // 2 + 1
-        white_move = game_history[i]['move'] if i < len(game_history) else ''
-        black_move = game_history[i + 1]['move'] if i + 1 < len(game_history) else ''
-        moves.append({
-            'number': move_num,
-            'white': white_move,
-            'black': black_move
-        })
-    return moves
+def evaluate_game_position(board, limit, session_id=None):
+    entry = terminal_entry(board)
+    if entry is not None:
+        return entry
+    entry, _ = evaluate_position(board, limit, session_id, PRIORITY_BACKGROUND)
+    if entry is None:
+        raise chess.engine.EngineError('Engine returned no move')
+    return entry
+
+def analyse_game(start_board, moves, limit, session_id=None):
+    """
+    Yield one report per ply, in order, then a per-game summary. Every
+    position is searched once, in parallel on as many engines as
+    background work may use; the eval after ply N doubles as the eval
+    before ply N + 1.
+    """
+    boards = game_positions(start_board, moves)
+    totals = new_game_totals()
+    executor = ThreadPoolExecutor(max_workers=engine_pool.job_slots())
+    futures = [executor.submit(evaluate_game_position, position, limit, session_id) for position in boards]
+    try:
+        before = futures[0].result()
+        for ply, move in enumerate(moves):
+            after = futures[ply + 1].result()
+            yield ply_report(ply, boards[ply], move, before, after, totals)
+            before = after
+        yield game_summary(totals)
+    finally:
+        # Also runs when the client goes away mid-stream
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def evaluate_batch_position(board, limit, session_id=None):
+    entry = terminal_entry(board)
+    if entry is not None:
+        return entry, False
+    entry, cached = evaluate_position(board, limit, session_id, PRIORITY_BACKGROUND)
+    if entry is None:
+        raise chess.engine.EngineError('Engine returned no move')
+    return entry, cached
+
+def evaluate_batch(positions, limit, session_id=None):
+    """
+    Yield a report for each unique position as soon as it is evaluated.
+    Searches run at background priority, in parallel on as many engines
+    as background work may use.
+    """
+    executor = ThreadPoolExecutor(max_workers=engine_pool.job_slots())
+    futures = {executor.submit(evaluate_batch_position, board, limit, session_id): (board, indices)
+               for board, indices in positions}
+    try:
+        for future in as_completed(futures):
+            board, indices = futures[future]
+            try:
+                entry, cached = future.result()
+            except EngineBusy as e:
+                yield {'type': 'error', 'indices': indices, 'error': str(e)}
+            except Exception as e:
+                print(f"Engine error: {e}")
+                yield {'type': 'error', 'indices': indices, 'error': 'Evaluation failed'}
+            else:
+                yield batch_report(board, indices, entry, cached)
+    finally:
+        # Also runs when the client goes away mid-stream
+        executor.shutdown(wait=False, cancel_futures=True)
 
 # Cleanup function to properly close engine
 def cleanup():
-    global engine
-    if engine:
-        engine.quit()
+    if engine_pool:
+        engine_pool.close()
+    core.close()
 
 # Register cleanup function
 import atexit
 atexit.register(cleanup)
 
 if __name__ == '__main__':
-    init_engine()
+    # The debug reloader's parent process only watches files; start the
+    # engine in the process that serves requests
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        init_engine()
     try:
         # Run with SocketIO
         socketio.run(app, debug=True, host='0.0.0.0', port=5000)
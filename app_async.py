@@ -0,0 +1,1342 @@
+"""
+Asyncio deployment of Chess Assistant.
+
+Serves the same page, REST API and Socket.IO events as app.py, but on a
+single event loop: aiohttp handles HTTP, python-socketio's AsyncServer
+handles sockets, and Stockfish is driven through the coroutine API from
+chess.engine.popen_uci. Idle or waiting clients cost no threads, and a
+search is cancelled when the client that asked for it goes away.
+
+Run with:  python app_async.py
+
+Game logic, caches and settings live in core.py and are shared with
+app.py. Calls into them that can block on a lock, a file or Redis run in
+worker threads, off the event loop.
+"""
+import asyncio
+import cProfile
+import dataclasses
+import functools
+import json
+import os
+import sqlite3
+import time
+import uuid
+import weakref
+from contextlib import asynccontextmanager
+import io
+from datetime import datetime
+
+import chess
+import chess.engine
+import chess.pgn
+import socketio
+from aiohttp import web
+
+import core
+
+
+class AsyncEngineWorker:
+    def __init__(self, worker_id, transport, engine):
+        self.worker_id = worker_id
+        self.transport = transport
+        self.engine = engine
+        self.options = {}
+        self.searches = 0
+        self.since = time.monotonic()  # start of the current idle or busy span
+        self.pondering = None  # (session id, Zobrist hash of the expected position)
+        self.ponder_timer = None
+        self.ticket = None  # request the worker is checked out for
+        self.preempted = False  # set when a more urgent request wants the worker back
+
+    async def configure(self, options):
+        # Only send options that actually changed so the hash table survives
+        changed = {name: value for name, value in options.items() if self.options.get(name) != value}
+        if changed:
+            await self.engine.configure(changed)
+            self.options.update(changed)
+
+    async def warm(self, positions, limit):
+        for fen in positions:
+            await self.engine.analyse(chess.Board(fen), limit)
+
+    async def quit(self):
+        try:
+            await asyncio.wait_for(self.engine.quit(), 5)
+        except Exception:
+            self.transport.close()
+
+
+class AsyncEnginePool(core.EnginePoolBase):
+    """
+    Coroutine counterpart of app.EnginePool over the same
+    core.EnginePoolBase bookkeeping. A supervisor task starts workers,
+    replaces crashed ones with backoff and health-checks idle ones; a
+    worker parked pondering for a session is stopped by its own timer.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wake = asyncio.Event()
+        self.supervisor = None
+
+    def start(self):
+        # Returns at once; workers come up in the background
+        if self.supervisor:
+            return
+        self.missing = self.size
+        self.supervisor = asyncio.ensure_future(self._supervise())
+
+    def status(self):
+        return self._status()
+
+    async def _spawn(self):
+        self.next_id += 1
+        worker_id = self.next_id
+        worker = None
+        try:
+            transport, engine = await chess.engine.popen_uci(self.path)
+            worker = AsyncEngineWorker(worker_id, transport, engine)
+            self.limits = core.engine_option_limits(engine.options)
+            await worker.configure(self.options)
+            # Readiness probe, then fill the hash table before taking requests
+            await engine.ping()
+            await worker.warm(self.warmup, chess.engine.Limit(time=core.ENGINE_WARMUP_TIME))
+            return worker
+        except Exception as e:
+            print(f"Error starting engine worker {worker_id}: {e}")
+            if worker:
+                await worker.quit()
+            return None
+
+    async def _restore(self):
+        # Start every missing worker in parallel; returns how many came up
+        workers = await asyncio.gather(*(self._spawn() for _ in range(self.missing)))
+        started = [worker for worker in workers if worker]
+        if self.closed:
+            await asyncio.gather(*(worker.quit() for worker in started))
+            return 0
+        self.missing -= len(started)
+        now = time.monotonic()
+        for worker in started:
+            worker.since = now
+            self.idle.append(worker)
+        self._dispatch()
+        return len(started)
+
+    async def _health_check(self):
+        # Parked ponder searches end on their own timer, so only idle workers
+        for worker in list(self.idle):
+            await self._ping(worker, core.ENGINE_HEALTH_INTERVAL)
+
+    async def _ping(self, worker, timeout=None):
+        if self._hold(worker):
+            await self._check(worker, timeout)
+
+    async def _check(self, worker, timeout=None):
+        # The worker is held; any command ends a ponder search, so this also stops one
+        try:
+            await asyncio.wait_for(worker.engine.ping(), timeout)
+        except Exception:
+            print(f"Engine worker {worker.worker_id} failed its health check")
+            await self.checkin(worker, broken=True)
+            return
+        self._return(worker, searched=False)
+
+    def stop_pondering(self, session_id):
+        worker = self.pondering.get(session_id)
+        if worker is not None:
+            asyncio.ensure_future(self._ping(worker))
+
+    def _park(self, worker):
+        replaced = super()._park(worker)
+        worker.ponder_timer = asyncio.get_running_loop().call_later(
+            core.PONDER_MAX_TIME, self.stop_pondering, worker.pondering[0])
+        return replaced
+
+    def _unparked(self, worker):
+        super()._unparked(worker)
+        worker.ponder_timer.cancel()
+
+    def _handed(self, ticket):
+        if ticket.waiter and not ticket.waiter.done():
+            ticket.waiter.set_result(ticket.worker)
+
+    async def _supervise(self):
+        delay = 0
+        while not self.closed:
+            if self.missing:
+                await self._restore()
+                self.retrying = bool(self.missing)
+                if self.missing:
+                    delay = min(max(delay * 2, core.ENGINE_RESTART_MIN_DELAY), core.ENGINE_RESTART_MAX_DELAY)
+                    print(f"{self.missing} engine worker(s) failed to start; retrying in {delay:.0f}s")
+                else:
+                    delay = 0
+            try:
+                await asyncio.wait_for(self.wake.wait(), delay if self.missing else core.ENGINE_HEALTH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            if not self.missing and not self.closed:
+                await self._health_check()
+
+    async def checkout(self, session_id=None, wait=True, priority=core.PRIORITY_INTERACTIVE, preemptible=False):
+        if self.closed:
+            raise core.EngineBusy('Engine pool is shut down')
+        if not wait and not self.idle:
+            raise core.EngineBusy('No idle engine')
+        started = time.monotonic()
+        options = dict(self.options, **self.profile(session_id))
+        ticket = self._ticket(session_id, priority, preemptible, options, started)
+        worker = self._claim(ticket)
+        if worker is not None:
+            self._assign(ticket, worker)
+        else:
+            self.scheduler.enqueue(ticket)
+            self._dispatch()
+            if ticket.worker is None and not wait:
+                self.scheduler.remove(ticket)
+                raise core.EngineBusy('No idle engine')
+            if ticket.worker is None:
+                self._preempt(ticket)
+                ticket.waiter = asyncio.get_running_loop().create_future()
+                try:
+                    await asyncio.wait_for(ticket.waiter, self.queue_timeout)
+                except BaseException as e:
+                    if ticket.worker is None:
+                        self.scheduler.remove(ticket)
+                    else:
+                        # Handed a worker just as the wait ended; pass it on
+                        await self.checkin(ticket.worker)
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise core.engine_busy('timeout', 'Timed out waiting for an engine')
+                    raise
+        worker = ticket.worker
+        core.ENGINE_QUEUE_WAIT.observe(time.monotonic() - started, core.PRIORITY_NAMES[ticket.priority])
+        try:
+            await worker.configure(options)
+        except chess.engine.EngineTerminatedError as e:
+            print(f"Engine worker {worker.worker_id} failed to configure: {e}")
+            await self.checkin(worker, broken=True)
+            raise core.EngineBusy('Engine worker unavailable')
+        except chess.engine.EngineError as e:
+            # Rejected before it reached the engine, which is still healthy
+            await self.checkin(worker)
+            raise core.EngineOptionError(f'Invalid engine settings: {e}')
+        except Exception as e:
+            print(f"Engine worker {worker.worker_id} failed to configure: {e}")
+            await self.checkin(worker, broken=True)
+            raise core.EngineBusy('Engine worker unavailable')
+        return worker
+
+    async def checkin(self, worker, broken=False, pondering=None):
+        if not broken and not self.closed:
+            replaced = self._return(worker, pondering)
+            if replaced is not None:
+                # The session's older ponder search, stopped off the caller's path
+                asyncio.ensure_future(self._check(replaced))
+            return
+        self._release(worker)
+        self.affinity.forget(worker)
+        self._dispatch()
+        await worker.quit()
+        if self.closed:
+            return
+        print(f"Replacing crashed engine worker {worker.worker_id}")
+        self.missing += 1
+        self.restarts += 1
+        # The supervisor respawns it, off the caller's path
+        self.wake.set()
+
+    @asynccontextmanager
+    async def acquire(self, wait=True, session_id=None, priority=core.PRIORITY_INTERACTIVE, preemptible=False):
+        worker = await self.checkout(session_id, wait, priority, preemptible)
+        try:
+            yield worker
+        except (chess.engine.EngineTerminatedError, chess.engine.EngineError, asyncio.TimeoutError):
+            await self.checkin(worker, broken=True)
+            raise
+        except BaseException:
+            # Includes cancellation: python-chess stops the search and the
+            # engine stays usable for the next caller
+            await self.checkin(worker)
+            raise
+        else:
+            await self.checkin(worker)
+
+    async def close(self):
+        workers = self._shutdown()
+        self.wake.set()
+        for ticket in self.scheduler.drain():
+            if ticket.waiter and not ticket.waiter.done():
+                ticket.waiter.set_exception(core.EngineBusy('Engine pool is shut down'))
+        await asyncio.gather(*(worker.quit() for worker in workers))
+
+
+engine_pool = None
+
+def init_engine():
+    """
+    Start the engine pool in the background. Safe to call repeatedly: a
+    running pool (and its warm hash tables) is kept as it is.
+    """
+    global engine_pool
+    if not core.STOCKFISH_PATH:
+        print("Cannot initialize engine: Stockfish not found")
+        return False
+    if engine_pool is None or engine_pool.closed:
+        engine_pool = AsyncEnginePool(core.STOCKFISH_PATH, core.ENGINE_POOL_SIZE, {
+            "Threads": core.config['threads'],
+            "Hash": core.config['memory']
+        }, warmup=core.ENGINE_WARMUP_POSITIONS, profile=core.engine_profile)
+        engine_pool.start()
+        print(f"Starting engine pool with {core.ENGINE_POOL_SIZE} workers using {core.STOCKFISH_PATH}")
+    return True
+
+def engine_status():
+    return engine_pool.status() if engine_pool else 'unavailable'
+
+async def evaluate_position(board, limit, session_id=None, priority=core.PRIORITY_INTERACTIVE):
+    entry = await asyncio.to_thread(core.eval_cache.get, board, limit)
+    if entry is not None:
+        return entry, True
+    if not engine_pool:
+        return None, False
+
+    async with engine_pool.acquire(session_id=session_id, priority=priority) as worker:
+        result = await worker.engine.play(
+            board,
+            limit,
+            info=chess.engine.INFO_BASIC | chess.engine.INFO_SCORE | chess.engine.INFO_PV
+        )
+
+    entry = await asyncio.to_thread(core.search_entry, board, limit, result)
+    return entry, False
+
+async def ponder_position(session_id, board, limit):
+    # See app.ponder_position
+    entry = await asyncio.to_thread(core.eval_cache.get, board, limit)
+    if entry is not None:
+        engine_pool.stop_pondering(session_id)
+        return entry, True
+
+    worker = await engine_pool.checkout(session_id)
+    core.count_ponder(worker, session_id, board)
+    try:
+        result = await worker.engine.play(
+            board,
+            limit,
+            ponder=True,
+            info=chess.engine.INFO_BASIC | chess.engine.INFO_SCORE | chess.engine.INFO_PV
+        )
+    except (chess.engine.EngineTerminatedError, chess.engine.EngineError, asyncio.TimeoutError):
+        await engine_pool.checkin(worker, broken=True)
+        raise
+    except BaseException:
+        await engine_pool.checkin(worker)
+        raise
+    await engine_pool.checkin(worker, pondering=core.ponder_target(session_id, board, result))
+
+    entry = await asyncio.to_thread(core.search_entry, board, limit, result)
+    return entry, False
+
+def stop_pondering(session_id):
+    if engine_pool:
+        engine_pool.stop_pondering(session_id)
+
+def position_changed(session):
+    # The board was replaced or taken back: drop work on the old position
+    stop_pondering(session.session_id)
+    start_pre_analysis(session)
+
+async def get_best_move(board, think_time, session_id=None, priority=core.PRIORITY_INTERACTIVE):
+    # See app.get_best_move
+    book_move = core.book_reply(board)
+    if book_move:
+        if session_id is not None and priority == core.PRIORITY_INTERACTIVE:
+            stop_pondering(session_id)
+        return book_move
+
+    try:
+        limit = chess.engine.Limit(time=think_time)
+        if session_id is not None and priority == core.PRIORITY_INTERACTIVE and core.ENGINE_PONDER and engine_pool:
+            entry, cached = await ponder_position(session_id, board, limit)
+        else:
+            entry, cached = await evaluate_position(board, limit, session_id, priority)
+    except core.EngineBusy:
+        raise
+    except Exception as e:
+        print(f"Engine error: {e}")
+        return None
+    if entry is None:
+        return None
+    return core.engine_reply(entry, cached)
+
+
+# Sessions come from core.session_store; coroutines that await while using
+# one also hold its asyncio lock, since the store's thread locks cannot
+# tell two coroutines on the event loop apart
+session_locks = weakref.WeakValueDictionary()
+
+@asynccontextmanager
+async def session_lock(session_id):
+    lock = session_locks.get(session_id)
+    if lock is None:
+        lock = session_locks[session_id] = asyncio.Lock()
+    async with lock:
+        yield
+
+
+def to_json(data):
+    # Same output as Flask's jsonify, which writes moves out as dataclasses
+    return json.dumps(data, default=lambda value: dataclasses.asdict(value) if dataclasses.is_dataclass(value) else str(value))
+
+def json_response(data, status=200):
+    return web.json_response(data, status=status, dumps=to_json)
+
+@web.middleware
+async def record_request(request, handler):
+    started = time.perf_counter()
+    profiler = None
+    if core.PROFILE_TOKEN and request.headers.get('X-Profile') == core.PROFILE_TOKEN:
+        # Profiles everything the event loop runs meanwhile, not just this request
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            profiler = None
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource else 'unmatched'
+        core.HTTP_LATENCY.observe(elapsed, route, request.method, str(status))
+        if profiler:
+            profiler.disable()
+            core.print_profile(profiler, f'{request.method} {request.path}', elapsed)
+
+def timed_event(handler):
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            core.EVENT_LATENCY.observe(time.perf_counter() - started, handler.__name__)
+    return wrapper
+
+@web.middleware
+async def cors_and_session(request, handler):
+    if request.method == 'OPTIONS':
+        response = web.Response()
+    else:
+        # Clients send X-Session-ID; plain browsers fall back to a cookie
+        session_id = request.headers.get('X-Session-ID') or request.cookies.get('session_id')
+        new_session = not session_id or len(session_id) > 64
+        request['session_id'] = uuid.uuid4().hex if new_session else session_id
+        response = await handler(request)
+        if new_session and not response.prepared:
+            response.set_cookie('session_id', request['session_id'], httponly=True, samesite='Lax')
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, X-Session-ID'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+    return response
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return {}
+
+
+# Serve static files (HTML, CSS, JS)
+def asset_response(request, asset, immutable=False):
+    status, headers, body = asset.respond(request.headers.get('If-None-Match'),
+                                          request.headers.get('Accept-Encoding'), immutable)
+    return web.Response(body=body, status=status, headers=headers)
+
+async def index(request):
+    # Rebuilding an edited file reads and compresses it, so off the loop
+    return asset_response(request, await asyncio.to_thread(core.static_assets.source, 'index.html'))
+
+async def styles(request):
+    return asset_response(request, await asyncio.to_thread(core.static_assets.source, 'styles.css'))
+
+async def script(request):
+    return asset_response(request, await asyncio.to_thread(core.static_assets.source, 'script.js'))
+
+async def hashed_asset(request):
+    asset = core.static_assets.hashed.get(request.match_info['name'])
+    if asset is None:
+        return json_response({'success': False, 'error': 'Not found'}, 404)
+    return asset_response(request, asset, immutable=True)
+
+
+# Single player endpoints
+async def initialize(request):
+    # Only starts the engine if nothing has yet; never waits for it
+    success = init_engine()
+    with core.session_store.locked(request['session_id']) as session:
+        payload = {
+            'success': success,
+            'engine': engine_status(),
+            'session_id': session.session_id,
+            'fen': session.board.fen(),
+            'legal_moves': core.get_legal_move_map(session.board),
+            'move_history': session.get_move_history(),
+            'config': session.config
+        }
+    if not success and not core.STOCKFISH_PATH:
+        payload['error'] = 'Stockfish engine not found. Please install Stockfish and ensure it is accessible.'
+    return json_response(payload)
+
+async def set_config(request):
+    try:
+        updates = core.parse_config(await read_json(request), engine_pool.limits if engine_pool else None)
+    except ValueError as e:
+        return json_response({'success': False, 'error': str(e)}, 400)
+    with core.session_store.locked(request['session_id']) as session:
+        session.config.update(updates)
+        if {'mode', 'player_color', 'preanalyze', 'time'} & set(updates):
+            position_changed(session)
+        # Threads and memory apply from the session's next search
+        return json_response({'success': True, 'config': session.config})
+
+async def make_move(request):
+    data = await read_json(request)
+    session_id = request['session_id']
+
+    async with session_lock(session_id):
+        with core.session_store.locked(session_id) as session:
+            try:
+                promotion = data.get('promotion')
+                move = chess.Move.from_uci(data.get('from') + data.get('to') + (promotion.lower() if promotion else ''))
+            except Exception as e:
+                return json_response({'success': False, 'error': str(e)}, 400)
+            if move not in session.board.legal_moves:
+                return json_response({'success': False, 'error': 'Illegal move'}, 400)
+            session.push_move(move)
+
+            board = session.game_board()
+            wants_reply = session.config['mode'] == 'play' and not board.is_game_over() and session.is_computer_turn()
+            think_time = session.config['time']
+
+        # Get computer move if in play mode; the session stays locked
+        # against other requests, but not against the event loop
+        computer_move = None
+        engine_error = None
+        if wants_reply:
+            try:
+                computer_move = await get_best_move(board, think_time, session_id)
+            except core.EngineBusy as e:
+                # Keep the player's move; the client can retry the reply
+                engine_error = str(e)
+
+        with core.session_store.locked(session_id) as session:
+            if computer_move:
+                session.push_move(computer_move['move'])
+            start_pre_analysis(session)
+            board = session.board
+            return json_response({
+                'success': True,
+                'fen': board.fen(),
+                'legal_moves': core.get_legal_move_map(board),
+                'move_history': session.get_move_history(),
+                'computer_move': computer_move,
+                'engine_error': engine_error,
+                'game_over': board.is_game_over(),
+                'result': board.result() if board.is_game_over() else None
+            })
+
+async def suggest_move(request):
+    with core.session_store.locked(request['session_id']) as session:
+        board = session.game_board()
+        think_time = session.config['time']
+    try:
+        await wait_for_pre_analysis(request['session_id'], board, think_time)
+        best_move = await get_best_move(board, think_time, request['session_id'], core.PRIORITY_SUGGEST)
+    except core.EngineBusy as e:
+        return json_response({'success': False, 'error': str(e)}, e.status)
+    return json_response({
+        'success': True if best_move else False,
+        'suggestion': best_move
+    })
+
+async def handle_fen(request):
+    session_id = request['session_id']
+    if request.method == 'GET':
+        with core.session_store.locked(session_id) as session:
+            return json_response({'fen': session.board.fen(), 'legal_moves': core.get_legal_move_map(session.board)})
+
+    data = await read_json(request)
+    async with session_lock(session_id):
+        with core.session_store.locked(session_id) as session:
+            try:
+                session.reset(chess.Board(data.get('fen')))  # Reset history when loading new position
+            except Exception as e:
+                return json_response({'success': False, 'error': f'Invalid FEN: {str(e)}'}, 400)
+            position_changed(session)
+            return json_response({
+                'success': True,
+                'fen': session.board.fen(),
+                'legal_moves': core.get_legal_move_map(session.board)
+            })
+
+async def reset_game(request):
+    async with session_lock(request['session_id']):
+        with core.session_store.locked(request['session_id']) as session:
+            session.reset()
+            position_changed(session)
+            return json_response({
+                'success': True,
+                'fen': session.board.fen(),
+                'legal_moves': core.get_legal_move_map(session.board),
+                'move_history': []
+            })
+
+async def undo_move(request):
+    async with session_lock(request['session_id']):
+        with core.session_store.locked(request['session_id']) as session:
+            if not session.moves:
+                return json_response({'success': False, 'error': 'No moves to undo'}, 400)
+            session.pop_move()
+
+            # If in play mode and it's computer's turn, undo computer's move too
+            if session.config['mode'] == 'play' and session.moves and session.is_computer_turn():
+                session.pop_move()
+            position_changed(session)
+            board = session.board
+
+            return json_response({
+                'success': True,
+                'fen': board.fen(),
+                'legal_moves': core.get_legal_move_map(board),
+                'move_history': session.get_move_history()
+            })
+
+async def save_game(request):
+    data = await read_json(request)
+    with core.session_store.locked(request['session_id']) as session:
+        board = session.board
+        if data.get('format', 'pgn') != 'pgn':
+            return json_response({
+                'success': True,
+                'data': board.fen(),
+                'filename': f"position_{datetime.now().strftime('%Y%m%d_%H%M%S')}.fen"
+            })
+
+        game = chess.pgn.Game()
+        game.headers["Event"] = "Chess Assistant Game"
+        game.headers["Date"] = datetime.now().strftime("%Y.%m.%d")
+        game.headers["White"] = "Player" if session.config['player_color'] == 'white' else "Computer"
+        game.headers["Black"] = "Computer" if session.config['player_color'] == 'white' else "Player"
+        node = game
+        for move in session.moves.moves():
+            node = node.add_variation(move)
+        return json_response({
+            'success': True,
+            'data': str(game),
+            'filename': f"game_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pgn"
+        })
+
+async def load_game(request):
+    data = await read_json(request)
+    content = data.get('content')
+    async with session_lock(request['session_id']):
+        with core.session_store.locked(request['session_id']) as session:
+            try:
+                if data.get('format', 'pgn') == 'pgn':
+                    game = chess.pgn.read_game(io.StringIO(content))
+                    if not game:
+                        return json_response({'success': False, 'error': 'Could not parse PGN'}, 400)
+                    session.reset(game.board())
+                    for move in game.mainline_moves():
+                        session.push_move(move)
+                else:
+                    session.reset(chess.Board(content))
+            except Exception as e:
+                return json_response({'success': False, 'error': str(e)}, 400)
+            position_changed(session)
+            return json_response({
+                'success': True,
+                'fen': session.board.fen(),
+                'legal_moves': core.get_legal_move_map(session.board),
+                'move_history': session.get_move_history()
+            })
+
+class BlockingReader:
+    """
+    File-like read(size) over an aiohttp body, for code running in an
+    executor thread; each read waits for the event loop to deliver a chunk.
+    """
+
+    def __init__(self, read_chunk, loop):
+        self.read_chunk = read_chunk
+        self.loop = loop
+
+    def read(self, size):
+        return asyncio.run_coroutine_threadsafe(self.read_chunk(size), self.loop).result()
+
+async def upload_body(request):
+    # Raw PGN body or the "file" part of a multipart form, unread
+    if not request.content_type.startswith('multipart/'):
+        return request.content.read
+    reader = await request.multipart()
+    while True:
+        part = await reader.next()
+        if part is None:
+            return request.content.read
+        if part.name == 'file':
+            return part.read_chunk
+        await part.release()
+
+async def upload_pgn(request):
+    # Streamed to disk and indexed in a worker thread, off the event loop
+    loop = asyncio.get_running_loop()
+    try:
+        stream = BlockingReader(await upload_body(request), loop)
+        database = await loop.run_in_executor(None, core.PgnDatabase.create, stream)
+        total, games = await loop.run_in_executor(
+            None, functools.partial(database.find, limit=core.PGN_PAGE_SIZE))
+    except (OSError, sqlite3.Error) as e:
+        return json_response({'success': False, 'error': f'Could not store PGN: {str(e)}'}, 500)
+    return json_response({
+        'success': True,
+        'database_id': database.database_id,
+        'total': total,
+        'games': games
+    })
+
+async def find_pgn_games(request):
+    database = core.open_pgn_database(request.match_info['database_id'])
+    if not database:
+        return json_response({'success': False, 'error': 'PGN database not found'}, 404)
+    args = request.query
+    try:
+        offset = max(0, int(args.get('offset', 0)))
+        limit = max(1, min(int(args.get('limit', core.PGN_PAGE_SIZE)), core.PGN_PAGE_SIZE))
+    except ValueError:
+        return json_response({'success': False, 'error': 'Invalid offset or limit'}, 400)
+    total, games = await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+        database.find,
+        player=args.get('player'),
+        white=args.get('white'),
+        black=args.get('black'),
+        date=args.get('date'),
+        result=args.get('result'),
+        offset=offset,
+        limit=limit
+    ))
+    return json_response({'success': True, 'total': total, 'games': games})
+
+async def load_pgn_game(request):
+    database = core.open_pgn_database(request.match_info['database_id'])
+    if not database:
+        return json_response({'success': False, 'error': 'PGN database not found'}, 404)
+    data = await read_json(request)
+    try:
+        number = int(data.get('number', 1))
+    except (TypeError, ValueError) as e:
+        return json_response({'success': False, 'error': str(e)}, 400)
+    game = await asyncio.get_running_loop().run_in_executor(None, database.read_game, number)
+    if not game:
+        return json_response({'success': False, 'error': 'Game not found'}, 404)
+    async with session_lock(request['session_id']):
+        with core.session_store.locked(request['session_id']) as session:
+            session.reset(game.board())
+            for move in game.mainline_moves():
+                session.push_move(move)
+            position_changed(session)
+            return json_response({
+                'success': True,
+                'fen': session.board.fen(),
+                'legal_moves': core.get_legal_move_map(session.board),
+                'move_history': session.get_move_history(),
+                'headers': dict(game.headers)
+            })
+
+async def get_legal_moves(request):
+    data = await read_json(request)
+    square = data.get('square')
+    with core.session_store.locked(request['session_id']) as session:
+        moves = session.board.legal_moves
+        if square:
+            try:
+                square_obj = chess.parse_square(square)
+            except ValueError:
+                return json_response({'success': False, 'error': 'Invalid square'}, 400)
+            return json_response({'success': True, 'moves': [move.uci() for move in moves if move.from_square == square_obj]})
+        return json_response({'success': True, 'moves': [move.uci() for move in moves]})
+
+async def explore_position(request):
+    if core.opening_explorer is None:
+        return json_response({'success': False, 'error': 'No opening explorer index configured'}, 404)
+    fen = request.query.get('fen')
+    if fen:
+        try:
+            board = chess.Board(fen)
+        except ValueError as e:
+            return json_response({'success': False, 'error': f'Invalid FEN: {str(e)}'}, 400)
+    else:
+        with core.session_store.locked(request['session_id']) as session:
+            board = session.board.copy(stack=False)
+    return json_response(dict(success=True, **core.explorer_stats(board)))
+
+async def evaluate_game_position(board, limit, slots, session_id=None):
+    entry = core.terminal_entry(board)
+    if entry is not None:
+        return entry
+    # Never queue more searches than background work has engines
+    async with slots:
+        entry, _ = await evaluate_position(board, limit, session_id, core.PRIORITY_BACKGROUND)
+    if entry is None:
+        raise chess.engine.EngineError('Engine returned no move')
+    return entry
+
+async def analyze_game(request):
+    if not engine_pool:
+        return json_response({'success': False, 'error': 'Engine not initialized'}, 503)
+    data = await read_json(request)
+
+    with core.session_store.locked(request['session_id']) as session:
+        try:
+            think_time = core.parse_think_time(data.get('time') or session.config['time'])
+            if data.get('pgn'):
+                game = chess.pgn.read_game(io.StringIO(data['pgn']))
+                if not game:
+                    return json_response({'success': False, 'error': 'Could not parse PGN'}, 400)
+                start_board = game.board()
+                moves = list(game.mainline_moves())
+            else:
+                start_board = session.moves.start_board()
+                moves = session.moves.moves()
+        except (TypeError, ValueError) as e:
+            return json_response({'success': False, 'error': str(e)}, 400)
+    limit = chess.engine.Limit(time=think_time)
+    boards = core.game_positions(start_board, moves)
+    try:
+        needed = await asyncio.to_thread(core.searches_needed, boards, limit)
+        engine_pool.check_quota(request['session_id'], needed, limit)
+    except core.EngineBusy as e:
+        return json_response({'success': False, 'error': str(e)}, e.status)
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson', 'Access-Control-Allow-Origin': '*'})
+    await response.prepare(request)
+
+    slots = asyncio.Semaphore(engine_pool.job_slots())
+    tasks = [asyncio.ensure_future(evaluate_game_position(position, limit, slots, request['session_id']))
+             for position in boards]
+    totals = core.new_game_totals()
+    try:
+        before = await tasks[0]
+        for ply, move in enumerate(moves):
+            after = await tasks[ply + 1]
+            await response.write((json.dumps(core.ply_report(ply, boards[ply], move, before, after, totals)) + '\n').encode())
+            before = after
+        await response.write((json.dumps(core.game_summary(totals)) + '\n').encode())
+    except core.EngineBusy as e:
+        await response.write((json.dumps({'type': 'error', 'error': str(e)}) + '\n').encode())
+    except (chess.engine.EngineError, chess.engine.EngineTerminatedError) as e:
+        print(f"Engine error: {e}")
+        await response.write((json.dumps({'type': 'error', 'error': 'Analysis failed'}) + '\n').encode())
+    finally:
+        # Also runs when the client disconnects and the handler is cancelled
+        for task in tasks:
+            task.cancel()
+    await response.write_eof()
+    return response
+
+async def evaluate_batch_position(board, limit, slots, session_id=None):
+    entry = core.terminal_entry(board)
+    if entry is not None:
+        return entry, False
+    async with slots:
+        entry, cached = await evaluate_position(board, limit, session_id, core.PRIORITY_BACKGROUND)
+    if entry is None:
+        raise chess.engine.EngineError('Engine returned no move')
+    return entry, cached
+
+async def evaluate_positions(request):
+    if not engine_pool:
+        return json_response({'success': False, 'error': 'Engine not initialized'}, 503)
+    data = await read_json(request)
+
+    entries = data.get('positions')
+    if not isinstance(entries, list) or not entries:
+        return json_response({'success': False, 'error': 'positions must be a list of FEN or EPD strings'}, 400)
+    if len(entries) > core.EVAL_BATCH_MAX_POSITIONS:
+        return json_response({'success': False, 'error': f'At most {core.EVAL_BATCH_MAX_POSITIONS} positions per request'}, 400)
+    with core.session_store.locked(request['session_id']) as session:
+        default_time = session.config['time']
+    try:
+        limit = core.batch_limit(data, default_time)
+    except (TypeError, ValueError) as e:
+        return json_response({'success': False, 'error': str(e)}, 400)
+    positions, errors = core.batch_positions(entries)
+    try:
+        needed = await asyncio.to_thread(core.searches_needed, [board for board, _ in positions], limit)
+        engine_pool.check_quota(request['session_id'], needed, limit)
+    except core.EngineBusy as e:
+        return json_response({'success': False, 'error': str(e)}, e.status)
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson', 'Access-Control-Allow-Origin': '*'})
+    await response.prepare(request)
+    for report in errors:
+        await response.write((json.dumps(report) + '\n').encode())
+
+    # One JSON object per unique position, in completion order, then a summary
+    slots = asyncio.Semaphore(engine_pool.job_slots())
+    tasks = {asyncio.ensure_future(evaluate_batch_position(board, limit, slots, request['session_id'])): (board, indices)
+             for board, indices in positions}
+    cached = 0
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                board, indices = tasks[task]
+                try:
+                    entry, hit = task.result()
+                except core.EngineBusy as e:
+                    report = {'type': 'error', 'indices': indices, 'error': str(e)}
+                except (chess.engine.EngineError, chess.engine.EngineTerminatedError) as e:
+                    print(f"Engine error: {e}")
+                    report = {'type': 'error', 'indices': indices, 'error': 'Evaluation failed'}
+                else:
+                    cached += hit
+                    report = core.batch_report(board, indices, entry, hit)
+                await response.write((json.dumps(report) + '\n').encode())
+        await response.write((json.dumps(core.batch_summary(entries, positions, errors, cached)) + '\n').encode())
+    finally:
+        # Also runs when the client disconnects and the handler is cancelled
+        for task in tasks:
+            task.cancel()
+    await response.write_eof()
+    return response
+
+async def metrics(request):
+    games = await asyncio.to_thread(core.game_store.all_games)
+    return web.Response(body=core.render_metrics(engine_pool, games).encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+async def get_active_games(request):
+    games = await asyncio.to_thread(core.game_store.all_games)
+    return json_response({'games': [{
+        'game_id': game.game_id,
+        'status': game.status,
+        'players': game.players,
+        'spectators_count': len(game.spectators)
+    } for game in games]})
+
+
+# Socket.IO events. Game store locks can wait on another worker process or
+# on Redis, so each locked section runs in a thread and returns what the
+# event then sends
+message_queue = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+sio = socketio.AsyncServer(
+    async_mode='aiohttp',
+    cors_allowed_origins='*',
+    client_manager=socketio.AsyncRedisManager(message_queue) if message_queue else None
+)
+
+# Per-client analysis jobs and other searches, cancelled on disconnect
+analysis_jobs = {}
+client_tasks = {}
+
+def track_task(sid, task):
+    tasks = client_tasks.setdefault(sid, set())
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+
+def seat_player(sid, game_id, color):
+    # (assigned color, game state), or (None, None) if there is no such game
+    with core.game_store.locked(game_id) as game:
+        if game is None:
+            return None, None
+        assigned_color = game.add_player(sid, color)
+        core.game_store.save(game)
+        return assigned_color, game.get_state()
+
+def play_move(sid, game_id, data):
+    """(move delta, whether anyone is spectating, error message) for a player's move."""
+    with core.game_store.locked(game_id) as game:
+        if game is None:
+            return None, False, 'Game not found'
+        color = game.get_current_turn()
+        if game.players[color] != sid:
+            return None, False, 'Not your turn'
+        delta = game.make_move(data['from'], data['to'], data.get('promotion'))
+        if not delta:
+            return None, False, 'Invalid move'
+        core.game_store.save(game)
+        delta.update(game.get_status())
+        delta['sound'] = 'move'
+        delta['by'] = color
+        return delta, bool(game.spectators), None
+
+def resync_payload(game_id, since):
+    # The plies after since, or the whole state if since is out of range
+    with core.game_store.locked(game_id) as game:
+        if game is None:
+            return 'error', {'message': 'Game not found'}
+        try:
+            since = int(since)
+        except (TypeError, ValueError):
+            since = -1
+        if 0 <= since <= len(game.moves):
+            payload = game.get_status()
+            payload['moves'] = game.get_move_deltas(since)
+            return 'game_resync', payload
+        return 'game_state', game.get_state()
+
+def game_state(game_id):
+    with core.game_store.locked(game_id) as game:
+        return game.get_state() if game else None
+
+def unseat_player(sid, game_id):
+    with core.game_store.locked(game_id) as game:
+        if game is None:
+            return None
+        game.remove_player(sid)
+        core.game_store.save(game)
+        return game.get_state()
+
+def schedule_spectator_update(game_id, seen):
+    if core.claim_spectator_flush(game_id, seen):
+        sio.start_background_task(flush_spectator_update, game_id)
+
+async def flush_spectator_update(game_id):
+    await asyncio.sleep(core.SPECTATOR_UPDATE_INTERVAL)
+    update = await asyncio.to_thread(core.spectator_update, game_id)
+    if update:
+        await sio.emit('spectator_update', update, room=core.spectator_room(game_id))
+
+@sio.event
+@timed_event
+async def connect(sid, environ, auth=None):
+    print(f'Client connected: {sid}')
+    await sio.emit('connected', {'player_id': sid}, to=sid)
+
+@sio.event
+@timed_event
+async def disconnect(sid, *args):
+    print(f'Client disconnected: {sid}')
+    for task in client_tasks.pop(sid, set()):
+        task.cancel()
+    analysis_jobs.pop(sid, None)
+
+    # Remove player from the games they joined
+    for game_id, state in await asyncio.to_thread(core.drop_player, sid):
+        await sio.emit('player_left', state, room=core.game_rooms(game_id))
+
+@sio.event
+@timed_event
+async def create_game(sid, data):
+    game_id = str(uuid.uuid4())[:8]
+    game = core.MultiplayerGame(game_id)
+    assigned_color = game.add_player(sid, data.get('color', None))
+    await asyncio.to_thread(core.game_store.add, game)
+    core.track_player(sid, game_id)
+
+    await sio.enter_room(sid, game_id)
+    await sio.emit('game_created', {
+        'game_id': game_id,
+        'color': assigned_color,
+        'state': game.get_state()
+    }, to=sid)
+    print(f'Game created: {game_id}')
+
+@sio.event
+@timed_event
+async def join_game(sid, data):
+    game_id = data['game_id']
+    assigned_color, state = await asyncio.to_thread(seat_player, sid, game_id, data.get('color', None))
+    if state is None:
+        await sio.emit('error', {'message': 'Game not found'}, to=sid)
+        return
+    core.track_player(sid, game_id)
+
+    await sio.enter_room(sid, core.spectator_room(game_id) if assigned_color == 'spectator' else game_id)
+    await sio.emit('game_joined', {'game_id': game_id, 'color': assigned_color, 'state': state}, to=sid)
+
+    # Notify players and spectators
+    await sio.emit('player_joined', state, room=core.game_rooms(game_id))
+    print(f'Player {sid} joined game {game_id} as {assigned_color}')
+
+@sio.event
+@timed_event
+async def make_multiplayer_move(sid, data):
+    game_id = data['game_id']
+    delta, watched, error = await asyncio.to_thread(play_move, sid, game_id, data)
+    if error:
+        await sio.emit('error', {'message': error}, to=sid)
+        return
+
+    # Only the new ply goes out; clients that miss one ask for a resync.
+    # The opponent plays the sound, the mover skips it by color.
+    await sio.emit('move_made', delta, room=game_id)
+    if watched:
+        schedule_spectator_update(game_id, delta['seq'] - 1)
+
+@sio.event
+@timed_event
+async def resync_game(sid, data):
+    event, payload = await asyncio.to_thread(resync_payload, data['game_id'], data.get('since', 0))
+    await sio.emit(event, payload, to=sid)
+
+@sio.event
+@timed_event
+async def get_game_state(sid, data):
+    state = await asyncio.to_thread(game_state, data['game_id'])
+    if state is None:
+        await sio.emit('error', {'message': 'Game not found'}, to=sid)
+    else:
+        await sio.emit('game_state', state, to=sid)
+
+@sio.event
+@timed_event
+async def leave_game(sid, data):
+    game_id = data['game_id']
+    state = await asyncio.to_thread(unseat_player, sid, game_id)
+    if state is None:
+        return
+    core.untrack_player(sid, game_id)
+    await sio.leave_room(sid, game_id)
+    await sio.leave_room(sid, core.spectator_room(game_id))
+    await sio.emit('player_left', state, room=core.game_rooms(game_id))
+    print(f'Player {sid} left game {game_id}')
+
+
+class AsyncPreAnalysisJob(core.PreAnalysisJobBase):
+    """Coroutine counterpart of app.PreAnalysisJob."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stopped = False
+        self.done = asyncio.Event()
+
+    def stop(self):
+        self.stopped = True
+
+    async def run(self):
+        if self.previous:
+            await self.previous.done.wait()
+            self.previous = None
+        try:
+            if not self.stopped and await asyncio.to_thread(self.needed):
+                await self.search()
+        except core.EngineBusy:
+            pass  # No idle engine; the suggestion is searched on demand
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError) as e:
+            print(f"Engine error: {e}")
+        finally:
+            if pre_analysis_jobs.get(self.session_id) is self:
+                del pre_analysis_jobs[self.session_id]
+            self.done.set()
+
+    async def search(self):
+        async with engine_pool.acquire(wait=False, session_id=self.session_id, priority=core.PRIORITY_BACKGROUND,
+                                       preemptible=True) as worker:
+            self.started = time.monotonic()
+            with await worker.engine.analysis(self.board, self.limit) as analysis:
+                finished = False
+                while True:
+                    try:
+                        await asyncio.wait_for(analysis.get(), core.ANALYSIS_UPDATE_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    except chess.engine.AnalysisComplete:
+                        finished = True
+                        break
+                    if self.stopped or worker.preempted or engine_pool.waiting:
+                        # Superseded, or a request needs the engine
+                        analysis.stop()
+                        break
+                best = await analysis.wait()
+                info = analysis.info
+        await asyncio.to_thread(self.store, best, info, finished)
+
+pre_analysis_jobs = {}
+
+def start_pre_analysis(session):
+    # See app.start_pre_analysis
+    old = pre_analysis_jobs.pop(session.session_id, None)
+    if old:
+        old.stop()
+    if core.pre_analysis_wanted(session, engine_pool):
+        job = AsyncPreAnalysisJob(session.session_id, session.game_board(),
+                                  chess.engine.Limit(time=session.config['time']), old)
+        pre_analysis_jobs[session.session_id] = job
+        asyncio.ensure_future(job.run())
+
+async def wait_for_pre_analysis(session_id, board, think_time):
+    job = pre_analysis_jobs.get(session_id)
+    if job and job.covers(board, think_time):
+        try:
+            await asyncio.wait_for(job.done.wait(), think_time)
+        except asyncio.TimeoutError:
+            pass
+
+
+class AsyncAnalysisJob(core.AnalysisJobBase):
+    """Coroutine counterpart of app.AnalysisJob; a stopped job stops its engine search at once."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.analysis = None
+
+    def stop(self):
+        self.stopped = True
+        if self.analysis:
+            self.analysis.stop()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        lines = {}
+        started = loop.time()
+        try:
+            best = None
+            while best is None:
+                async with engine_pool.acquire(session_id=self.session_id, priority=core.PRIORITY_BACKGROUND,
+                                               preemptible=True) as worker:
+                    best = await self.search(worker, self.remaining_limit(loop.time() - started), lines)
+        except core.EngineBusy as e:
+            await sio.emit('analysis_error', {'analysis_id': self.analysis_id, 'error': str(e)}, to=self.sid)
+            return
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError) as e:
+            print(f"Engine error: {e}")
+            await sio.emit('analysis_error', {'analysis_id': self.analysis_id, 'error': 'Analysis failed'}, to=self.sid)
+            return
+        finally:
+            if analysis_jobs.get(self.sid) is self:
+                del analysis_jobs[self.sid]
+
+        await asyncio.to_thread(self.finish, lines, best, loop.time() - started)
+        await self.emit_lines('analysis_done', lines, bestmove=best.move.uci() if best.move else None)
+
+    async def search(self, worker, limit, lines):
+        # Returns the engine's best move, or None if the search was preempted
+        loop = asyncio.get_running_loop()
+        preempted = False
+        with await worker.engine.analysis(self.board, limit, multipv=self.multipv) as analysis:
+            self.analysis = analysis
+            if self.stopped:
+                analysis.stop()
+            last_flush = 0.0
+            dirty = False
+            while True:
+                # Wake at least once per interval to notice preemption
+                timeout = core.ANALYSIS_UPDATE_INTERVAL
+                if dirty:
+                    timeout = max(0.0, last_flush + core.ANALYSIS_UPDATE_INTERVAL - loop.time())
+                try:
+                    info = await asyncio.wait_for(analysis.get(), timeout)
+                except asyncio.TimeoutError:
+                    info = None
+                except chess.engine.AnalysisComplete:
+                    break
+                if info:
+                    dirty = self.collect(lines, info) or dirty
+                if dirty and loop.time() - last_flush >= core.ANALYSIS_UPDATE_INTERVAL:
+                    await self.emit_lines('analysis_update', lines)
+                    last_flush = loop.time()
+                    dirty = False
+                if worker.preempted and not preempted:
+                    analysis.stop()
+                    preempted = True
+            best = await analysis.wait()
+        self.analysis = None
+        return None if preempted and not self.stopped else best
+
+    async def emit_lines(self, event, lines, **extra):
+        await sio.emit(event, self.payload(lines, **extra), to=self.sid)
+
+@sio.event
+@timed_event
+async def start_analysis(sid, data):
+    if not engine_pool:
+        await sio.emit('analysis_error', {'error': 'Engine not initialized'}, to=sid)
+        return
+
+    try:
+        if not isinstance(data, dict):
+            raise TypeError('expected an object')
+        if data.get('session_id'):
+            with core.session_store.locked(data['session_id']) as session:
+                board = session.game_board()
+        else:
+            board = chess.Board(data.get('fen'))
+        think_time = core.parse_think_time(data.get('time') or core.ANALYSIS_MAX_TIME)
+        depth = max(1, int(data['depth'])) if data.get('depth') else None
+        multipv = max(1, min(int(data.get('multipv', 1)), core.ANALYSIS_MAX_MULTIPV))
+    except (TypeError, ValueError, OverflowError) as e:
+        await sio.emit('analysis_error', {'error': f'Invalid analysis request: {str(e)}'}, to=sid)
+        return
+
+    # One running analysis per client; a new request replaces the old one
+    previous = analysis_jobs.pop(sid, None)
+    if previous:
+        previous.stop()
+    job = AsyncAnalysisJob(sid, board, chess.engine.Limit(time=think_time, depth=depth), multipv,
+                           data.get('session_id'))
+    analysis_jobs[sid] = job
+    track_task(sid, asyncio.ensure_future(job.run()))
+    await sio.emit('analysis_started', {'analysis_id': job.analysis_id, 'fen': board.fen()}, to=sid)
+
+@sio.event
+@timed_event
+async def stop_analysis(sid, data=None):
+    job = analysis_jobs.pop(sid, None)
+    if job:
+        job.stop()
+
+
+async def start_background(web_app):
+    init_engine()
+
+async def cleanup(web_app):
+    if engine_pool:
+        await engine_pool.close()
+    await asyncio.to_thread(core.close)
+
+def create_app():
+    core.init()
+    web_app = web.Application(middlewares=[record_request, cors_and_session])
+    web_app.router.add_get('/', index)
+    web_app.router.add_get('/styles.css', styles)
+    web_app.router.add_get('/script.js', script)
+    web_app.router.add_get('/assets/{name}', hashed_asset)
+    web_app.router.add_post('/api/init', initialize)
+    web_app.router.add_post('/api/config', set_config)
+    web_app.router.add_post('/api/move', make_move)
+    web_app.router.add_post('/api/suggest', suggest_move)
+    web_app.router.add_route('*', '/api/fen', handle_fen)
+    web_app.router.add_post('/api/reset', reset_game)
+    web_app.router.add_post('/api/undo', undo_move)
+    web_app.router.add_post('/api/save', save_game)
+    web_app.router.add_post('/api/load', load_game)
+    web_app.router.add_post('/api/pgn/upload', upload_pgn)
+    web_app.router.add_get('/api/pgn/{database_id}/games', find_pgn_games)
+    web_app.router.add_post('/api/pgn/{database_id}/load', load_pgn_game)
+    web_app.router.add_post('/api/legal_moves', get_legal_moves)
+    web_app.router.add_get('/api/explorer', explore_position)
+    web_app.router.add_post('/api/analyze_game', analyze_game)
+    web_app.router.add_post('/api/evaluate', evaluate_positions)
+    web_app.router.add_get('/api/active_games', get_active_games)
+    web_app.router.add_get('/metrics', metrics)
+    sio.attach(web_app)
+    web_app.on_startup.append(start_background)
+    web_app.on_cleanup.append(cleanup)
+    return web_app
+
+if __name__ == '__main__':
+    # Cancel handlers (and their searches) when the client disconnects
+    web.run_app(create_app(), host='0.0.0.0', port=5000, handler_cancellation=True)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Deterministic stand-in for Stockfish that speaks enough UCI for Chess
+Assistant, so benchmarks are reproducible without a real engine.
+
+The move played in a position is always the same (picked from the sorted
+legal moves by Zobrist hash) and every search takes a fixed think delay:
+
+    STOCKFISH_PATH=bench/fake_engine.py FAKE_ENGINE_DELAY=0.05 python app.py
+
+The delay comes from --delay or FAKE_ENGINE_DELAY in seconds; without one
+the engine uses the movetime it is asked for. Infinite searches run until
+"stop"; ponder searches run until "stop", or until "ponderhit" turns them
+into a normal search whose time counts from the original "go", as in
+Stockfish.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import chess
+import chess.polyglot
+
+INFO_INTERVAL = 0.05
+
+
+def out(line):
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+
+def ranked_moves(board):
+    # Same order for the same position on every run
+    moves = sorted(board.legal_moves, key=lambda move: move.uci())
+    if moves:
+        start = chess.polyglot.zobrist_hash(board) % len(moves)
+        moves = moves[start:] + moves[:start]
+    return moves
+
+
+def position_score(board, rank):
+    return chess.polyglot.zobrist_hash(board) % 101 - 50 - rank * 10
+
+
+class FakeEngine:
+    def __init__(self, delay=None):
+        self.delay = delay
+        self.board = chess.Board()
+        self.multipv = 1
+        self.stop_event = threading.Event()
+        self.ponderhit = threading.Event()
+        self.wake = threading.Event()
+        self.search = None
+
+    def handle(self, line):
+        parts = line.split()
+        if not parts:
+            return True
+        command, args = parts[0], parts[1:]
+        if command == 'uci':
+            out('id name Chess Assistant fake engine')
+            out('id author Chess Assistant')
+            out('option name Threads type spin default 1 min 1 max 512')
+            out('option name Hash type spin default 16 min 1 max 33554432')
+            out('option name MultiPV type spin default 1 min 1 max 500')
+            out('option name Ponder type check default false')
+            out('uciok')
+        elif command == 'isready':
+            out('readyok')
+        elif command == 'setoption':
+            self.set_option(args)
+        elif command == 'ucinewgame':
+            self.board = chess.Board()
+        elif command == 'position':
+            self.set_position(args)
+        elif command == 'go':
+            self.finish_search()
+            self.stop_event.clear()
+            self.ponderhit.clear()
+            self.search = threading.Thread(target=self.go, args=(args, self.board.copy()), daemon=True)
+            self.search.start()
+        elif command == 'stop':
+            self.finish_search()
+        elif command == 'ponderhit':
+            self.ponderhit.set()
+            self.wake.set()
+        elif command == 'quit':
+            self.finish_search()
+            return False
+        return True
+
+    def set_option(self, args):
+        if 'name' in args and 'value' in args:
+            name = ' '.join(args[args.index('name') + 1:args.index('value')])
+            if name.lower() == 'multipv':
+                self.multipv = max(1, int(args[args.index('value') + 1]))
+
+    def set_position(self, args):
+        moves_at = args.index('moves') if 'moves' in args else len(args)
+        if args[0] == 'startpos':
+            self.board = chess.Board()
+        else:
+            self.board = chess.Board(' '.join(args[1:moves_at]))
+        for move in args[moves_at + 1:]:
+            self.board.push_uci(move)
+
+    def finish_search(self):
+        if self.search:
+            self.stop_event.set()
+            self.wake.set()
+            self.search.join()
+            self.search = None
+
+    def think_time(self, args):
+        if self.delay is not None:
+            return self.delay
+        if 'movetime' in args:
+            return int(args[args.index('movetime') + 1]) / 1000
+        return 0.0
+
+    def go(self, args, board):
+        moves = ranked_moves(board)
+        if not moves:
+            out('info depth 0 score mate 0' if board.is_checkmate() else 'info depth 0 score cp 0')
+            out('bestmove (none)')
+            return
+
+        infinite = 'infinite' in args
+        pondering = 'ponder' in args
+        max_depth = int(args[args.index('depth') + 1]) if 'depth' in args else None
+        timed = self.delay is not None or 'movetime' in args
+        deadline = time.monotonic() + self.think_time(args)
+        started = time.monotonic()
+        depth = 0
+        while True:
+            depth += 1
+            elapsed = time.monotonic() - started
+            for rank, move in enumerate(moves[:self.multipv]):
+                nodes = depth * 1000
+                out(f'info depth {depth} seldepth {depth} multipv {rank + 1} '
+                    f'score cp {position_score(board, rank)} nodes {nodes} '
+                    f'time {int(elapsed * 1000)} pv {move.uci()}')
+            if pondering and self.ponderhit.is_set():
+                pondering = False
+            if not infinite and not pondering:
+                if max_depth is not None and depth >= max_depth:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 and (max_depth is None or timed):
+                    break
+            wait = INFO_INTERVAL if infinite or pondering else max(0.0, min(INFO_INTERVAL, remaining))
+            self.wake.wait(wait)
+            self.wake.clear()
+            if self.stop_event.is_set():
+                break
+        # The expected reply is what this engine would play after the best move
+        board.push(moves[0])
+        replies = ranked_moves(board)
+        out(f'bestmove {moves[0].uci()}' + (f' ponder {replies[0].uci()}' if replies else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--delay', type=float, default=None,
+                        help='seconds every search takes (default: FAKE_ENGINE_DELAY, else the requested movetime)')
+    options = parser.parse_args()
+    delay = options.delay
+    if delay is None and os.environ.get('FAKE_ENGINE_DELAY'):
+        delay = float(os.environ['FAKE_ENGINE_DELAY'])
+
+    engine = FakeEngine(delay)
+    for line in sys.stdin:
+        if not engine.handle(line):
+            break
+
+
+if __name__ == '__main__':
+    main()
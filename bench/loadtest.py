@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+"""
+Load test for Chess Assistant.
+
+Simulates concurrent players against a running server. REST players
+play single-player games through /api/legal_moves, /api/move and
+/api/suggest. Play-mode players play against the engine through
+/api/move, so each move waits for the engine's reply and goes through
+the ponder path. Multiplayer players pair up over Socket.IO and play
+through create_game, join_game and make_multiplayer_move. For each
+operation the test reports throughput and p50/p95/p99 latency, and
+writes the results to a JSON file that can be diffed between releases
+(bench/results.json by default, which git ignores).
+
+Against a server you started yourself:
+
+    python bench/loadtest.py --url http://localhost:5000 --players 20
+
+Or let the test start the server with the fake engine, so runs can be
+reproduced without Stockfish:
+
+    python bench/loadtest.py --start-server --engine-delay 0.05 --players 20 --play 10 --multiplayer 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import signal
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime
+
+import aiohttp
+import chess
+import socketio
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+FAKE_ENGINE = os.path.join(BENCH_DIR, 'fake_engine.py')
+
+SERVER_COMMANDS = {
+    'threaded': "import app; app.init_engine(); "
+                "app.socketio.run(app.app, host='127.0.0.1', port={port}, allow_unsafe_werkzeug=True)",
+    'async': "import app_async; from aiohttp import web; "
+             "web.run_app(app_async.create_app(), host='127.0.0.1', port={port}, handler_cancellation=True)"
+}
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, operation, seconds):
+        self.latencies.setdefault(operation, []).append(seconds)
+
+    def fail(self, operation, error):
+        errors = self.errors.setdefault(operation, {})
+        errors[error] = errors.get(error, 0) + 1
+
+    def report(self, elapsed):
+        operations = {}
+        for operation in sorted(set(self.latencies) | set(self.errors)):
+            samples = sorted(self.latencies.get(operation, []))
+            errors = self.errors.get(operation, {})
+            operations[operation] = {
+                'count': len(samples),
+                'errors': sum(errors.values()),
+                'error_kinds': errors,
+                'throughput': round(len(samples) / elapsed, 2),
+                'mean_ms': round(sum(samples) / len(samples) * 1000, 2) if samples else None,
+                'p50_ms': percentile(samples, 50),
+                'p95_ms': percentile(samples, 95),
+                'p99_ms': percentile(samples, 99),
+                'max_ms': round(samples[-1] * 1000, 2) if samples else None
+            }
+        return operations
+
+
+def percentile(samples, pct):
+    # Nearest-rank percentile of an already sorted list, in milliseconds
+    if not samples:
+        return None
+    rank = max(1, -(-len(samples) * pct // 100))
+    return round(samples[int(rank) - 1] * 1000, 2)
+
+
+async def timed(recorder, operation, coro):
+    started = time.perf_counter()
+    try:
+        result = await coro
+    except Exception as e:
+        recorder.fail(operation, type(e).__name__)
+        return None
+    recorder.add(operation, time.perf_counter() - started)
+    return result
+
+
+async def post(http, url, session_id, path, payload=None):
+    async with http.post(f'{url}/api{path}', json=payload or {}, headers={'X-Session-ID': session_id}) as response:
+        data = await response.json()
+        if response.status >= 400 or data.get('success') is False:
+            raise RuntimeError(data.get('error') or f'HTTP {response.status}')
+        return data
+
+
+async def rest_player(number, options, recorder, deadline):
+    """Plays both sides of a single-player game, asking for hints as it goes."""
+    rng = random.Random(options.seed * 1000 + number)
+    session_id = f'bench-{options.seed}-{number}-{uuid.uuid4().hex[:8]}'
+    async with aiohttp.ClientSession() as http:
+        await post(http, options.url, session_id, '/config', {'mode': 'suggest', 'time': options.think_time})
+        await post(http, options.url, session_id, '/reset')
+        ply = 0
+        while time.monotonic() < deadline:
+            data = await timed(recorder, 'rest.legal_moves', post(http, options.url, session_id, '/legal_moves'))
+            if not data or not data['moves']:
+                await post(http, options.url, session_id, '/reset')
+                ply = 0
+                continue
+            if options.suggest_every and ply % options.suggest_every == 0:
+                await timed(recorder, 'rest.suggest', post(http, options.url, session_id, '/suggest'))
+            move = rng.choice(sorted(data['moves']))
+            result = await timed(recorder, 'rest.move', post(http, options.url, session_id, '/move', {
+                'from': move[:2],
+                'to': move[2:4],
+                'promotion': move[4:] or None
+            }))
+            ply += 1
+            if not result or result.get('game_over') or ply >= options.max_plies:
+                await post(http, options.url, session_id, '/reset')
+                ply = 0
+
+
+async def play_player(number, options, recorder, deadline):
+    """Plays white against the engine; every move waits for the engine's reply."""
+    rng = random.Random(options.seed * 1000 + 250 + number)
+    session_id = f'bench-play-{options.seed}-{number}-{uuid.uuid4().hex[:8]}'
+    async with aiohttp.ClientSession() as http:
+        await post(http, options.url, session_id, '/config',
+                   {'mode': 'play', 'player_color': 'white', 'time': options.think_time})
+        await post(http, options.url, session_id, '/reset')
+        ply = 0
+        while time.monotonic() < deadline:
+            data = await timed(recorder, 'play.legal_moves', post(http, options.url, session_id, '/legal_moves'))
+            if not data or not data['moves']:
+                await post(http, options.url, session_id, '/reset')
+                ply = 0
+                continue
+            move = rng.choice(sorted(data['moves']))
+            result = await timed(recorder, 'play.move', post(http, options.url, session_id, '/move', {
+                'from': move[:2],
+                'to': move[2:4],
+                'promotion': move[4:] or None
+            }))
+            if result and result.get('engine_error'):
+                # The engine did not reply, so it would be the player's turn with the other colour
+                recorder.fail('play.engine_reply', 'EngineBusy')
+            ply += 2
+            if not result or result.get('game_over') or result.get('engine_error') or ply >= options.max_plies:
+                await post(http, options.url, session_id, '/reset')
+                ply = 0
+
+
+class SocketPlayer:
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.client = socketio.AsyncClient(reconnection=False)
+        self.waiters = {}
+        self.seq = 0
+        for event in ('game_created', 'game_joined', 'error'):
+            self.client.on(event, self.resolver(event))
+        self.client.on('move_made', self.on_move)
+        self.client.on('game_resync', self.on_move)
+        self.client.on('game_state', self.on_move)
+
+    def resolver(self, event):
+        async def handler(data):
+            waiter = self.waiters.pop(event, None)
+            if event == 'error':
+                for pending in list(self.waiters.values()):
+                    if not pending.done():
+                        pending.set_exception(RuntimeError(data.get('message')))
+                self.waiters.clear()
+            elif waiter and not waiter.done():
+                waiter.set_result(data)
+        return handler
+
+    async def on_move(self, data):
+        self.seq = max(self.seq, data.get('seq', 0))
+        waiter = self.waiters.get(('seq', self.seq))
+        if waiter and not waiter.done():
+            waiter.set_result(data)
+
+    async def request(self, operation, event, payload, reply, timeout):
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[reply] = waiter
+        started = time.perf_counter()
+        try:
+            await self.client.emit(event, payload)
+            result = await asyncio.wait_for(waiter, timeout)
+        except Exception as e:
+            self.recorder.fail(operation, type(e).__name__)
+            return None
+        finally:
+            self.waiters.pop(reply, None)
+        self.recorder.add(operation, time.perf_counter() - started)
+        return result
+
+
+async def multiplayer_pair(number, options, recorder, deadline):
+    """Two clients play games against each other until the deadline."""
+    rng = random.Random(options.seed * 1000 + 500 + number)
+    white, black = SocketPlayer(recorder), SocketPlayer(recorder)
+    await timed(recorder, 'socket.connect', white.client.connect(options.url, wait_timeout=options.timeout))
+    await timed(recorder, 'socket.connect', black.client.connect(options.url, wait_timeout=options.timeout))
+    try:
+        while time.monotonic() < deadline:
+            created = await white.request('socket.create_game', 'create_game', {'color': 'white'},
+                                          'game_created', options.timeout)
+            if not created:
+                continue
+            game_id = created['game_id']
+            joined = await black.request('socket.join_game', 'join_game', {'game_id': game_id, 'color': 'black'},
+                                         'game_joined', options.timeout)
+            if not joined:
+                continue
+            board = chess.Board()
+            white.seq = black.seq = 0
+            while time.monotonic() < deadline and not board.is_game_over() and board.ply() < options.max_plies:
+                mover = white if board.turn == chess.WHITE else black
+                move = rng.choice(sorted(board.legal_moves, key=lambda m: m.uci()))
+                result = await mover.request('socket.make_multiplayer_move', 'make_multiplayer_move', {
+                    'game_id': game_id,
+                    'from': chess.square_name(move.from_square),
+                    'to': chess.square_name(move.to_square),
+                    'promotion': chess.piece_symbol(move.promotion) if move.promotion else None
+                }, ('seq', board.ply() + 1), options.timeout)
+                if not result:
+                    break
+                board.push(move)
+            await white.client.emit('leave_game', {'game_id': game_id})
+            await black.client.emit('leave_game', {'game_id': game_id})
+    finally:
+        await white.client.disconnect()
+        await black.client.disconnect()
+
+
+async def wait_for_server(url, timeout):
+    started = time.monotonic()
+    async with aiohttp.ClientSession() as http:
+        while time.monotonic() - started < timeout:
+            try:
+                async with http.post(f'{url}/api/init') as response:
+                    data = await response.json()
+                    if data.get('engine') in ('ready', None):
+                        return data
+            except (aiohttp.ClientError, ValueError):
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f'Server at {url} did not become ready within {timeout}s')
+
+
+def start_server(options):
+    env = dict(os.environ, STOCKFISH_PATH=FAKE_ENGINE)
+    if options.engine_delay is not None:
+        env['FAKE_ENGINE_DELAY'] = str(options.engine_delay)
+    command = [sys.executable, '-c', SERVER_COMMANDS[options.server].format(port=options.port)]
+    kwargs = {'start_new_session': True} if os.name == 'posix' else {}
+    return subprocess.Popen(command, cwd=ROOT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **kwargs)
+
+
+def stop_server(process):
+    if os.name == 'posix':
+        os.killpg(process.pid, signal.SIGTERM)
+    else:
+        process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(options):
+    init = await wait_for_server(options.url, options.timeout)
+    deadline = time.monotonic() + options.duration
+    recorder = Recorder()
+    started = time.monotonic()
+    tasks = [rest_player(number, options, recorder, deadline) for number in range(options.players)]
+    tasks += [play_player(number, options, recorder, deadline) for number in range(options.play)]
+    tasks += [multiplayer_pair(number, options, recorder, deadline) for number in range(options.multiplayer // 2)]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.monotonic() - started
+    for result in results:
+        if isinstance(result, Exception):
+            recorder.fail('player', type(result).__name__)
+    return init, elapsed, recorder.report(elapsed)
+
+
+def print_report(operations):
+    print(f"{'operation':32} {'count':>7} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for operation, stats in operations.items():
+        print(f"{operation:32} {stats['count']:>7} {stats['errors']:>6} {stats['throughput']:>8} "
+              f"{stats['p50_ms'] or '-':>8} {stats['p95_ms'] or '-':>8} {stats['p99_ms'] or '-':>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='server to test (default: the one started with --start-server)')
+    parser.add_argument('--players', type=int, default=10, help='concurrent single-player REST clients')
+    parser.add_argument('--play', type=int, default=5, help='concurrent play-mode REST clients against the engine')
+    parser.add_argument('--multiplayer', type=int, default=10, help='concurrent multiplayer clients, in pairs')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run')
+    parser.add_argument('--think-time', type=float, default=0.1, help='engine time per suggestion, in seconds')
+    parser.add_argument('--suggest-every', type=int, default=5, help='ask for a suggestion every N plies (0: never)')
+    parser.add_argument('--max-plies', type=int, default=80, help='start a new game after this many plies')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds before a request counts as failed')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the moves players choose')
+    parser.add_argument('--output', default=os.path.join(BENCH_DIR, 'results.json'), help='JSON results file')
+    parser.add_argument('--start-server', action='store_true', help='start the server with the fake engine')
+    parser.add_argument('--server', choices=sorted(SERVER_COMMANDS), default='threaded',
+                        help='which server --start-server runs')
+    parser.add_argument('--port', type=int, default=5055, help='port for --start-server')
+    parser.add_argument('--engine-delay', type=float, default=None,
+                        help='fake engine think delay in seconds (default: the requested think time)')
+    options = parser.parse_args()
+
+    process = None
+    if options.start_server:
+        process = start_server(options)
+        options.url = options.url or f'http://127.0.0.1:{options.port}'
+    elif not options.url:
+        options.url = 'http://localhost:5000'
+    options.url = options.url.rstrip('/')
+
+    try:
+        init, elapsed, operations = asyncio.run(run(options))
+    finally:
+        if process:
+            stop_server(process)
+
+    print_report(operations)
+    results = {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'url': options.url,
+            'server': options.server if options.start_server else None,
+            'engine': 'fake' if options.start_server else 'external',
+            'engine_delay': options.engine_delay,
+            'engine_status': init.get('engine'),
+            'players': options.players,
+            'play': options.play,
+            'multiplayer': options.multiplayer // 2 * 2,
+            'duration': round(elapsed, 2),
+            'think_time': options.think_time,
+            'suggest_every': options.suggest_every,
+            'seed': options.seed
+        },
+        'operations': operations
+    }
+    with open(options.output, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+        results_file.write('\n')
+    print(f'Results written to {options.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2736 @@
+"""
+Game logic, engine scheduling, caches and settings shared by app.py
+(threaded Flask server) and app_async.py (asyncio server).
+
+Importing this module starts no threads and opens no files; each server
+calls init() once before serving and close() on shutdown.
+"""
+import os
+import json
+import chess
+import chess.engine
+import chess.pgn
+import chess.polyglot
+import bisect
+import gzip
+import hashlib
+import io
+import itertools
+import math
+import platform
+import pstats
+import queue
+import re
+import uuid
+import sqlite3
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from explorer import ExplorerIndex, decode_move, encode_move
+
+# Auto-detect Stockfish path in local directory
+def find_stockfish_path():
+    """
+    Find Stockfish executable in the local directory structure
+    """
+    system = platform.system().lower()
+    
+    # Get the directory where this script is located
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    
+    # Stockfish executable names by platform
+    if system == "windows":
+        exe_names = ["stockfish.exe", "stockfish_15_win_x64_avx2.exe", "stockfish_15_x64_avx2.exe"]
+    else:  # Linux/Mac
+        exe_names = ["stockfish", "stockfish_15_linux_x64_avx2", "stockfish_15"]
+    
+    # Search paths relative to script directory
+    search_paths = [
+        script_dir,  # Same directory as script
+        os.path.join(script_dir, "stockfish"),  # stockfish subdirectory
+        os.path.join(script_dir, "engines"),    # engines subdirectory
+        os.path.join(script_dir, "bin"),        # bin subdirectory
+    ]
+    
+    # Search for Stockfish executable
+    for path in search_paths:
+        for exe_name in exe_names:
+            full_path = os.path.join(path, exe_name)
+            if os.path.isfile(full_path):
+                # On Unix systems, check if file is executable
+                if system != "windows":
+                    if os.access(full_path, os.X_OK):
+                        print(f"Found Stockfish at: {full_path}")
+                        return full_path
+                else:
+                    print(f"Found Stockfish at: {full_path}")
+                    return full_path
+    
+    return None
+
+# Find Stockfish in local directory (STOCKFISH_PATH skips the search)
+STOCKFISH_PATH = os.environ.get('STOCKFISH_PATH') or find_stockfish_path()
+
+# Optional Polyglot opening book consulted before the engine
+def find_opening_book():
+    path = os.environ.get('OPENING_BOOK')
+    if path:
+        return path if os.path.isfile(path) else None
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    for candidate in (os.path.join(script_dir, 'book.bin'), os.path.join(script_dir, 'books', 'book.bin')):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+OPENING_BOOK_PATH = find_opening_book()
+OPENING_BOOK_DEPTH = int(os.environ.get('OPENING_BOOK_DEPTH', 20))  # plies
+OPENING_BOOK_MODE = os.environ.get('OPENING_BOOK_MODE', 'weighted')  # 'weighted' or 'best'
+
+opening_book = None  # opened by init()
+
+# Optional opening explorer index built offline with explorer.py
+def find_opening_explorer():
+    path = os.environ.get('OPENING_EXPLORER')
+    if path:
+        return path if os.path.isfile(path) else None
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    for candidate in (os.path.join(script_dir, 'explorer.bin'), os.path.join(script_dir, 'books', 'explorer.bin')):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+OPENING_EXPLORER_PATH = find_opening_explorer()
+
+opening_explorer = None  # opened by init()
+
+# Engine pool settings (Threads/Hash come from each session's config)
+ENGINE_POOL_SIZE = int(os.environ.get('ENGINE_POOL_SIZE', max(1, (os.cpu_count() or 1) // 2)))
+ENGINE_QUEUE_LIMIT = int(os.environ.get('ENGINE_QUEUE_LIMIT', 32))
+ENGINE_QUEUE_TIMEOUT = float(os.environ.get('ENGINE_QUEUE_TIMEOUT', 30.0))
+
+# Engine scheduling: requests queue in priority classes that share the
+# engines by weight. Each session may run ENGINE_SESSION_CONCURRENCY
+# searches at once, plus background searches on engines nothing else
+# wants, and spend ENGINE_SESSION_CPU_QUOTA engine CPU-seconds per
+# ENGINE_QUOTA_WINDOW; background work never takes the last
+# ENGINE_RESERVED_WORKERS workers
+PRIORITY_INTERACTIVE = 0  # the computer's reply in play mode
+PRIORITY_SUGGEST = 1  # move suggestions
+PRIORITY_BACKGROUND = 2  # analysis, game review, batch evaluation and pre-analysis
+PRIORITY_NAMES = ('interactive', 'suggest', 'background')
+PRIORITY_WEIGHTS = (16, 4, 1)
+ENGINE_SESSION_CONCURRENCY = int(os.environ.get('ENGINE_SESSION_CONCURRENCY', 2))
+ENGINE_SESSION_CPU_QUOTA = float(os.environ.get('ENGINE_SESSION_CPU_QUOTA', 300.0))
+ENGINE_QUOTA_WINDOW = float(os.environ.get('ENGINE_QUOTA_WINDOW', 300.0))
+ENGINE_RESERVED_WORKERS = int(os.environ.get('ENGINE_RESERVED_WORKERS', 1))
+
+# Engine affinity: each session's searches go back to the engine that ran
+# its last one while that is idle, so its hash table is still warm
+ENGINE_AFFINITY_SESSIONS = 10000  # sessions remembered, least recently used dropped first
+
+# Ceilings for the Threads and Hash (MB) a session may ask for, on top of
+# the engine's own limits
+ENGINE_MAX_THREADS = int(os.environ.get('ENGINE_MAX_THREADS', os.cpu_count() or 1))
+ENGINE_MAX_HASH = int(os.environ.get('ENGINE_MAX_HASH', 2048))
+
+# Engine supervision: crashed workers are restarted with exponential backoff
+# and idle workers are pinged every ENGINE_HEALTH_INTERVAL seconds
+ENGINE_RESTART_MIN_DELAY = 1.0
+ENGINE_RESTART_MAX_DELAY = float(os.environ.get('ENGINE_RESTART_MAX_DELAY', 60.0))
+ENGINE_HEALTH_INTERVAL = float(os.environ.get('ENGINE_HEALTH_INTERVAL', 30.0))
+
+# In play mode the engine keeps thinking on the player's expected move
+# (set ENGINE_PONDER=0 to turn it off); the health check stops ponder
+# searches that outlive PONDER_MAX_TIME
+ENGINE_PONDER = os.environ.get('ENGINE_PONDER', '1') != '0'
+PONDER_MAX_TIME = float(os.environ.get('PONDER_MAX_TIME', 300.0))
+
+# Positions each new worker searches before taking requests, to fill its hash
+def load_warmup_positions():
+    path = os.environ.get('ENGINE_WARMUP_FILE')
+    if not path:
+        return [chess.STARTING_FEN]
+    positions = []
+    try:
+        with open(path) as warmup_file:
+            for line in warmup_file:
+                fen = line.strip()
+                if not fen or fen.startswith('#'):
+                    continue
+                try:
+                    positions.append(chess.Board(fen).fen())
+                except ValueError:
+                    print(f"Skipping invalid warm-up FEN: {fen}")
+    except OSError as e:
+        print(f"Error reading warm-up positions {path}: {e}")
+    return positions
+
+ENGINE_WARMUP_POSITIONS = load_warmup_positions()
+ENGINE_WARMUP_TIME = float(os.environ.get('ENGINE_WARMUP_TIME', 0.2))
+
+# Multiplayer game storage: 'memory', 'file:<directory>' or a redis:// URL
+GAME_STORE = os.environ.get('GAME_STORE', 'memory')
+
+# Spectators get one coalesced update per game at most this often (seconds)
+SPECTATOR_UPDATE_INTERVAL = float(os.environ.get('SPECTATOR_UPDATE_INTERVAL', 0.5))
+
+# Write-behind journal that lets in-memory games survive a restart
+# (off unless GAME_JOURNAL names a SQLite file)
+GAME_JOURNAL = os.environ.get('GAME_JOURNAL', '')
+GAME_JOURNAL_BATCH = 500
+GAME_JOURNAL_COMPACT_ROWS = int(os.environ.get('GAME_JOURNAL_COMPACT_ROWS', 10000))
+GAME_JOURNAL_MAX_AGE = float(os.environ.get('GAME_JOURNAL_MAX_AGE', 86400))
+
+# Single-player session limits
+SESSION_MEMORY_LIMIT_MB = int(os.environ.get('SESSION_MEMORY_LIMIT_MB', 256))
+SESSION_IDLE_TTL = float(os.environ.get('SESSION_IDLE_TTL', 3600))
+
+# Position evaluation cache (set EVAL_CACHE_FILE to keep it across restarts)
+EVAL_CACHE_SIZE = int(os.environ.get('EVAL_CACHE_SIZE', 100000))
+EVAL_CACHE_FILE = os.environ.get('EVAL_CACHE_FILE')
+
+# Streaming analysis over Socket.IO
+ANALYSIS_UPDATE_INTERVAL = float(os.environ.get('ANALYSIS_UPDATE_INTERVAL', 0.1))
+ANALYSIS_MAX_TIME = float(os.environ.get('ANALYSIS_MAX_TIME', 60.0))
+ANALYSIS_MAX_MULTIPV = 5
+ANALYSIS_SAN_PLIES = 10
+
+# Whole-game analysis: centipawn-loss thresholds for move labels
+INACCURACY_CP = 50
+MISTAKE_CP = 100
+BLUNDER_CP = 300
+EVAL_CLAMP_CP = 1000
+
+# Static assets: fingerprinted files are cached by browsers for a year
+STATIC_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_IMMUTABLE_MAX_AGE = 365 * 86400
+STATIC_GZIP_LEVEL = 9
+
+# Batch evaluation: positions accepted per request
+EVAL_BATCH_MAX_POSITIONS = int(os.environ.get('EVAL_BATCH_MAX_POSITIONS', 500))
+
+# Uploaded PGN databases and their game indexes
+PGN_DATA_DIR = os.environ.get('PGN_DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pgn_data'))
+PGN_CHUNK_SIZE = 64 * 1024
+PGN_PAGE_SIZE = 200
+
+# Legal-move maps sent with every position, cached by Zobrist hash
+LEGAL_MOVE_CACHE_SIZE = 10000
+
+# Requests carrying "X-Profile: <PROFILE_TOKEN>" are run under cProfile
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_TOP_FUNCTIONS = 30
+
+# Prometheus metrics, served as text from /metrics
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+NPS_BUCKETS = (1e4, 3e4, 1e5, 3e5, 1e6, 3e6, 1e7, 3e7, 1e8)
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(self.labels, label_values)} {value}')
+        return lines
+
+
+class Histogram:
+    """
+    Prometheus histogram. Observing is a bisect and a locked list update,
+    cheap enough to leave on for every request.
+    """
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # label values -> [count per bucket..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        slot = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[slot] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = sorted((label_values, list(counts)) for label_values, counts in self.series.items())
+        for label_values, counts in series:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{format_labels(self.labels, label_values, [("le", le)])} {total}')
+            labels = format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {counts[-1]}')
+            lines.append(f'{self.name}_count{labels} {total}')
+        return lines
+
+
+HTTP_LATENCY = Histogram('chess_http_request_duration_seconds', 'Time spent handling HTTP requests.',
+                         ('route', 'method', 'status'))
+EVENT_LATENCY = Histogram('chess_socketio_event_duration_seconds', 'Time spent handling Socket.IO events.', ('event',))
+ENGINE_QUEUE_WAIT = Histogram('chess_engine_queue_wait_seconds', 'Time requests waited for a free engine, by priority class.',
+                              ('priority',))
+ENGINE_REJECTED = Counter('chess_engine_rejected_total', 'Engine requests turned away by admission control, by reason.',
+                          ('reason',))
+ENGINE_PREEMPTED = Counter('chess_engine_preempted_total', 'Background searches that handed their engine to a more urgent request.')
+ENGINE_AFFINITY = Counter('chess_engine_affinity_total', 'Session searches by whether they ran on the engine their last one used.',
+                          ('result',))
+ENGINE_RECONFIGURED = Counter('chess_engine_reconfigured_total', 'Checkouts that had to change an engine\'s Threads or Hash.')
+ENGINE_NPS = Histogram('chess_engine_nps', 'Nodes per second of completed engine searches.', buckets=NPS_BUCKETS)
+ENGINE_NODES = Counter('chess_engine_nodes_total', 'Nodes searched by the engines.')
+ENGINE_SEARCH_SECONDS = Counter('chess_engine_search_seconds_total', 'Engine time spent in completed searches.')
+ENGINE_SEARCHES = Counter('chess_engine_searches_total', 'Completed engine searches by kind.', ('kind',))
+CACHE_LOOKUPS = Counter('chess_cache_lookups_total', 'Cache lookups by cache and outcome.', ('cache', 'result'))
+PONDER_RESULTS = Counter('chess_ponder_total', 'Computer replies searched after pondering, by whether the expected move was played.',
+                         ('result',))
+
+def record_search(kind, info):
+    ENGINE_SEARCHES.inc(1, kind)
+    nodes = info.get('nodes')
+    seconds = info.get('time')
+    if nodes:
+        ENGINE_NODES.inc(nodes)
+    if seconds:
+        ENGINE_SEARCH_SECONDS.inc(seconds)
+    if nodes and seconds:
+        ENGINE_NPS.observe(info.get('nps') or nodes / seconds)
+
+# Defaults for new single-player sessions
+config = {
+    'time': 1.0,
+    'threads': 1,
+    'memory': 128,  # MB for hash table
+    'player_color': 'white',
+    'mode': 'suggest',  # 'suggest', 'play', or 'multiplayer'
+    'preanalyze': False  # suggest mode: search each new position in the background
+}
+CONFIG_CHOICES = {
+    'player_color': ('white', 'black'),
+    'mode': ('suggest', 'play', 'multiplayer')
+}
+MIN_THINK_TIME = 0.05
+
+def parse_think_time(value):
+    """Seconds to search, clamped to [MIN_THINK_TIME, ANALYSIS_MAX_TIME]; ValueError unless a finite number."""
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid time: {value!r}')
+    if not math.isfinite(seconds):
+        raise ValueError(f'Invalid time: {value!r}')
+    return max(MIN_THINK_TIME, min(seconds, ANALYSIS_MAX_TIME))
+
+def parse_config(data, limits=None):
+    """
+    Settings from a /api/config body, converted to their types and clamped
+    like analysis requests; raises ValueError for anything else. limits
+    maps engine option names to the running engine's (min, max).
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Expected a JSON object')
+    limits = limits or {}
+    updates = {}
+    for key, value in data.items():
+        if key not in config:
+            continue
+        try:
+            if key == 'time':
+                updates[key] = parse_think_time(value)
+            elif key in ('threads', 'memory'):
+                name, ceiling = ('Threads', ENGINE_MAX_THREADS) if key == 'threads' else ('Hash', ENGINE_MAX_HASH)
+                low, high = limits.get(name, (1, ceiling))
+                updates[key] = max(low, min(int(value), high, ceiling))
+            elif key == 'preanalyze':
+                if not isinstance(value, bool):
+                    raise ValueError
+                updates[key] = value
+            elif value in CONFIG_CHOICES[key]:
+                updates[key] = value
+            else:
+                raise ValueError
+        except (TypeError, ValueError):
+            raise ValueError(f'Invalid value for {key}: {data[key]!r}')
+    return updates
+
+def push_trimmed(board, move):
+    # Positions before a capture or pawn move can never repeat, so the
+    # stack only has to reach back to the last one
+    zeroing = board.is_zeroing(move)
+    board.push(move)
+    if zeroing:
+        board.clear_stack()
+
+class MoveList:
+    """
+    A game as its start position plus one 16-bit code per move. Only the
+    current position is kept as a board, with a stack back to the last
+    capture or pawn move; SAN and FEN of other plies are replayed when
+    first asked for and memoized.
+    """
+
+    __slots__ = ('start_fen', 'codes', 'board', 'sans', 'fens', 'pairs')
+
+    def __init__(self, board=None):
+        board = board if board is not None else chess.Board()
+        fen = board.fen()
+        self.start_fen = chess.STARTING_FEN if fen == chess.STARTING_FEN else fen
+        self.codes = array('H')
+        self.board = board.copy(stack=False)
+        self.sans = None  # SAN per ply, kept up to date once asked for
+        self.fens = None  # ply -> FEN, for the plies asked for
+        self.pairs = None  # numbered move list, kept up to date once asked for
+
+    def __len__(self):
+        return len(self.codes)
+
+    def move(self, ply):
+        return decode_move(self.codes[ply])
+
+    def moves(self):
+        return [decode_move(code) for code in self.codes]
+
+    def start_board(self):
+        return chess.Board(self.start_fen)
+
+    def game_board(self):
+        """The current position with every move on its stack, for the engine and exports."""
+        board = self.start_board()
+        for code in self.codes:
+            board.push(decode_move(code))
+        return board
+
+    def _replay(self, board, start, stop):
+        for code in self.codes[start:stop]:
+            push_trimmed(board, decode_move(code))
+        return board
+
+    def push(self, move, san=None):
+        # Pass the move's SAN if it is already known, to save working it out again
+        if self.sans is not None:
+            self._add_san(san or self.board.san(move))
+        self.codes.append(encode_move(move))
+        push_trimmed(self.board, move)
+
+    def pop(self):
+        code = self.codes.pop()
+        ply = len(self.codes)
+        if self.sans is not None:
+            self.sans.pop()
+            if self.pairs is not None:
+                if ply % 2 == 0:
+                    self.pairs.pop()
+                else:
+                    self.pairs[-1]['black'] = ''
+        if self.fens:
+            self.fens.pop(ply + 1, None)
+        if self.board.move_stack:
+            self.board.pop()
+        else:
+            self.board = self._replay(self.start_board(), 0, ply)
+        return decode_move(code)
+
+    def _add_san(self, san):
+        # Interned, so common moves like "e4" are shared by every game
+        ply = len(self.sans)
+        self.sans.append(sys.intern(san))
+        if self.pairs is not None:
+            self._add_pair(ply, self.sans[ply])
+
+    def _add_pair(self, ply, san):
+        if ply % 2 == 0:
+            self.pairs.append({'number': ply // 2 + 1, 'white': san, 'black': ''})
+        else:
+            self.pairs[-1]['black'] = san
+
+    def san_list(self):
+        if self.sans is None:
+            self.sans = []
+            board = self.start_board()
+            for code in self.codes:
+                move = decode_move(code)
+                self._add_san(board.san(move))
+                push_trimmed(board, move)
+        return self.sans
+
+    def san(self, ply):
+        return self.san_list()[ply]
+
+    def move_pairs(self):
+        """Numbered white/black SAN pairs, as the move list shows them."""
+        if self.pairs is None:
+            sans = self.san_list()
+            self.pairs = []
+            for ply, san in enumerate(sans):
+                self._add_pair(ply, san)
+        return self.pairs
+
+    def fen(self, ply):
+        """FEN after the first ply moves."""
+        return self.fen_range(ply, ply + 1)[0]
+
+    def fen_range(self, start, stop):
+        """FENs after each ply from start up to stop, replaying the moves at most once."""
+        fens = []
+        board = None
+        for ply in range(start, stop):
+            if ply == len(self.codes):
+                fens.append(self.board.fen())
+            elif ply == 0:
+                fens.append(self.start_fen)
+            elif self.fens and ply in self.fens:
+                fens.append(self.fens[ply])
+            else:
+                if board is None:
+                    # Resume from the nearest earlier FEN already worked out
+                    at = max((known for known in self.fens or () if known < ply), default=0)
+                    board = chess.Board(self.fens[at]) if at else self.start_board()
+                board = self._replay(board, at, ply)
+                at = ply
+                if self.fens is None:
+                    self.fens = {}
+                fen = self.fens[ply] = board.fen()
+                fens.append(fen)
+        return fens
+
+class MultiplayerGame:
+    __slots__ = ('game_id', 'moves', 'players', 'spectators', 'status')
+
+    def __init__(self, game_id):
+        self.game_id = game_id
+        self.moves = MoveList()
+        self.players = {'white': None, 'black': None}
+        self.spectators = []
+        self.status = 'waiting'  # waiting, active, finished
+    
+    @property
+    def board(self):
+        return self.moves.board
+        
+    def add_player(self, player_id, color=None):
+        if color and not self.players[color]:
+            self.players[color] = player_id
+            if self.players['white'] and self.players['black']:
+                self.status = 'active'
+            return color
+        elif not self.players['white']:
+            self.players['white'] = player_id
+            return 'white'
+        elif not self.players['black']:
+            self.players['black'] = player_id
+            self.status = 'active'
+            return 'black'
+        else:
+            self.spectators.append(player_id)
+            return 'spectator'
+    
+    def remove_player(self, player_id):
+        for color, pid in self.players.items():
+            if pid == player_id:
+                self.players[color] = None
+                self.status = 'waiting'
+                return
+        if player_id in self.spectators:
+            self.spectators.remove(player_id)
+    
+    def get_current_turn(self):
+        return 'white' if self.board.turn == chess.WHITE else 'black'
+    
+    def make_move(self, from_square, to_square, promotion=None):
+        """Play a move and return its delta, or None if it is illegal."""
+        try:
+            move_uci = from_square + to_square + (promotion.lower() if promotion else '')
+            move = chess.Move.from_uci(move_uci)
+            
+            if move in self.board.legal_moves:
+                # Taken before the push, so the game's SAN list is never rebuilt
+                san = self.board.san(move)
+                self.moves.push(move, san)
+                
+                if self.board.is_game_over():
+                    self.status = 'finished'
+                
+                return self.get_move_delta(len(self.moves) - 1, self.board.fen(), san)
+            return None
+        except:
+            return None
+    
+    def to_dict(self):
+        return {
+            'game_id': self.game_id,
+            'players': self.players,
+            'spectators': self.spectators,
+            'status': self.status,
+            'moves': [move.uci() for move in self.moves.moves()]
+        }
+    
+    @classmethod
+    def from_dict(cls, data):
+        game = cls(data['game_id'])
+        game.players = data['players']
+        game.spectators = data['spectators']
+        # Stored moves were legal when they were played; no checks per ply
+        for uci in data['moves']:
+            game.moves.push(chess.Move.from_uci(uci))
+        game.status = data['status']
+        return game
+    
+    def get_move_delta(self, index, fen=None, san=None):
+        # Sequence numbers are ply numbers, so a resync can start anywhere in history
+        move = self.moves.move(index)
+        return {
+            'seq': index + 1,
+            'san': san or self.moves.san(index),
+            'uci': move.uci(),
+            'from': chess.square_name(move.from_square),
+            'to': chess.square_name(move.to_square),
+            'fen': fen or self.moves.fen(index + 1)
+        }
+    
+    def get_move_deltas(self, since):
+        """Deltas for every move after ply since."""
+        fens = self.moves.fen_range(since + 1, len(self.moves) + 1)
+        return [self.get_move_delta(since + i, fen) for i, fen in enumerate(fens)]
+    
+    def get_status(self, legal_moves=True):
+        status = {
+            'game_id': self.game_id,
+            'seq': len(self.moves),
+            'current_turn': self.get_current_turn(),
+            'status': self.status,
+            'game_over': self.board.is_game_over(),
+            'result': self.board.result() if self.board.is_game_over() else None
+        }
+        if legal_moves:
+            status['legal_moves'] = get_legal_move_map(self.board)
+        return status
+    
+    def get_state(self):
+        return {
+            'game_id': self.game_id,
+            'seq': len(self.moves),
+            'fen': self.board.fen(),
+            'legal_moves': get_legal_move_map(self.board),
+            'players': self.players,
+            'current_turn': self.get_current_turn(),
+            'status': self.status,
+            'history': self.moves.move_pairs(),
+            'game_over': self.board.is_game_over(),
+            'result': self.board.result() if self.board.is_game_over() else None
+        }
+
+class MemoryGameStore:
+    """
+    Games held in this process. Each game is guarded by one of a fixed set
+    of striped locks, so concurrent events for one game are serialized.
+    Games recovered from the journal that no player sits down in again
+    are dropped once the journal's max_age has passed since the restart.
+    """
+
+    LOCK_STRIPES = 64
+
+    def __init__(self, journal=None):
+        self.games = {}
+        self.locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+        self.journal = journal
+        self.logged_moves = {}  # game id -> moves already in the journal
+        self.pending = {}  # recovered game id -> moves, until the game is rebuilt
+        self.unclaimed = set()  # recovered games no player has rejoined yet
+        self.unclaimed_until = None  # when those are dropped (monotonic)
+        if journal:
+            self.pending = journal.recover()
+            if self.pending:
+                self.unclaimed = set(self.pending)
+                self.unclaimed_until = time.monotonic() + journal.max_age
+                threading.Thread(target=self._restore, name='game-restore', daemon=True).start()
+
+    def _restore(self):
+        # Replaying moves is the slow part of recovery, so it happens after
+        # boot; a game someone asks for first is rebuilt on the spot
+        started = time.monotonic()
+        count = len(self.pending)
+        for game_id in list(self.pending):
+            with self.locks[hash(game_id) % self.LOCK_STRIPES]:
+                self._rebuild(game_id)
+        print(f"Restored {count} multiplayer games in {time.monotonic() - started:.2f}s")
+
+    def _rebuild(self, game_id):
+        # Caller holds the game's lock
+        moves = self.pending.pop(game_id, None)
+        if moves is None:
+            return
+        game = MultiplayerGame.from_dict({
+            'game_id': game_id,
+            'players': {'white': None, 'black': None},
+            'spectators': [],
+            'status': 'waiting',
+            'moves': moves
+        })
+        if game.board.is_game_over():
+            game.status = 'finished'
+        self.games[game_id] = game
+        self.logged_moves[game_id] = len(game.moves)
+
+    def _expire(self):
+        # Checked on access rather than by a timer thread
+        if self.unclaimed_until is None or time.monotonic() < self.unclaimed_until:
+            return
+        self.unclaimed_until = None
+        for game_id in list(self.unclaimed):
+            with self.locks[hash(game_id) % self.LOCK_STRIPES]:
+                if game_id in self.unclaimed:
+                    if self.pending.pop(game_id, None) is not None:
+                        self.journal.record(game_id, 'delete')
+                    self.delete(game_id)
+        print("Dropped recovered multiplayer games that no player rejoined")
+
+    @contextmanager
+    def locked(self, game_id):
+        self._expire()
+        with self.locks[hash(game_id) % self.LOCK_STRIPES]:
+            if game_id in self.pending:
+                self._rebuild(game_id)
+            yield self.games.get(game_id)
+
+    def add(self, game):
+        self.games[game.game_id] = game
+        if self.journal:
+            self.journal.record(game.game_id, 'create')
+            self.logged_moves[game.game_id] = 0
+            self.save(game)
+
+    def save(self, game):
+        if game.game_id in self.unclaimed and (game.players['white'] or game.players['black']):
+            self.unclaimed.discard(game.game_id)
+        # Games are live objects; only new moves go to the journal
+        if not self.journal:
+            return
+        logged = self.logged_moves.get(game.game_id, 0)
+        for ply in range(logged, len(game.moves)):
+            self.journal.record(game.game_id, 'move', game.moves.move(ply).uci())
+        self.logged_moves[game.game_id] = len(game.moves)
+
+    def delete(self, game_id):
+        self.games.pop(game_id, None)
+        self.unclaimed.discard(game_id)
+        if self.journal and self.logged_moves.pop(game_id, None) is not None:
+            self.journal.record(game_id, 'delete')
+
+    def all_games(self):
+        # Recovered games show up here once they have been rebuilt
+        self._expire()
+        return list(self.games.values())
+
+    def close(self):
+        if self.journal:
+            self.journal.close()
+
+
+class GameJournal:
+    """
+    Append-only log of multiplayer games in SQLite (WAL mode). Records are
+    queued and written in batches by a background thread, so moves never
+    wait on disk. Once the log reaches compact_rows records it is folded
+    into one snapshot row per game, which keeps recovery to a read of the
+    snapshots plus a short tail.
+    
+    Only creations, moves and deletions are logged: players' socket ids
+    die with the process, so recovered games come back with empty seats
+    for the players to rejoin.
+    """
+
+    def __init__(self, path, batch_size=GAME_JOURNAL_BATCH, compact_rows=GAME_JOURNAL_COMPACT_ROWS,
+                 max_age=GAME_JOURNAL_MAX_AGE):
+        self.path = path
+        self.batch_size = batch_size
+        self.compact_rows = compact_rows
+        self.max_age = max_age
+        self.queue = queue.Queue()
+        self.log_rows = 0
+        self.closed = False
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS snapshots '
+                        '(game_id TEXT PRIMARY KEY, moves TEXT NOT NULL, updated REAL NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS log (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                        'game_id TEXT NOT NULL, kind TEXT NOT NULL, data TEXT, created REAL NOT NULL)')
+        self.db.commit()
+        self.writer = threading.Thread(target=self._run, name='game-journal', daemon=True)
+        self.writer.start()
+
+    def record(self, game_id, kind, data=None):
+        self.queue.put((game_id, kind, data, time.time()))
+
+    def recover(self):
+        """Fold the log into the snapshots and return {game id: moves} for recent games."""
+        started = time.monotonic()
+        with self.db:
+            self._compact()
+            self.db.execute('DELETE FROM snapshots WHERE updated < ?', (time.time() - self.max_age,))
+        games = {game_id: moves.split() for game_id, moves in self.db.execute('SELECT game_id, moves FROM snapshots')}
+        if games:
+            print(f"Recovered {len(games)} multiplayer games from {self.path} in {time.monotonic() - started:.2f}s")
+        return games
+
+    def _run(self):
+        # Whatever queued up during the previous write goes out as one batch
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            rows = [item for item in batch if item is not None]
+            try:
+                with self.db:
+                    self.db.executemany('INSERT INTO log (game_id, kind, data, created) VALUES (?, ?, ?, ?)', rows)
+                    self.log_rows += len(rows)
+                    if self.log_rows >= self.compact_rows or (stop and self.log_rows):
+                        self._compact()
+            except sqlite3.Error as e:
+                print(f"Error writing game journal: {e}")
+            if stop:
+                return
+
+    def _compact(self):
+        # Runs inside the caller's transaction
+        rows = self.db.execute('SELECT id, game_id, kind, data, created FROM log ORDER BY id').fetchall()
+        if not rows:
+            return
+        games = {}
+        for _, game_id, kind, data, created in rows:
+            if game_id not in games:
+                snapshot = self.db.execute('SELECT moves FROM snapshots WHERE game_id = ?', (game_id,)).fetchone()
+                games[game_id] = [snapshot[0].split(), created] if snapshot else None
+            if kind == 'create':
+                games[game_id] = [[], created]
+            elif kind == 'delete':
+                games[game_id] = None
+            elif games[game_id] is not None:
+                games[game_id][0].append(data)
+                games[game_id][1] = created
+        for game_id, game in games.items():
+            if game is None:
+                self.db.execute('DELETE FROM snapshots WHERE game_id = ?', (game_id,))
+            else:
+                self.db.execute('INSERT OR REPLACE INTO snapshots (game_id, moves, updated) VALUES (?, ?, ?)',
+                                (game_id, ' '.join(game[0]), game[1]))
+        self.db.execute('DELETE FROM log WHERE id <= ?', (rows[-1][0],))
+        self.log_rows = 0
+
+    def close(self):
+        # Flushes everything still queued and compacts before closing
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.writer.join()
+        self.db.close()
+
+
+class FileGameStore:
+    """
+    One JSON file per game in a shared directory, locked with flock, so
+    several worker processes on one host can serve the same rooms. Parsed
+    games are reused while the file is unchanged.
+    """
+
+    ID_RE = re.compile(r'^[0-9a-f]{8}$')
+
+    def __init__(self, directory):
+        import fcntl  # Unix only
+        self.fcntl = fcntl
+        self.directory = directory
+        self.cache = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, game_id, suffix='.json'):
+        return os.path.join(self.directory, game_id + suffix)
+
+    @contextmanager
+    def locked(self, game_id):
+        if not self.ID_RE.match(str(game_id)):
+            yield None
+            return
+        with open(self.path(game_id, '.lock'), 'a') as lock_file:
+            self.fcntl.flock(lock_file, self.fcntl.LOCK_EX)
+            try:
+                yield self._load(game_id)
+            finally:
+                self.fcntl.flock(lock_file, self.fcntl.LOCK_UN)
+
+    def _load(self, game_id):
+        try:
+            stat = os.stat(self.path(game_id))
+        except FileNotFoundError:
+            self.cache.pop(game_id, None)
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self.cache.get(game_id)
+        if cached and cached[0] == signature:
+            return cached[1]
+        with open(self.path(game_id)) as game_file:
+            game = MultiplayerGame.from_dict(json.load(game_file))
+        self.cache[game_id] = (signature, game)
+        return game
+
+    def add(self, game):
+        with self.locked(game.game_id):
+            self.save(game)
+
+    def save(self, game):
+        path = self.path(game.game_id)
+        with open(path + '.tmp', 'w') as game_file:
+            json.dump(game.to_dict(), game_file)
+        os.replace(path + '.tmp', path)
+        stat = os.stat(path)
+        self.cache[game.game_id] = ((stat.st_mtime_ns, stat.st_size), game)
+
+    def delete(self, game_id):
+        self.cache.pop(game_id, None)
+        for suffix in ('.json', '.lock'):
+            try:
+                os.remove(self.path(game_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    def all_games(self):
+        games = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                with self.locked(name[:-5]) as game:
+                    if game:
+                        games.append(game)
+        return games
+
+    def close(self):
+        pass  # Every save is already on disk
+
+
+class RedisGameStore:
+    """
+    Games stored in Redis, for workers spread over several hosts. Each game
+    is a hash of its JSON and a version counter bumped on every save, so a
+    worker reuses its parsed copy while the version is unchanged instead of
+    replaying the game on every event. Held locks are renewed in the
+    background, so a slow handler cannot outlive its lock.
+    """
+
+    LOCK_TIMEOUT = 10  # seconds a lock survives its holder dying
+
+    def __init__(self, url):
+        import redis  # Optional dependency, only needed for this backend
+        self.client = redis.Redis.from_url(url)
+        self.lock_error = redis.exceptions.LockError
+        self.cache = {}  # game id -> (version, game)
+        self.held = set()
+        self.held_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.renewer = threading.Thread(target=self._renew, name='redis-lock-renewer', daemon=True)
+        self.renewer.start()
+
+    def key(self, game_id):
+        return f'chess:game:{game_id}'
+
+    @contextmanager
+    def locked(self, game_id):
+        # Not thread-local, so the renewer thread can extend it
+        lock = self.client.lock(f'chess:lock:{game_id}', timeout=self.LOCK_TIMEOUT, thread_local=False)
+        with lock:
+            with self.held_lock:
+                self.held.add(lock)
+            try:
+                yield self._load(game_id)
+            finally:
+                with self.held_lock:
+                    self.held.discard(lock)
+
+    def _renew(self):
+        # Reset every held lock's timeout well before it runs out
+        while not self.closed.wait(self.LOCK_TIMEOUT / 3):
+            with self.held_lock:
+                locks = list(self.held)
+            for lock in locks:
+                try:
+                    lock.reacquire()
+                except self.lock_error:
+                    pass  # Released meanwhile
+                except Exception as e:
+                    print(f"Error renewing game lock: {e}")
+
+    def _load(self, game_id):
+        version = self.client.hget(self.key(game_id), 'version')
+        if version is None:
+            self.cache.pop(game_id, None)
+            return None
+        cached = self.cache.get(game_id)
+        if cached and cached[0] == int(version):
+            return cached[1]
+        data, version = self.client.hmget(self.key(game_id), 'data', 'version')
+        if data is None:
+            self.cache.pop(game_id, None)
+            return None
+        game = MultiplayerGame.from_dict(json.loads(data))
+        self.cache[game_id] = (int(version), game)
+        return game
+
+    def add(self, game):
+        self.save(game)
+
+    def save(self, game):
+        pipeline = self.client.pipeline()
+        pipeline.hset(self.key(game.game_id), 'data', json.dumps(game.to_dict()))
+        pipeline.hincrby(self.key(game.game_id), 'version', 1)
+        version = pipeline.execute()[1]
+        self.cache[game.game_id] = (version, game)
+
+    def delete(self, game_id):
+        self.cache.pop(game_id, None)
+        self.client.delete(self.key(game_id))
+
+    def all_games(self):
+        games = []
+        seen = set()
+        for key in self.client.scan_iter(self.key('*')):
+            game_id = key.decode()[len(self.key('')):]
+            seen.add(game_id)
+            game = self._load(game_id)
+            if game:
+                games.append(game)
+        # Games deleted by other workers
+        for game_id in set(self.cache) - seen:
+            self.cache.pop(game_id, None)
+        return games
+
+    def close(self):
+        self.closed.set()
+        self.client.close()
+
+
+def create_game_store(spec):
+    # 'memory', 'file:<directory>' or a redis:// URL
+    if spec.startswith('file:'):
+        return FileGameStore(spec[len('file:'):])
+    if spec.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisGameStore(spec)
+    return MemoryGameStore(GameJournal(GAME_JOURNAL) if GAME_JOURNAL else None)
+
+game_store = None
+
+
+# Games each connected client has joined, for O(1) cleanup on disconnect
+player_games = {}
+player_games_lock = threading.Lock()
+
+def track_player(sid, game_id):
+    with player_games_lock:
+        player_games.setdefault(sid, set()).add(game_id)
+
+def untrack_player(sid, game_id):
+    with player_games_lock:
+        games = player_games.get(sid)
+        if games:
+            games.discard(game_id)
+
+# Spectators sit in their own room and get batched updates instead of every move
+spectator_seq = {}  # game id -> last ply sent to spectators
+spectator_flushes = set()
+spectator_lock = threading.Lock()
+
+def spectator_room(game_id):
+    return f'{game_id}:watch'
+
+def game_rooms(game_id):
+    return [game_id, spectator_room(game_id)]
+
+def claim_spectator_flush(game_id, seen):
+    """Note that spectators have seen ``seen`` plies; True if no flush is queued yet."""
+    with spectator_lock:
+        spectator_seq.setdefault(game_id, seen)
+        if game_id in spectator_flushes:
+            return False
+        spectator_flushes.add(game_id)
+        return True
+
+def forget_spectators(game_id):
+    with spectator_lock:
+        spectator_seq.pop(game_id, None)
+
+def spectator_update(game_id):
+    """Collect the plies spectators have not seen yet, or None if the game is gone."""
+    with spectator_lock:
+        spectator_flushes.discard(game_id)
+        since = spectator_seq.get(game_id, 0)
+    with game_store.locked(game_id) as game:
+        update = None
+        if game is not None:
+            # Same shape as a resync, minus the legal-move map spectators never use
+            update = game.get_status(legal_moves=False)
+            update['moves'] = game.get_move_deltas(min(since, len(game.moves)))
+            update['sound'] = 'move'
+    with spectator_lock:
+        if update is None:
+            spectator_seq.pop(game_id, None)
+        else:
+            spectator_seq[game_id] = update['seq']
+    return update
+
+def drop_player(sid):
+    """
+    Take a disconnected client out of every game it joined and delete the
+    games nobody is left in. Returns (game id, state) for each game still
+    waiting for players, for the caller to tell the room.
+    """
+    with player_games_lock:
+        game_ids = player_games.pop(sid, set())
+    waiting = []
+    for game_id in game_ids:
+        with game_store.locked(game_id) as game:
+            if game is None:
+                continue
+            game.remove_player(sid)
+            if not game.players['white'] and not game.players['black'] and not game.spectators:
+                game_store.delete(game_id)
+                forget_spectators(game_id)
+                print(f'Game {game_id} deleted - no players')
+                continue
+            game_store.save(game)
+            if game.status == 'waiting':
+                waiting.append((game_id, game.get_state()))
+    return waiting
+
+class GameSession:
+    # Rough per-session footprint used for the memory ceiling
+    BASE_BYTES = 8 * 1024
+    PLY_BYTES = 128
+
+    __slots__ = ('session_id', 'moves', 'config', 'lock', 'last_access', 'size')
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.moves = MoveList()
+        self.config = dict(config)
+        self.lock = threading.RLock()
+        self.last_access = time.monotonic()
+        self.size = self.estimate_size()
+
+    @property
+    def board(self):
+        return self.moves.board
+
+    def estimate_size(self):
+        return self.BASE_BYTES + self.PLY_BYTES * len(self.moves)
+
+    def game_board(self):
+        """A copy of the position with the whole game on its stack, as the engine wants it."""
+        return self.moves.game_board()
+
+    def is_computer_turn(self):
+        return (self.board.turn == chess.WHITE and self.config['player_color'] == 'black') or \
+               (self.board.turn == chess.BLACK and self.config['player_color'] == 'white')
+
+    def push_move(self, move):
+        self.moves.push(move)
+
+    def pop_move(self):
+        return self.moves.pop()
+
+    def reset(self, board=None):
+        self.moves = MoveList(board)
+
+    def get_move_history(self):
+        return self.moves.move_pairs()
+
+
+class SessionStore:
+    """
+    Session-keyed single-player games. Sessions are kept in LRU order and
+    evicted when idle longer than the TTL or when the estimated memory of
+    all sessions exceeds the ceiling.
+    """
+
+    def __init__(self, memory_limit=SESSION_MEMORY_LIMIT_MB * 1024 * 1024, idle_ttl=SESSION_IDLE_TTL):
+        self.memory_limit = memory_limit
+        self.idle_ttl = idle_ttl
+        self.sessions = OrderedDict()
+        self.total_size = 0
+        self.lock = threading.Lock()
+
+    def get(self, session_id):
+        with self.lock:
+            now = time.monotonic()
+            self._expire(now)
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = GameSession(session_id)
+                self.sessions[session_id] = session
+                self.total_size += session.size
+                self._shrink(session_id)
+            else:
+                self.sessions.move_to_end(session_id)
+            session.last_access = now
+            return session
+
+    def peek(self, session_id):
+        # No LRU bump and no new session for ids that are not in use
+        with self.lock:
+            return self.sessions.get(session_id)
+
+    @contextmanager
+    def locked(self, session_id):
+        session = self.get(session_id)
+        with session.lock:
+            try:
+                yield session
+            finally:
+                self._account(session)
+
+    def _account(self, session):
+        size = session.estimate_size()
+        with self.lock:
+            if self.sessions.get(session.session_id) is not session:
+                return  # Evicted while in use
+            self.total_size += size - session.size
+            session.size = size
+            self._shrink(session.session_id)
+
+    def _expire(self, now):
+        # Oldest sessions sit at the front, so stop at the first live one
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if now - session.last_access < self.idle_ttl:
+                break
+            self._evict(session_id)
+
+    def _shrink(self, keep_id):
+        while self.total_size > self.memory_limit and len(self.sessions) > 1:
+            session_id = next(iter(self.sessions))
+            if session_id == keep_id:
+                self.sessions.move_to_end(session_id)
+                session_id = next(iter(self.sessions))
+            self._evict(session_id)
+
+    def _evict(self, session_id):
+        session = self.sessions.pop(session_id)
+        self.total_size -= session.size
+
+    def stats(self):
+        with self.lock:
+            return {
+                'sessions': len(self.sessions),
+                'estimated_bytes': self.total_size,
+                'memory_limit': self.memory_limit
+            }
+
+session_store = SessionStore()
+
+def engine_profile(session_id):
+    # Read without the session lock, which callers may already hold; a
+    # session changing its settings mid-read only affects this one search
+    session = session_store.peek(session_id) if session_id is not None else None
+    settings = session.config if session else config
+    return {'Threads': settings['threads'], 'Hash': settings['memory']}
+
+class EngineBusy(Exception):
+    """Raised when no engine worker can be checked out in time."""
+
+    status = 503
+
+
+class EngineOptionError(EngineBusy):
+    """Raised when the engine rejects a session's settings; the engine itself is fine."""
+
+    status = 400
+
+
+def engine_option_limits(options):
+    # (min, max) of the engine options sessions choose
+    return {name: (options[name].min, options[name].max) for name in ('Threads', 'Hash') if name in options}
+
+
+def engine_busy(reason, message):
+    # Requests turned away by admission control, counted by reason
+    ENGINE_REJECTED.inc(1, reason)
+    return EngineBusy(message)
+
+
+class EngineTicket:
+    """One request's place in the engine queue."""
+
+    __slots__ = ('session_id', 'priority', 'preemptible', 'options', 'worker', 'waiter', 'spare')
+
+    def __init__(self, session_id, priority, preemptible=False, options=None):
+        self.session_id = session_id
+        self.priority = priority
+        self.preemptible = preemptible  # long searches that can stop and queue again
+        self.options = options or {}  # engine profile the search needs
+        self.worker = None
+        self.waiter = None  # future the coroutine pool resolves
+        self.spare = False  # background search past its session's limit, on an otherwise idle engine
+
+
+class EngineScheduler:
+    """
+    Decides which queued engine request runs next. Priority classes share
+    the engines by weight (stride scheduling) and sessions within a class
+    take turns. Each session is held to ENGINE_SESSION_CONCURRENCY searches
+    at a time and a budget of engine CPU-seconds that refills over
+    ENGINE_QUOTA_WINDOW. Game reviews and batches queue more background
+    searches than that; the extra ones only run on engines no other
+    request can use. Holds no lock; callers hold their pool's.
+    """
+
+    def __init__(self, size, queue_limit):
+        self.queue_limit = queue_limit
+        self.session_limit = max(1, ENGINE_SESSION_CONCURRENCY)
+        self.background_limit = max(1, size - ENGINE_RESERVED_WORKERS)
+        self.queues = [OrderedDict() for _ in PRIORITY_WEIGHTS]  # session id -> deque of tickets
+        self.queued_by_class = [0] * len(PRIORITY_WEIGHTS)
+        self.passes = [0.0] * len(PRIORITY_WEIGHTS)
+        self.clock = 0.0  # pass of the class served last
+        self.running = {}  # session id -> searches in progress
+        self.spare = {}  # session id -> of those, searches past the session limit
+        self.running_background = 0
+        self.usage = {}  # session id -> (CPU-seconds charged, when)
+        self.charges = 0
+
+    @property
+    def queued(self):
+        return sum(self.queued_by_class)
+
+    def used(self, session_id, now):
+        # Charged CPU-seconds drain at the rate the quota refills
+        charged, since = self.usage.get(session_id, (0.0, now))
+        return max(0.0, charged - (now - since) * ENGINE_SESSION_CPU_QUOTA / ENGINE_QUOTA_WINDOW)
+
+    def under_limit(self, session_id):
+        # Spare searches do not count against the session's limit
+        if session_id is None:
+            return True
+        return self.running.get(session_id, 0) - self.spare.get(session_id, 0) < self.session_limit
+
+    def admit(self, session_id, priority, now):
+        """The class a new request runs in; raises EngineBusy rather than queue it."""
+        if self.queued >= self.queue_limit:
+            raise engine_busy('queue', 'Engine queue is full')
+        if session_id is not None:
+            over = self.used(session_id, now) - ENGINE_SESSION_CPU_QUOTA
+            if over >= 0:
+                if priority != PRIORITY_INTERACTIVE:
+                    retry = math.ceil(over * ENGINE_QUOTA_WINDOW / ENGINE_SESSION_CPU_QUOTA) or 1
+                    raise engine_busy('quota', f'Engine quota used up; try again in {retry}s')
+                # The player's own game goes on, behind everyone else's work
+                priority = PRIORITY_BACKGROUND
+            # Background work may queue a search for every engine it could use
+            background = priority == PRIORITY_BACKGROUND
+            queued = sum(len(by_session.get(session_id, ())) for class_, by_session in enumerate(self.queues)
+                         if (class_ == PRIORITY_BACKGROUND) == background)
+            if queued >= (self.background_limit if background else self.session_limit):
+                raise engine_busy('session', 'Too many engine requests from this session')
+        if priority == PRIORITY_BACKGROUND and self.queued_by_class[priority] >= self.queue_limit // 2:
+            # Leave room in the queue for interactive requests
+            raise engine_busy('queue', 'Engine queue is full')
+        return priority
+
+    def enqueue(self, ticket):
+        by_session = self.queues[ticket.priority]
+        if not by_session:
+            # A class that sat idle resumes at the current pass instead of catching up
+            self.passes[ticket.priority] = max(self.passes[ticket.priority], self.clock)
+        by_session.setdefault(ticket.session_id, deque()).append(ticket)
+        self.queued_by_class[ticket.priority] += 1
+
+    def remove(self, ticket):
+        tickets = self.queues[ticket.priority].get(ticket.session_id)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del self.queues[ticket.priority][ticket.session_id]
+            self.queued_by_class[ticket.priority] -= 1
+
+    def drain(self):
+        tickets = [ticket for by_session in self.queues for session in by_session.values() for ticket in session]
+        for by_session in self.queues:
+            by_session.clear()
+        self.queued_by_class = [0] * len(PRIORITY_WEIGHTS)
+        return tickets
+
+    def next_ticket(self):
+        """Take the next ticket to run off the queue, or None if none may run now."""
+        best = None
+        spare = None
+        for priority, by_session in enumerate(self.queues):
+            if best is not None and self.passes[priority] >= self.passes[best[0]]:
+                continue
+            if priority == PRIORITY_BACKGROUND and self.running_background >= self.background_limit:
+                continue
+            for session_id in by_session:
+                if self.under_limit(session_id):
+                    best = (priority, session_id)
+                    break
+                if priority == PRIORITY_BACKGROUND and spare is None:
+                    spare = (priority, session_id)
+        if best is None and spare is None:
+            return None
+        # A session at its limit only gets an engine no other request can use
+        priority, session_id = best or spare
+        by_session = self.queues[priority]
+        tickets = by_session[session_id]
+        ticket = tickets.popleft()
+        if tickets:
+            by_session.move_to_end(session_id)
+        else:
+            del by_session[session_id]
+        self.queued_by_class[priority] -= 1
+        self.passes[priority] += 1 / PRIORITY_WEIGHTS[priority]
+        self.clock = self.passes[priority]
+        ticket.spare = best is None
+        return ticket
+
+    def start(self, ticket):
+        self.running[ticket.session_id] = self.running.get(ticket.session_id, 0) + 1
+        if ticket.spare:
+            self.spare[ticket.session_id] = self.spare.get(ticket.session_id, 0) + 1
+        if ticket.priority == PRIORITY_BACKGROUND:
+            self.running_background += 1
+
+    def finish(self, ticket, cpu_seconds, now):
+        running = self.running.get(ticket.session_id, 0) - 1
+        if running > 0:
+            self.running[ticket.session_id] = running
+        else:
+            self.running.pop(ticket.session_id, None)
+        if ticket.spare:
+            spare = self.spare.get(ticket.session_id, 0) - 1
+            if spare > 0:
+                self.spare[ticket.session_id] = spare
+            else:
+                self.spare.pop(ticket.session_id, None)
+        if ticket.priority == PRIORITY_BACKGROUND:
+            self.running_background -= 1
+        self.charge(ticket.session_id, cpu_seconds, now)
+
+    def charge(self, session_id, cpu_seconds, now):
+        """Count engine CPU-seconds against a session's quota."""
+        if session_id is None:
+            return
+        self.usage[session_id] = (self.used(session_id, now) + cpu_seconds, now)
+        self.charges += 1
+        if self.charges % 256 == 0:
+            self.usage = {session_id: entry for session_id, entry in self.usage.items()
+                          if self.used(session_id, now) > 0}
+
+    def victim(self, ticket, workers):
+        """A busy worker running preemptible work less urgent than ticket, if any."""
+        for worker in workers:
+            job = worker.ticket
+            if job and job.preemptible and job.priority > ticket.priority and not worker.preempted:
+                return worker
+        return None
+
+
+def profile_matches(worker, options):
+    return all(worker.options.get(name) == value for name, value in options.items())
+
+
+class EngineAffinity:
+    """
+    Remembers which engine each session searched on last and picks the idle
+    engine a request should get. A session stays on its engine while that
+    is idle, so consecutive moves of a game find their positions in its
+    hash table. When its engine is busy it moves to the idle engine fewest
+    sessions are bound to, which spreads sessions out under load.
+    Reconfiguring an engine clears its hash table, so an engine other
+    sessions are bound to is only switched to a different (Threads, Hash)
+    profile when every idle engine would have to be. Holds no lock;
+    callers hold their pool's.
+    """
+
+    def __init__(self, limit=ENGINE_AFFINITY_SESSIONS):
+        self.limit = limit
+        self.bound = OrderedDict()  # session id -> worker, least recently used first
+        self.load = {}  # worker -> sessions bound to it
+
+    def choose(self, ticket, workers):
+        bound = self.bound.get(ticket.session_id)
+        def cost(worker):
+            matches = profile_matches(worker, ticket.options)
+            others = self.load.get(worker, 0) - (worker is bound)
+            return (not matches and others > 0,
+                    worker is not bound,
+                    others,
+                    not matches)
+        return min(workers, key=cost)
+
+    def bind(self, ticket, worker):
+        if ticket.session_id is None:
+            return
+        previous = self.bound.get(ticket.session_id)
+        ENGINE_AFFINITY.inc(1, 'new' if previous is None else 'kept' if previous is worker else 'moved')
+        if previous is not None and previous is not worker and previous.ticket is not None \
+                and previous.ticket.session_id == ticket.session_id:
+            # A second search alongside one still running; the session's
+            # history stays on the engine it has been using
+            self.bound.move_to_end(ticket.session_id)
+            return
+        self.bound.pop(ticket.session_id, None)
+        if previous is not None:
+            self._unload(previous)
+        self.bound[ticket.session_id] = worker
+        self.load[worker] = self.load.get(worker, 0) + 1
+        while len(self.bound) > self.limit:
+            self._unload(self.bound.popitem(last=False)[1])
+
+    def forget(self, worker):
+        # A crashed engine's hash table is gone; its sessions start afresh
+        for session_id in [session_id for session_id, bound in self.bound.items() if bound is worker]:
+            del self.bound[session_id]
+        self.load.pop(worker, None)
+
+    def _unload(self, worker):
+        load = self.load.get(worker, 0) - 1
+        if load > 0:
+            self.load[worker] = load
+        else:
+            self.load.pop(worker, None)
+
+
+class EnginePoolBase:
+    """
+    Bookkeeping shared by app.EnginePool (threads) and
+    app_async.AsyncEnginePool (coroutines): which workers are idle, busy or
+    parked pondering for a session, who gets the next free one, and how
+    long each spent in each state. Nothing here blocks or talks to an
+    engine; the threaded pool calls these methods holding its lock, the
+    asyncio pool from the event loop. Subclasses start, check and stop
+    the engines and make callers wait.
+    """
+
+    def __init__(self, path, size, options, queue_limit=ENGINE_QUEUE_LIMIT, queue_timeout=ENGINE_QUEUE_TIMEOUT,
+                 warmup=(), profile=None):
+        self.path = path
+        self.size = max(1, size)
+        self.options = dict(options)  # what workers start with
+        self.profile = profile or (lambda session_id: {})  # session id -> options its searches need
+        self.queue_limit = queue_limit
+        self.queue_timeout = queue_timeout
+        self.warmup = list(warmup)
+        self.idle = []
+        self.busy = set()
+        self.pondering = {}  # session id -> worker parked pondering for it, oldest first
+        self.scheduler = EngineScheduler(self.size, queue_limit)
+        self.affinity = EngineAffinity()
+        self.limits = {}  # engine option name -> (min, max), once a worker is up
+        self.missing = 0
+        self.restarts = 0
+        self.retrying = False
+        self.busy_seconds = 0.0
+        self.idle_seconds = 0.0
+        self.ponder_seconds = 0.0
+        self.closed = False
+        self.next_id = 0
+
+    @property
+    def waiting(self):
+        return self.scheduler.queued
+
+    def job_slots(self):
+        # Searches a game review or batch keeps queued: one per engine background work may use
+        return self.scheduler.background_limit
+
+    def check_quota(self, session_id, searches, limit):
+        """
+        Turn a job of searches at limit away before it starts if the
+        session's CPU quota cannot cover it, rather than fail it partway.
+        Only time limits can be costed up front.
+        """
+        if session_id is None or limit.time is None or not searches:
+            return
+        threads = dict(self.options, **self.profile(session_id)).get('Threads', 1)
+        needed = searches * limit.time * threads
+        left = ENGINE_SESSION_CPU_QUOTA - self.scheduler.used(session_id, time.monotonic())
+        if needed > left:
+            raise engine_busy('quota', f'This needs {needed:.0f} engine CPU-seconds and the session has '
+                                       f'{max(0.0, left):.0f} left; try fewer positions or a shorter time')
+
+    def _status(self):
+        if self.closed:
+            return 'stopped'
+        if self.idle or self.busy or self.pondering:
+            return 'ready'
+        if self.retrying:
+            return 'unavailable'
+        return 'restarting' if self.restarts else 'starting'
+
+    def _ticket(self, session_id, priority, preemptible, options, now):
+        # Raises EngineBusy if admission control turns the request away
+        return EngineTicket(session_id, self.scheduler.admit(session_id, priority, now), preemptible, options)
+
+    def _unparked(self, worker):
+        # Off the pondering list: the ponder search counts against its session's quota
+        now = time.monotonic()
+        span = now - worker.since
+        self.ponder_seconds += span
+        worker.since = now
+        self.scheduler.charge(worker.pondering[0], span * worker.options.get('Threads', 1), now)
+
+    def _handed(self, ticket):
+        """Called when a queued or new ticket has been given its worker."""
+
+    def _claim(self, ticket):
+        # The computer's reply gets the worker pondering for its session
+        if ticket.priority != PRIORITY_INTERACTIVE or ticket.session_id is None:
+            return None
+        worker = self.pondering.pop(ticket.session_id, None)
+        if worker is not None:
+            self._unparked(worker)
+        return worker
+
+    def _take(self, worker):
+        # Off the idle or pondering list; False if it is on neither
+        if worker in self.idle:
+            self.idle.remove(worker)
+            return True
+        if worker.pondering and self.pondering.get(worker.pondering[0]) is worker:
+            del self.pondering[worker.pondering[0]]
+            self._unparked(worker)
+            return True
+        return False
+
+    def _assign(self, ticket, worker):
+        # The worker is already off the idle and pondering lists
+        now = time.monotonic()
+        self.idle_seconds += now - worker.since
+        worker.since = now
+        worker.ticket = ticket
+        worker.preempted = False
+        self.busy.add(worker)
+        ticket.worker = worker
+        self.scheduler.start(ticket)
+        self.affinity.bind(ticket, worker)
+        if not profile_matches(worker, ticket.options):
+            ENGINE_RECONFIGURED.inc()
+        self._handed(ticket)
+
+    def _dispatch(self):
+        # Idle workers first; parked ponder searches give way once none are left
+        while self.scheduler.queued and (self.idle or self.pondering):
+            ticket = self.scheduler.next_ticket()
+            if ticket is None:
+                break
+            worker = self._claim(ticket)
+            if worker is None and self.idle:
+                worker = self.affinity.choose(ticket, self.idle)
+                self.idle.remove(worker)
+            elif worker is None:
+                worker = self.pondering.pop(next(iter(self.pondering)))
+                self._unparked(worker)
+            self._assign(ticket, worker)
+
+    def _preempt(self, ticket):
+        # A long background search hands its engine to a more urgent request
+        worker = self.scheduler.victim(ticket, self.busy)
+        if worker is not None:
+            worker.preempted = True
+            ENGINE_PREEMPTED.inc()
+
+    def _hold(self, worker):
+        # Mark an idle or parked worker busy while it is health-checked
+        if self.closed or not self._take(worker):
+            return False
+        now = time.monotonic()
+        self.idle_seconds += now - worker.since
+        worker.since = now
+        worker.pondering = None
+        self.busy.add(worker)
+        return True
+
+    def _release(self, worker):
+        # End the worker's busy span and charge it to the session it searched for
+        if worker in self.busy:
+            now = time.monotonic()
+            self.busy_seconds += now - worker.since
+            if worker.ticket:
+                self.scheduler.finish(worker.ticket, (now - worker.since) * worker.options.get('Threads', 1), now)
+            worker.since = now
+            self.busy.discard(worker)
+        worker.ticket = None
+
+    def _return(self, worker, pondering=None, searched=True):
+        """
+        Put a healthy worker back in the pool; it only ponders on spare
+        capacity. Returns the worker whose ponder search for the same
+        session it replaced, held for the caller to stop, or None.
+        """
+        self._release(worker)
+        if self.closed:
+            return None
+        if searched:
+            worker.searches += 1
+        worker.pondering = pondering if not self.waiting else None
+        replaced = None
+        if worker.pondering:
+            replaced = self._park(worker)
+        else:
+            self.idle.append(worker)
+        self._dispatch()
+        return replaced
+
+    def _park(self, worker):
+        # One ponder search per session: the one it replaces is held to be stopped
+        session_id = worker.pondering[0]
+        previous = self.pondering.get(session_id)
+        if previous is not None and not self._hold(previous):
+            previous = None
+        self.pondering[session_id] = worker
+        return previous
+
+    def _shutdown(self):
+        # Every worker, for the caller to quit
+        self.closed = True
+        workers = list(self.busy) + list(self.pondering.values()) + self.idle
+        for worker in self.pondering.values():
+            self._unparked(worker)
+        self.idle = []
+        self.busy = set()
+        self.pondering = {}
+        return workers
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'idle': len(self.idle),
+            'busy': len(self.busy),
+            'waiting': self.waiting,
+            'pondering': len(self.pondering),
+            'missing': self.missing,
+            'restarts': self.restarts
+        }
+
+    def utilisation(self):
+        """Worker-seconds spent busy, idle and pondering, including the spans still in progress."""
+        now = time.monotonic()
+        return (self.busy_seconds + sum(now - worker.since for worker in self.busy),
+                self.idle_seconds + sum(now - worker.since for worker in self.idle),
+                self.ponder_seconds + sum(now - worker.since for worker in self.pondering.values()))
+
+def score_to_dict(score):
+    # Scores are stored from the side to move's point of view
+    if score is None:
+        return None
+    if score.is_mate():
+        return {'mate': score.mate()}
+    return {'cp': score.score()}
+
+
+class PositionCache:
+    """
+    Search results keyed by the Zobrist hash of the position. An entry
+    satisfies any request it searched at least as deeply or as long as.
+    Entries evicted from memory spill to an optional SQLite file, which is
+    also where the whole cache is written on shutdown.
+    """
+
+    def __init__(self, max_entries=EVAL_CACHE_SIZE, path=EVAL_CACHE_FILE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if path:
+            try:
+                self.db = sqlite3.connect(path, check_same_thread=False)
+                self.db.execute('CREATE TABLE IF NOT EXISTS evals (key INTEGER PRIMARY KEY, depth INTEGER, time REAL, data TEXT)')
+                self.db.commit()
+            except sqlite3.Error as e:
+                print(f"Evaluation cache file unavailable: {e}")
+                self.db = None
+
+    @staticmethod
+    def key(board):
+        # SQLite integers are signed 64-bit
+        return chess.polyglot.zobrist_hash(board) - (1 << 63)
+
+    @staticmethod
+    def satisfies(entry, limit):
+        if limit.depth is not None and entry['depth'] >= limit.depth:
+            return True
+        if limit.nodes is not None and entry['nodes'] >= limit.nodes:
+            return True
+        return limit.time is not None and entry['time'] >= limit.time
+
+    def get(self, board, limit):
+        with self.lock:
+            entry = self._find(board, limit)
+            if entry is not None:
+                self.hits += 1
+                CACHE_LOOKUPS.inc(1, 'eval', 'hit')
+                return entry
+            self.misses += 1
+            CACHE_LOOKUPS.inc(1, 'eval', 'miss')
+            return None
+
+    def covers(self, board, limit):
+        """True if get() would answer board at limit; not counted as a lookup."""
+        with self.lock:
+            return self._find(board, limit) is not None
+
+    def _find(self, board, limit):
+        # Caller holds the lock
+        key = self.key(board)
+        entry = self.entries.get(key)
+        if entry is None and self.db:
+            entry = self._load(key)
+        if entry is not None and self.satisfies(entry, limit) and \
+                chess.Move.from_uci(entry['move']) in board.legal_moves:
+            self.entries.move_to_end(key)
+            return entry
+        return None
+
+    def put(self, board, entry):
+        key = self.key(board)
+        with self.lock:
+            current = self.entries.get(key)
+            if current and current['depth'] > entry['depth']:
+                return
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self._trim()
+
+    def _load(self, key):
+        row = self.db.execute('SELECT data FROM evals WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        entry = json.loads(row[0])
+        self.entries[key] = entry
+        self._trim()
+        return entry
+
+    def _trim(self):
+        evicted = []
+        while len(self.entries) > self.max_entries:
+            evicted.append(self.entries.popitem(last=False))
+        if evicted and self.db:
+            self._store(evicted)
+            self.db.commit()
+
+    def _store(self, items):
+        self.db.executemany(
+            'INSERT OR REPLACE INTO evals (key, depth, time, data) VALUES (?, ?, ?, ?)',
+            [(key, entry['depth'], entry['time'], json.dumps(entry)) for key, entry in items]
+        )
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+    def close(self):
+        with self.lock:
+            if self.db:
+                self._store(self.entries.items())
+                self.db.commit()
+                self.db.close()
+                self.db = None
+
+eval_cache = None
+
+def info_to_dict(board, info):
+    pv = info.get('pv', [])
+    score = info.get('score')
+    try:
+        san = board.variation_san(pv[:ANALYSIS_SAN_PLIES])
+    except ValueError:
+        san = ''
+    return {
+        'multipv': info.get('multipv', 1),
+        'depth': info.get('depth'),
+        'seldepth': info.get('seldepth'),
+        'score': score_to_dict(score.relative) if score else None,
+        'nodes': info.get('nodes'),
+        'nps': info.get('nps'),
+        'time': info.get('time'),
+        'pv': [move.uci() for move in pv],
+        'san': san
+    }
+
+
+
+def analysis_entry(move, info, elapsed):
+    # Evaluation cache entry for a finished or stopped engine.analysis()
+    score = info.get('score')
+    return {
+        'move': move.uci(),
+        'score': score_to_dict(score.relative) if score else None,
+        'pv': [pv_move.uci() for pv_move in info.get('pv', [move])],
+        'depth': info.get('depth', 0),
+        'nodes': info.get('nodes', 0),
+        'time': elapsed
+    }
+
+class AnalysisJobBase:
+    """
+    One client's live analysis. Info lines are coalesced per multipv slot
+    and flushed at most once per ANALYSIS_UPDATE_INTERVAL, so a fast engine
+    cannot flood the socket. The search runs at background priority; when
+    a more urgent request preempts it, it queues again for the rest of its
+    time. app.AnalysisJob and app_async.AsyncAnalysisJob run the search
+    and send the lines.
+    """
+
+    def __init__(self, sid, board, limit, multipv, session_id=None):
+        self.sid = sid
+        self.session_id = session_id or sid
+        self.board = board
+        self.limit = limit
+        self.multipv = multipv
+        self.analysis_id = uuid.uuid4().hex[:8]
+        self.stopped = False
+
+    def remaining_limit(self, elapsed):
+        if self.limit.time is None:
+            return self.limit
+        remaining = max(ANALYSIS_UPDATE_INTERVAL, self.limit.time - elapsed)
+        return chess.engine.Limit(time=remaining, depth=self.limit.depth)
+
+    @staticmethod
+    def collect(lines, info):
+        # Keep the latest complete line of each multipv slot; True if one changed
+        if 'pv' in info and 'score' in info:
+            lines[info.get('multipv', 1)] = info
+            return True
+        return False
+
+    def payload(self, lines, **extra):
+        payload = {
+            'analysis_id': self.analysis_id,
+            'fen': self.board.fen(),
+            'lines': [info_to_dict(self.board, lines[slot]) for slot in sorted(lines)]
+        }
+        payload.update(extra)
+        return payload
+
+    def finish(self, lines, best, elapsed):
+        """Count the finished search and cache its top line."""
+        top = lines.get(1)
+        if top:
+            record_search('analysis', top)
+        if top and best.move:
+            eval_cache.put(self.board, analysis_entry(best.move, top, elapsed))
+
+
+class PreAnalysisJobBase:
+    """
+    Low-priority search of a suggest-mode position, started as soon as the
+    position is known. It only runs on an idle engine, hands the engine
+    back as soon as a request is waiting for one, and leaves its result in
+    the evaluation cache where /api/suggest finds it. app.PreAnalysisJob
+    and app_async.AsyncPreAnalysisJob run the search.
+    """
+
+    def __init__(self, session_id, board, limit, previous=None):
+        self.session_id = session_id
+        self.previous = previous  # superseded job, whose engine this one takes over
+        self.board = board
+        self.key = chess.polyglot.zobrist_hash(board)
+        self.limit = limit
+        self.started = time.monotonic()
+
+    def needed(self):
+        # Nothing to search if the cache already answers the suggestion
+        return eval_cache.get(self.board, self.limit) is None
+
+    def covers(self, board, think_time):
+        """True if this job's result will answer a suggestion for board."""
+        return self.key == chess.polyglot.zobrist_hash(board) and self.limit.time >= think_time
+
+    def store(self, best, info, finished):
+        if best.move and 'score' in info:
+            record_search('analysis', info)
+            # A search that ran its course satisfies the full budget
+            elapsed = self.limit.time if finished else time.monotonic() - self.started
+            eval_cache.put(self.board, analysis_entry(best.move, info, elapsed))
+
+def pre_analysis_wanted(session, pool):
+    # Think Ahead is on, an engine is available and the game is still going
+    return bool(session.config.get('preanalyze') and session.config['mode'] == 'suggest' and pool
+                and not session.board.is_game_over())
+
+
+class PgnIndexer:
+    """
+    Incrementally scans raw PGN bytes and records where each game starts
+    together with its header tags, without parsing any movetext.
+    """
+
+    HEADER_RE = re.compile(rb'^\[(\w+)\s+"((?:[^"\\]|\\.)*)"\]')
+    RESULTS = (b'1-0', b'0-1', b'1/2-1/2', b'*')
+
+    def __init__(self, on_game):
+        self.on_game = on_game
+        self.offset = 0
+        self.pending = b''
+        self.current = None
+        self.in_movetext = False
+        self.in_comment = False
+
+    def feed(self, chunk):
+        lines = (self.pending + chunk).split(b'\n')
+        self.pending = lines.pop()
+        for line in lines:
+            self._line(line + b'\n')
+
+    def close(self):
+        if self.pending:
+            self._line(self.pending)
+            self.pending = b''
+        self._finish()
+
+    def _line(self, line):
+        start = self.offset
+        self.offset += len(line)
+        stripped = line.strip()
+        # Escape lines (% in the first column) and rest-of-line comments are skipped like blank lines
+        if not self.in_comment and (line.startswith(b'%') or stripped.startswith(b';')):
+            return
+        if not stripped:
+            return
+        if stripped.startswith(b'[') and not self.in_comment:
+            if self.current is None or self.in_movetext:
+                self._finish()
+                self.current = {'offset': start, 'headers': {}}
+                self.in_movetext = False
+            match = self.HEADER_RE.match(stripped)
+            if match:
+                value = match.group(2).replace(b'\\"', b'"').replace(b'\\\\', b'\\')
+                self.current['headers'][match.group(1).decode('utf-8', 'replace')] = value.decode('utf-8', 'replace')
+            return
+        if self.current is None:
+            self.current = {'offset': start, 'headers': {}}
+        self.in_movetext = True
+        movetext = self._movetext(stripped)
+        # A termination marker ends the game even when the next one has no tags
+        if not self.in_comment and movetext and movetext.split()[-1] in self.RESULTS:
+            self._finish()
+
+    def _movetext(self, line):
+        """
+        The line without its comments. Brace comments may span lines and
+        contain text that looks like a tag; a ; comment runs to the end of
+        the line.
+        """
+        kept = []
+        for token in re.findall(rb'[{};]|[^{};]+', line):
+            if self.in_comment:
+                self.in_comment = token != b'}'
+            elif token == b'{':
+                self.in_comment = True
+            elif token == b';':
+                break
+            elif token != b'}':
+                kept.append(token)
+        return b' '.join(kept).strip()
+
+    def _finish(self):
+        if self.current is not None:
+            self.on_game(self.current['offset'], self.current['headers'])
+        self.current = None
+        self.in_comment = False
+
+
+class PgnDatabase:
+    """
+    An uploaded PGN file plus a SQLite index of game number -> byte offset
+    and header tags, so any game can be opened with a single seek.
+    """
+
+    ID_RE = re.compile(r'^[0-9a-f]{12}$')
+    BATCH_SIZE = 1000
+
+    def __init__(self, database_id):
+        if not self.ID_RE.match(database_id):
+            raise ValueError('Invalid database id')
+        self.database_id = database_id
+        self.pgn_path = os.path.join(PGN_DATA_DIR, f'{database_id}.pgn')
+        self.index_path = os.path.join(PGN_DATA_DIR, f'{database_id}.sqlite')
+
+    @classmethod
+    def create(cls, stream):
+        os.makedirs(PGN_DATA_DIR, exist_ok=True)
+        database = cls(uuid.uuid4().hex[:12])
+        database.build(stream)
+        return database
+
+    def exists(self):
+        return os.path.isfile(self.pgn_path) and os.path.isfile(self.index_path)
+
+    def connect(self):
+        return sqlite3.connect(self.index_path)
+
+    def build(self, stream):
+        db = self.connect()
+        db.execute('''CREATE TABLE IF NOT EXISTS games (
+            number INTEGER PRIMARY KEY, offset INTEGER, event TEXT, date TEXT,
+            white TEXT COLLATE NOCASE, black TEXT COLLATE NOCASE, result TEXT, headers TEXT)''')
+        batch = []
+        numbers = itertools.count(1)
+
+        def on_game(offset, headers):
+            batch.append((next(numbers), offset, headers))
+            if len(batch) >= self.BATCH_SIZE:
+                self._insert(db, batch)
+
+        indexer = PgnIndexer(on_game)
+        # Copy the upload to disk and index it in the same pass
+        with open(self.pgn_path, 'wb') as pgn_file:
+            while True:
+                chunk = stream.read(PGN_CHUNK_SIZE)
+                if not chunk:
+                    break
+                pgn_file.write(chunk)
+                indexer.feed(chunk)
+        indexer.close()
+        self._insert(db, batch)
+        for column in ('white', 'black', 'date', 'result'):
+            db.execute(f'CREATE INDEX IF NOT EXISTS games_{column} ON games ({column})')
+        db.commit()
+        db.close()
+
+    @staticmethod
+    def _insert(db, batch):
+        db.executemany(
+            'INSERT INTO games (number, offset, event, date, white, black, result, headers) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(number, offset, headers.get('Event'), headers.get('Date'), headers.get('White'),
+              headers.get('Black'), headers.get('Result'), json.dumps(headers))
+             for number, offset, headers in batch]
+        )
+        batch.clear()
+
+    def find(self, player=None, white=None, black=None, date=None, result=None, offset=0, limit=100):
+        clauses = []
+        params = []
+        if player:
+            clauses.append('(white = ? OR black = ?)')
+            params += [player, player]
+        if white:
+            clauses.append('white = ?')
+            params.append(white)
+        if black:
+            clauses.append('black = ?')
+            params.append(black)
+        if date:
+            # Prefix match so "2023" or "2023.05" select a year or month
+            clauses.append('date LIKE ?')
+            params.append(date.replace('%', '').replace('_', '') + '%')
+        if result:
+            clauses.append('result = ?')
+            params.append(result)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        db = self.connect()
+        try:
+            total = db.execute(f'SELECT COUNT(*) FROM games {where}', params).fetchone()[0]
+            rows = db.execute(f'SELECT number, headers FROM games {where} ORDER BY number LIMIT ? OFFSET ?',
+                              params + [limit, offset]).fetchall()
+        finally:
+            db.close()
+        return total, [{'number': number, 'headers': json.loads(headers)} for number, headers in rows]
+
+    def read_game(self, number):
+        db = self.connect()
+        try:
+            row = db.execute('SELECT offset FROM games WHERE number = ?', (number,)).fetchone()
+        finally:
+            db.close()
+        if row is None:
+            return None
+        with open(self.pgn_path, 'rb') as pgn_file:
+            pgn_file.seek(row[0])
+            return chess.pgn.read_game(io.TextIOWrapper(pgn_file, encoding='utf-8', errors='replace'))
+
+def minify_js(source):
+    # Line by line only: indentation, blank lines and whole-line comments go,
+    # but line breaks stay so automatic semicolon insertion is unaffected.
+    # Lines inside multi-line template literals are kept as written.
+    lines = []
+    in_template = False
+    for line in source.splitlines():
+        stripped = line.strip()
+        if in_template:
+            lines.append(line)
+        elif stripped and not stripped.startswith('//'):
+            lines.append(stripped)
+        if line.count('`') % 2:
+            in_template = not in_template
+    return '\n'.join(lines) + '\n'
+
+def minify_css(source):
+    source = re.sub(r'/\*.*?\*/', '', source, flags=re.S)
+    source = re.sub(r'\s+', ' ', source)
+    # A space before ':' can be a descendant combinator, so only the one after goes
+    source = re.sub(r'\s*([{};,>])\s*', r'\1', source)
+    source = re.sub(r':\s+', ':', source)
+    return source.replace(';}', '}').strip() + '\n'
+
+def accepts_gzip(accept_encoding):
+    for part in (accept_encoding or '').split(','):
+        coding, _, params = part.partition(';')
+        if coding.strip().lower() in ('gzip', '*'):
+            return not re.fullmatch(r'\s*q\s*=\s*0(\.0*)?\s*', params)
+    return False
+
+def etag_matches(if_none_match, etag):
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or any(tag.removeprefix('W/') == etag for tag in tags)
+
+class StaticAsset:
+    __slots__ = ('body', 'gzipped', 'etag', 'content_type')
+
+    def __init__(self, body, content_type):
+        self.body = body
+        gzipped = gzip.compress(body, STATIC_GZIP_LEVEL, mtime=0)
+        self.gzipped = gzipped if len(gzipped) < len(body) else None
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:20]}"'
+        self.content_type = content_type
+
+    def respond(self, if_none_match, accept_encoding, immutable):
+        """(status, headers, body) for a request with these headers."""
+        compressed = self.gzipped is not None and accepts_gzip(accept_encoding)
+        # Each encoding is a different representation and needs its own strong tag
+        etag = self.etag[:-1] + '-gzip"' if compressed else self.etag
+        headers = {
+            'ETag': etag,
+            'Cache-Control': f'public, max-age={STATIC_IMMUTABLE_MAX_AGE}, immutable' if immutable else 'no-cache',
+            'Vary': 'Accept-Encoding'
+        }
+        if if_none_match and etag_matches(if_none_match, etag):
+            return 304, headers, b''
+        headers['Content-Type'] = self.content_type
+        if compressed:
+            headers['Content-Encoding'] = 'gzip'
+        return 200, headers, self.gzipped if compressed else self.body
+
+class StaticAssets:
+    """
+    The page, stylesheet and script, minified, gzipped and held in memory.
+    The stylesheet and script are also served under content-hashed names
+    that index.html is rewritten to use, so browsers can keep them for good
+    and only revalidate the page. Everything is rebuilt when a source file
+    changes, so editing the front end needs no restart.
+    """
+
+    PAGE = 'index.html'
+    FILES = {
+        'styles.css': ('text/css; charset=utf-8', minify_css),
+        'script.js': ('application/javascript; charset=utf-8', minify_js)
+    }
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.mtimes = None
+        self.sources = {}  # page and unhashed names -> asset
+        self.hashed = {}  # fingerprinted name -> asset
+        self.refresh()
+
+    def refresh(self):
+        names = (self.PAGE,) + tuple(self.FILES)
+        mtimes = tuple(os.stat(os.path.join(self.directory, name)).st_mtime_ns for name in names)
+        if mtimes == self.mtimes:
+            return
+        with self.lock:
+            if mtimes == self.mtimes:
+                return
+            sources = {}
+            hashed = {}
+            with open(os.path.join(self.directory, self.PAGE), encoding='utf-8') as page_file:
+                page = page_file.read()
+            for name, (content_type, minify) in self.FILES.items():
+                with open(os.path.join(self.directory, name), encoding='utf-8') as source_file:
+                    asset = StaticAsset(minify(source_file.read()).encode('utf-8'), content_type)
+                stem, extension = os.path.splitext(name)
+                fingerprinted = f'{stem}.{asset.etag[1:11]}{extension}'
+                sources[name] = hashed[fingerprinted] = asset
+                page = re.sub(rf'(href|src)="{re.escape(name)}"', rf'\1="/assets/{fingerprinted}"', page)
+            sources[self.PAGE] = StaticAsset(page.encode('utf-8'), 'text/html; charset=utf-8')
+            self.sources, self.hashed = sources, hashed
+            self.mtimes = mtimes
+            print(f"Static assets built: {', '.join(sorted(hashed))}")
+
+    def source(self, name):
+        try:
+            self.refresh()
+        except OSError as e:
+            print(f"Error rebuilding static assets: {e}")
+        return self.sources[name]
+
+static_assets = None
+
+def open_pgn_database(database_id):
+    try:
+        database = PgnDatabase(database_id)
+    except ValueError:
+        return None
+    return database if database.exists() else None
+
+def metric_lines(name, help_text, kind, samples):
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+    for labels, value in samples:
+        lines.append(f'{name}{format_labels((), (), labels)} {value}')
+    return lines
+
+def render_metrics(pool, games=None):
+    """
+    Prometheus text exposition of the server's metrics and current state.
+    games is game_store.all_games(), for callers that fetched it already.
+    """
+    lines = []
+    for metric in (HTTP_LATENCY, EVENT_LATENCY, ENGINE_QUEUE_WAIT, ENGINE_NPS, ENGINE_NODES,
+                   ENGINE_SEARCH_SECONDS, ENGINE_SEARCHES, CACHE_LOOKUPS, PONDER_RESULTS, ENGINE_REJECTED,
+                   ENGINE_PREEMPTED, ENGINE_AFFINITY, ENGINE_RECONFIGURED):
+        lines.extend(metric.render())
+    
+    statuses = {}
+    players = 0
+    spectators = 0
+    for game in game_store.all_games() if games is None else games:
+        statuses[game.status] = statuses.get(game.status, 0) + 1
+        players += sum(1 for player in game.players.values() if player)
+        spectators += len(game.spectators)
+    lines += metric_lines('chess_games', 'Multiplayer games by status.', 'gauge',
+                          [([('status', status)], count) for status, count in sorted(statuses.items())])
+    lines += metric_lines('chess_players', 'Players seated in multiplayer games.', 'gauge', [([], players)])
+    lines += metric_lines('chess_spectators', 'Spectators watching multiplayer games.', 'gauge', [([], spectators)])
+    
+    sessions = session_store.stats()
+    lines += metric_lines('chess_sessions', 'Single-player sessions in memory.', 'gauge', [([], sessions['sessions'])])
+    lines += metric_lines('chess_session_bytes', 'Estimated memory used by single-player sessions.', 'gauge',
+                          [([], sessions['estimated_bytes'])])
+    
+    if pool:
+        stats = pool.stats()
+        busy_seconds, idle_seconds, ponder_seconds = pool.utilisation()
+        lines += metric_lines('chess_engine_workers', 'Engine workers by state.', 'gauge',
+                              [([('state', state)], stats[state]) for state in ('idle', 'busy', 'pondering', 'missing')])
+        lines += metric_lines('chess_engine_queue_waiting', 'Requests waiting for a free engine.', 'gauge',
+                              [([], stats['waiting'])])
+        lines += metric_lines('chess_engine_restarts_total', 'Engine workers replaced after crashing.', 'counter',
+                              [([], stats['restarts'])])
+        lines += metric_lines('chess_engine_busy_seconds_total', 'Worker time spent checked out.', 'counter',
+                              [([], round(busy_seconds, 3))])
+        lines += metric_lines('chess_engine_idle_seconds_total', 'Worker time spent idle in the pool.', 'counter',
+                              [([], round(idle_seconds, 3))])
+        lines += metric_lines('chess_engine_ponder_seconds_total', "Worker time spent pondering a player's expected move.",
+                              'counter', [([], round(ponder_seconds, 3))])
+    
+    with CACHE_LOOKUPS.lock:
+        lookups = dict(CACHE_LOOKUPS.values)
+    ratios = []
+    for cache in sorted({cache for cache, _ in lookups}):
+        hits = lookups.get((cache, 'hit'), 0)
+        total = hits + lookups.get((cache, 'miss'), 0)
+        ratios.append(([('cache', cache)], round(hits / total, 4) if total else 0.0))
+    lines += metric_lines('chess_cache_hit_ratio', 'Share of cache lookups that hit.', 'gauge', ratios)
+    with legal_move_lock:
+        legal_moves = len(legal_move_cache)
+    lines += metric_lines('chess_cache_entries', 'Entries held in memory by each cache.', 'gauge',
+                          [([('cache', 'eval')], eval_cache.stats()['entries']),
+                           ([('cache', 'legal_moves')], legal_moves)])
+    return '\n'.join(lines) + '\n'
+
+def print_profile(profiler, label, elapsed):
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+    print(f"Profile of {label} ({elapsed * 1000:.1f} ms):\n{output.getvalue()}")
+
+def make_eval_entry(result, limit):
+    score = result.info.get('score')
+    return {
+        'move': result.move.uci(),
+        'score': score_to_dict(score.relative) if score else None,
+        'pv': [move.uci() for move in result.info.get('pv', [result.move])],
+        'depth': result.info.get('depth', 0),
+        'nodes': result.info.get('nodes', 0),
+        'time': limit.time if limit.time is not None else result.info.get('time', 0)
+    }
+
+legal_move_cache = OrderedDict()
+legal_move_lock = threading.Lock()
+
+def get_legal_move_map(board):
+    """Map each from-square to the squares its piece can legally move to."""
+    key = chess.polyglot.zobrist_hash(board)
+    with legal_move_lock:
+        moves = legal_move_cache.get(key)
+        if moves is not None:
+            legal_move_cache.move_to_end(key)
+    if moves is not None:
+        CACHE_LOOKUPS.inc(1, 'legal_moves', 'hit')
+        return moves
+    CACHE_LOOKUPS.inc(1, 'legal_moves', 'miss')
+    
+    moves = {}
+    for move in board.legal_moves:
+        targets = moves.setdefault(chess.square_name(move.from_square), [])
+        to_square = chess.square_name(move.to_square)
+        # Promotions share a target; the client asks for the piece
+        if to_square not in targets:
+            targets.append(to_square)
+    
+    with legal_move_lock:
+        legal_move_cache[key] = moves
+        if len(legal_move_cache) > LEGAL_MOVE_CACHE_SIZE:
+            legal_move_cache.popitem(last=False)
+    return moves
+
+def get_book_move(board):
+    if opening_book is None or board.ply() >= OPENING_BOOK_DEPTH:
+        return None
+    try:
+        if OPENING_BOOK_MODE == 'best':
+            entry = opening_book.find(board)
+        else:
+            entry = opening_book.weighted_choice(board)
+    except IndexError:
+        entry = None
+    CACHE_LOOKUPS.inc(1, 'opening_book', 'hit' if entry else 'miss')
+    return entry
+
+def explorer_stats(board):
+    moves = []
+    for move, white, draws, black in opening_explorer.lookup(board):
+        moves.append({
+            'uci': move.uci(),
+            'san': board.san(move),
+            'games': white + draws + black,
+            'white': white,
+            'draws': draws,
+            'black': black
+        })
+    moves.sort(key=lambda entry: entry['games'], reverse=True)
+    CACHE_LOOKUPS.inc(1, 'opening_explorer', 'hit' if moves else 'miss')
+    return {
+        'fen': board.fen(),
+        'games': sum(entry['games'] for entry in moves),
+        'white': sum(entry['white'] for entry in moves),
+        'draws': sum(entry['draws'] for entry in moves),
+        'black': sum(entry['black'] for entry in moves),
+        'moves': moves
+    }
+
+def format_move(move, **details):
+    return dict({
+        'move': move,
+        'from': chess.square_name(move.from_square),
+        'to': chess.square_name(move.to_square),
+        'uci': move.uci()
+    }, **details)
+
+def search_entry(board, limit, result):
+    """Count a finished engine.play() search and cache its result; None if it found no move."""
+    record_search('play', result.info)
+    if not result.move:
+        return None
+    entry = make_eval_entry(result, limit)
+    eval_cache.put(board, entry)
+    return entry
+
+def count_ponder(worker, session_id, board):
+    # Whether the player made the move this session's worker pondered on
+    if worker.pondering and worker.pondering[0] == session_id:
+        PONDER_RESULTS.inc(1, 'hit' if worker.pondering[1] == chess.polyglot.zobrist_hash(board) else 'miss')
+
+def ponder_target(session_id, board, result):
+    """(session id, Zobrist hash) of the position the engine expects after its reply, or None."""
+    if not (result.move and result.ponder):
+        return None
+    expected = board.copy(stack=False)
+    expected.push(result.move)
+    expected.push(result.ponder)
+    return (session_id, chess.polyglot.zobrist_hash(expected))
+
+def book_reply(board):
+    """The opening book's move for board, formatted like an engine reply, or None."""
+    book_entry = get_book_move(board)
+    if not book_entry:
+        return None
+    return format_move(book_entry.move, score=None, pv=[book_entry.move.uci()], depth=0,
+                       cached=False, source='book', weight=book_entry.weight)
+
+def engine_reply(entry, cached):
+    return format_move(chess.Move.from_uci(entry['move']), score=entry['score'], pv=entry['pv'],
+                       depth=entry['depth'], cached=cached, source='engine')
+
+
+def dict_to_score(score):
+    if score is None:
+        return chess.engine.Cp(0)
+    if 'mate' in score:
+        return chess.engine.Mate(score['mate'])
+    return chess.engine.Cp(score['cp'])
+
+def clamped_cp(score):
+    # Mates and hopeless positions all count as the same large advantage
+    value = dict_to_score(score).score(mate_score=100000)
+    return max(-EVAL_CLAMP_CP, min(EVAL_CLAMP_CP, value))
+
+def win_percent(cp):
+    return 50 + 50 * (2 / (1 + math.exp(-0.00368208 * cp)) - 1)
+
+def move_accuracy(win_before, win_after):
+    accuracy = 103.1668 * math.exp(-0.04354 * max(0.0, win_before - win_after)) - 3.1669
+    return max(0.0, min(100.0, accuracy))
+
+def classify_move(cp_loss):
+    if cp_loss >= BLUNDER_CP:
+        return 'blunder'
+    if cp_loss >= MISTAKE_CP:
+        return 'mistake'
+    if cp_loss >= INACCURACY_CP:
+        return 'inaccuracy'
+    return None
+
+def terminal_entry(board):
+    # Checkmate or stalemate: nothing to search
+    if any(board.legal_moves):
+        return None
+    return {'move': None, 'score': {'mate': 0} if board.is_check() else {'cp': 0}, 'pv': [], 'depth': 0}
+
+def searches_needed(boards, limit):
+    """How many of boards a job at limit has to search: the game goes on and the cache has no answer."""
+    return sum(1 for board in boards if terminal_entry(board) is None and not eval_cache.covers(board, limit))
+
+def game_positions(start_board, moves):
+    boards = [start_board.copy(stack=False)]
+    for move in moves:
+        next_board = boards[-1].copy(stack=False)
+        next_board.push(move)
+        boards.append(next_board)
+    return boards
+
+def new_game_totals():
+    return {color: {'moves': 0, 'cp_loss': 0, 'accuracy': 0.0, 'inaccuracy': 0, 'mistake': 0, 'blunder': 0}
+            for color in ('white', 'black')}
+
+def ply_report(ply, position, move, before, after, totals):
+    color = 'white' if position.turn == chess.WHITE else 'black'
+    
+    # Both evals from the mover's point of view
+    before_cp = clamped_cp(before['score'])
+    after_cp = -clamped_cp(after['score'])
+    best_move = chess.Move.from_uci(before['move']) if before['move'] else None
+    cp_loss = 0 if move == best_move else max(0, before_cp - after_cp)
+    label = classify_move(cp_loss)
+    accuracy = move_accuracy(win_percent(before_cp), win_percent(after_cp))
+    
+    stats = totals[color]
+    stats['moves'] += 1
+    stats['cp_loss'] += cp_loss
+    stats['accuracy'] += accuracy
+    if label:
+        stats[label] += 1
+    
+    return {
+        'type': 'ply',
+        'ply': ply + 1,
+        'move_number': position.fullmove_number,
+        'color': color,
+        'san': position.san(move),
+        'uci': move.uci(),
+        'eval': after_cp if color == 'white' else -after_cp,
+        'best_move': position.san(best_move) if best_move else None,
+        'best_uci': before['move'],
+        'cp_loss': cp_loss,
+        'label': label,
+        'accuracy': round(accuracy, 1)
+    }
+
+def game_summary(totals):
+    summary = {'type': 'summary'}
+    for color, stats in totals.items():
+        played = stats['moves'] or 1
+        summary[color] = {
+            'moves': stats['moves'],
+            'acpl': round(stats['cp_loss'] / played),
+            'accuracy': round(stats['accuracy'] / played, 1),
+            'inaccuracies': stats['inaccuracy'],
+            'mistakes': stats['mistake'],
+            'blunders': stats['blunder']
+        }
+    return summary
+
+def parse_position(text):
+    """Board for a FEN or EPD string; EPD operations are ignored."""
+    if not isinstance(text, str):
+        raise ValueError('expected a string')
+    try:
+        board = chess.Board(text.strip())
+    except ValueError:
+        board = chess.Board()
+        board.set_epd(text.strip())
+    if not board.is_valid():
+        raise ValueError('illegal position')
+    return board
+
+def batch_limit(data, default_time):
+    """The search limit every position in a batch gets: time, depth or nodes."""
+    given = [key for key in ('time', 'depth', 'nodes') if data.get(key)]
+    if len(given) > 1:
+        raise ValueError('Give only one of time, depth or nodes')
+    try:
+        if 'depth' in given:
+            return chess.engine.Limit(depth=max(1, int(data['depth'])))
+        if 'nodes' in given:
+            return chess.engine.Limit(nodes=max(1, int(data['nodes'])))
+    except OverflowError:
+        raise ValueError(f'Invalid {given[0]}: {data[given[0]]!r}')
+    return chess.engine.Limit(time=parse_think_time(data.get('time') or default_time))
+
+def batch_positions(entries):
+    """
+    Parse a batch and group it by Zobrist hash, so transpositions and
+    repeated entries are searched once. Returns (board, indices) pairs
+    for the unique positions and error reports for unparsable entries.
+    """
+    unique = {}
+    errors = []
+    for index, text in enumerate(entries):
+        try:
+            board = parse_position(text)
+        except ValueError as e:
+            errors.append({'type': 'error', 'indices': [index], 'error': f'Invalid position: {e}'})
+            continue
+        key = chess.polyglot.zobrist_hash(board)
+        if key in unique:
+            unique[key][1].append(index)
+        else:
+            unique[key] = (board, [index])
+    return list(unique.values()), errors
+
+def batch_report(board, indices, entry, cached):
+    move = chess.Move.from_uci(entry['move']) if entry['move'] else None
+    return {
+        'type': 'eval',
+        'indices': indices,
+        'fen': board.fen(),
+        'move': entry['move'],
+        'san': board.san(move) if move else None,
+        'score': entry['score'],
+        'pv': entry['pv'],
+        'depth': entry['depth'],
+        'cached': cached
+    }
+
+def batch_summary(entries, positions, errors, cached):
+    return {
+        'type': 'summary',
+        'positions': len(entries),
+        'unique': len(positions),
+        'cached': cached,
+        'errors': len(errors)
+    }
+
+initialized = False
+
+def init():
+    """
+    Open what both servers share: the multiplayer game store and its
+    journal, the evaluation cache, the opening book and explorer, and the
+    front-end assets. Later calls keep what is already open.
+    """
+    global initialized, game_store, eval_cache, opening_book, opening_explorer, static_assets
+    if initialized:
+        return
+    initialized = True
+    if not STOCKFISH_PATH:
+        print("=" * 60)
+        print("WARNING: Stockfish engine not found!")
+        print("Please place the Stockfish executable in one of these locations:")
+        print(f"1. Same directory as app.py: {os.path.dirname(os.path.abspath(__file__))}")
+        print(f"2. In a 'stockfish' subdirectory: {os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stockfish')}")
+        if platform.system().lower() == "windows":
+            print("   Expected filename: stockfish.exe")
+        else:
+            print("   Expected filename: stockfish (make sure it's executable)")
+        print("Download from: https://stockfishchess.org/download/")
+        print("=" * 60)
+    else:
+        print(f"Using Stockfish engine at: {STOCKFISH_PATH}")
+
+    if OPENING_BOOK_PATH:
+        try:
+            # Memory-mapped once; each lookup is a binary search over the file
+            opening_book = chess.polyglot.open_reader(OPENING_BOOK_PATH)
+            print(f"Using opening book at: {OPENING_BOOK_PATH}")
+        except (OSError, ValueError) as e:
+            print(f"Error opening book {OPENING_BOOK_PATH}: {e}")
+    if OPENING_EXPLORER_PATH:
+        try:
+            # Remapped automatically when explorer.py replaces the file
+            opening_explorer = ExplorerIndex(OPENING_EXPLORER_PATH)
+            print(f"Using opening explorer at: {OPENING_EXPLORER_PATH} ({len(opening_explorer)} entries)")
+        except (OSError, ValueError) as e:
+            print(f"Error opening explorer {OPENING_EXPLORER_PATH}: {e}")
+
+    game_store = create_game_store(GAME_STORE)
+    eval_cache = PositionCache()
+    static_assets = StaticAssets(STATIC_DIR)
+
+def close():
+    """Flush and close what init() opened."""
+    global opening_book, opening_explorer
+    if game_store is not None:
+        game_store.close()
+    if eval_cache is not None:
+        eval_cache.close()
+    if opening_book is not None:
+        opening_book.close()
+        opening_book = None
+    if opening_explorer is not None:
+        opening_explorer.close()
+        opening_explorer = None
@@ -0,0 +1,340 @@
+"""
+Opening explorer index: which moves were played from a position, how often,
+and how those games ended, aggregated offline from PGN files.
+
+    python explorer.py explorer.bin games.pgn more-games.pgn
+
+streams every game once and counts, for each position in its first
+--max-plies plies, the move played and the game's result. Positions are keyed
+by their Polyglot Zobrist hash, so transpositions share one entry. The index
+is a sorted array of fixed-size records that the server memory-maps and
+answers with a single binary search.
+
+Running the command again only reads games it has not seen before: the index
+remembers how far it got into each PGN file, so new files and games appended
+to old ones are counted and merged with the existing records in one
+sequential pass. A file that got shorter since the last build is skipped;
+delete the index to rebuild from scratch.
+"""
+import argparse
+import heapq
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+
+import chess
+import chess.pgn
+import chess.polyglot
+
+# Magic and record count, then the records sorted by (key, move), then a JSON
+# trailer with the build settings and how far each PGN file has been read
+HEADER = struct.Struct('>8sQ')
+MAGIC = b'CAEXPL01'
+# Zobrist key, move code, white wins, draws, black wins
+RECORD = struct.Struct('>QH2xIII')
+KEY = struct.Struct('>Q')
+
+RESULTS = {'1-0': 0, '1/2-1/2': 1, '0-1': 2}
+DEFAULT_MAX_PLIES = 30
+BUFFER_ENTRIES = 500000  # (position, move) counts held in memory before spilling a sorted run
+READ_CHUNK_RECORDS = 4096
+
+
+def encode_move(move):
+    # From square in bits 0-5, to square in bits 6-11, promotion piece type above
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def decode_move(code):
+    return chess.Move(code & 63, code >> 6 & 63, code >> 12 or None)
+
+
+def read_header(data, size):
+    if size < HEADER.size:
+        raise ValueError('not an opening explorer index')
+    magic, count = HEADER.unpack_from(data)
+    if magic != MAGIC or size < HEADER.size + count * RECORD.size:
+        raise ValueError('not an opening explorer index')
+    return count
+
+
+class ExplorerIndex:
+    """
+    Read side of an index. The file is memory-mapped and every lookup is a
+    binary search over the sorted records; when the builder replaces the
+    file, the next lookup maps the new one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.identity = None
+        self.mapping = (b'', 0)
+        self.refresh()
+
+    def __len__(self):
+        return self.mapping[1]
+
+    def refresh(self):
+        stat = os.stat(self.path)
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if identity == self.identity:
+            return
+        with self.lock:
+            if identity == self.identity:
+                return
+            with open(self.path, 'rb') as handle:
+                data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                count = read_header(data, len(data))
+            except ValueError:
+                data.close()
+                raise
+            # Swapped as one tuple; lookups in flight keep the old mapping
+            # alive until they finish
+            self.mapping = (data, count)
+            self.identity = identity
+
+    def find(self, key):
+        """(move code, white wins, draws, black wins) for every move recorded from key."""
+        data, count = self.mapping
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if KEY.unpack_from(data, HEADER.size + mid * RECORD.size)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        entries = []
+        offset = HEADER.size + lo * RECORD.size
+        for _ in range(lo, count):
+            record = RECORD.unpack_from(data, offset)
+            if record[0] != key:
+                break
+            entries.append(record[1:])
+            offset += RECORD.size
+        return entries
+
+    def lookup(self, board):
+        try:
+            self.refresh()
+        except (OSError, ValueError):
+            pass  # Mid-rebuild or removed; keep serving the mapping we have
+        entries = []
+        for code, white, draws, black in self.find(chess.polyglot.zobrist_hash(board)):
+            move = decode_move(code)
+            # A hash collision can bring moves from another position
+            if board.is_legal(move):
+                entries.append((move, white, draws, black))
+        return entries
+
+    def close(self):
+        data = self.mapping[0]
+        self.mapping = (b'', 0)
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+class GameVisitor(chess.pgn.BaseVisitor):
+    """
+    Collects the (position, move) pairs of a game's first plies without
+    building a game tree; later moves are not even parsed.
+    """
+
+    def __init__(self, max_plies):
+        self.max_plies = max_plies
+
+    def begin_game(self):
+        self.outcome = None
+        self.pairs = set()  # A position repeated in one game counts once
+        self.plies = 0
+
+    def visit_header(self, tagname, tagvalue):
+        if tagname == 'Result':
+            self.outcome = tagvalue
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def begin_parse_san(self, board, san):
+        if self.plies >= self.max_plies:
+            return chess.pgn.SKIP
+
+    def visit_move(self, board, move):
+        self.pairs.add((chess.polyglot.zobrist_hash(board), encode_move(move)))
+        self.plies += 1
+
+    def visit_result(self, result):
+        if self.outcome not in RESULTS:
+            self.outcome = result
+
+    def handle_error(self, error):
+        pass  # Keep the moves before the illegal one
+
+    def result(self):
+        return self
+
+
+def read_records(handle, start, count=None):
+    handle.seek(start)
+    while count is None or count > 0:
+        want = READ_CHUNK_RECORDS if count is None else min(count, READ_CHUNK_RECORDS)
+        chunk = handle.read(want * RECORD.size)
+        chunk = chunk[:len(chunk) - len(chunk) % RECORD.size]
+        if not chunk:
+            return
+        if count is not None:
+            count -= len(chunk) // RECORD.size
+        yield from RECORD.iter_unpack(chunk)
+
+
+class IndexBuilder:
+    """
+    Counts moves from new games and merges them into an index file. Counts
+    are kept in memory up to a limit, then sorted and spilled to temporary
+    runs; writing merges the old index and every run in one pass.
+    """
+
+    def __init__(self, path, max_plies=None, buffer_entries=BUFFER_ENTRIES):
+        self.path = path
+        self.buffer_entries = buffer_entries
+        self.counts = {}
+        self.runs = []
+        self.games = 0
+        self.sources = {}
+        self.existing = 0
+        built_plies = None
+        if os.path.exists(path):
+            with open(path, 'rb') as handle:
+                self.existing = read_header(handle.read(HEADER.size), os.path.getsize(path))
+                handle.seek(HEADER.size + self.existing * RECORD.size)
+                trailer = json.loads(handle.read() or b'{}')
+            built_plies = trailer.get('max_plies')
+            self.sources = trailer.get('sources', {})
+        if built_plies is not None and max_plies is not None and max_plies != built_plies:
+            raise ValueError(f'{path} was built with --max-plies {built_plies}; '
+                             f'delete it to rebuild with a different depth')
+        self.max_plies = max_plies or built_plies or DEFAULT_MAX_PLIES
+
+    def add_file(self, pgn_path):
+        """Counts the games added to pgn_path since the last build; returns how many."""
+        name = os.path.abspath(pgn_path)
+        source = self.sources.get(name, {'offset': 0, 'games': 0})
+        if os.path.getsize(pgn_path) < source['offset']:
+            print(f'{pgn_path}: shorter than when it was indexed, skipped')
+            return 0
+        visitor = GameVisitor(self.max_plies)
+        games = 0
+        with open(pgn_path, encoding='utf-8-sig', errors='replace') as handle:
+            handle.seek(source['offset'])
+            while chess.pgn.read_game(handle, Visitor=lambda: visitor) is not None:
+                column = RESULTS.get(visitor.outcome)
+                if column is None:
+                    continue  # Unfinished games say nothing about results
+                for key, code in visitor.pairs:
+                    entry = self.counts.get(key << 16 | code)
+                    if entry is None:
+                        entry = self.counts[key << 16 | code] = [0, 0, 0]
+                    entry[column] += 1
+                games += 1
+                if len(self.counts) >= self.buffer_entries:
+                    self.spill()
+            offset = handle.tell()
+        self.sources[name] = {'offset': offset, 'games': source['games'] + games}
+        self.games += games
+        return games
+
+    def sorted_counts(self):
+        for packed in sorted(self.counts):
+            white, draws, black = self.counts[packed]
+            yield packed >> 16, packed & 0xffff, white, draws, black
+
+    def spill(self):
+        run = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.path)))
+        run.write(b''.join(RECORD.pack(*record) for record in self.sorted_counts()))
+        self.runs.append(run)
+        self.counts = {}
+
+    def write(self):
+        """Merges the old index, spilled runs and in-memory counts; returns the record count."""
+        old = open(self.path, 'rb') if self.existing else None
+        sources = [read_records(run, 0) for run in self.runs]
+        if old:
+            sources.append(read_records(old, HEADER.size, self.existing))
+        sources.append(self.sorted_counts())
+        tmp_path = self.path + '.tmp'
+        count = 0
+        try:
+            with open(tmp_path, 'wb') as out:
+                out.write(HEADER.pack(MAGIC, 0))
+                pending = []
+                current = None
+                for record in heapq.merge(*sources):
+                    if current and current[:2] == record[:2]:
+                        current = current[:2] + tuple(a + b for a, b in zip(current[2:], record[2:]))
+                        continue
+                    if current:
+                        pending.append(RECORD.pack(*current))
+                    current = record
+                    if len(pending) >= READ_CHUNK_RECORDS:
+                        out.write(b''.join(pending))
+                        count += len(pending)
+                        pending = []
+                if current:
+                    pending.append(RECORD.pack(*current))
+                out.write(b''.join(pending))
+                count += len(pending)
+                out.write(json.dumps({'max_plies': self.max_plies, 'sources': self.sources}).encode())
+                out.seek(0)
+                out.write(HEADER.pack(MAGIC, count))
+                out.flush()
+                os.fsync(out.fileno())
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            if old:
+                old.close()
+            for run in self.runs:
+                run.close()
+            self.runs = []
+        # Readers see either the old file or the new one, never a partial write
+        os.replace(tmp_path, self.path)
+        self.existing = count
+        self.counts = {}
+        return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('index', help='index file to create or update')
+    parser.add_argument('pgn', nargs='+', help='PGN files to add')
+    parser.add_argument('--max-plies', type=int, default=None,
+                        help=f'plies counted from the start of each game (default: as before, else {DEFAULT_MAX_PLIES})')
+    parser.add_argument('--buffer', type=int, default=BUFFER_ENTRIES,
+                        help=f'counts held in memory before spilling to a temporary file (default: {BUFFER_ENTRIES})')
+    options = parser.parse_args()
+
+    try:
+        builder = IndexBuilder(options.index, options.max_plies, options.buffer)
+    except (OSError, ValueError) as e:
+        sys.exit(f'Error opening {options.index}: {e}')
+    for path in options.pgn:
+        try:
+            print(f'{path}: {builder.add_file(path)} new games')
+        except OSError as e:
+            sys.exit(f'Error reading {path}: {e}')
+    if not builder.games and builder.existing:
+        print(f'{options.index}: no new games, left unchanged')
+        return
+    count = builder.write()
+    print(f'{options.index}: {count} records from {builder.games} new games')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,12 +5,28 @@ let board = null;
 let currentFEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1';
 let selectedSquare = null;
 let legalMoves = [];
+let legalMoveMap = null;
 let playerColor = 'white';
 let gameMode = 'suggest';
 let draggedPiece = null;
 let draggedFrom = null;
 let preventIllegalMoves = true;
 let lastSuggestion = null;
+let analysisRunning = false;
+let pgnDatabaseId = null;
+let explorerFEN = null;
+let explorerAvailable = true;
+
+// Per-browser session id so the server keeps this browser's game separate
+let sessionId = localStorage.getItem('chessSessionId');
+if (!sessionId) {
+    sessionId = Array.from(crypto.getRandomValues(new Uint8Array(16)), b => b.toString(16).padStart(2, '0')).join('');
+    localStorage.setItem('chessSessionId', sessionId);
+}
+
+function apiHeaders() {
+    return { 'Content-Type': 'application/json', 'X-Session-ID': sessionId };
+}
 
 // Multiplayer variables
 let multiplayerGame = null;
@@ -174,6 +190,10 @@ function initializeSocket() {
     socket.on('game_created', (data) => {
         multiplayerGame = data.state;
         multiplayerColor = data.color;
+        currentFEN = data.state.fen;
+        legalMoveMap = data.state.legal_moves || null;
+        renderBoard();
+        updateMoveHistory(data.state.history);
         showGameLink(data.game_id);
         updateMultiplayerInfo();
         updateStatus(`Game created! You are playing as ${data.color}`, 'success');
@@ -184,6 +204,7 @@ function initializeSocket() {
         multiplayerGame = data.state;
         multiplayerColor = data.color;
         currentFEN = data.state.fen;
+        legalMoveMap = data.state.legal_moves || null;
         renderBoard();
         updateMoveHistory(data.state.history);
         showGameLink(data.game_id);
@@ -207,31 +228,111 @@ function initializeSocket() {
         updateStatus('Opponent left the game', 'error');
     });
     
-    socket.on('move_made', (state) => {
+    socket.on('move_made', (move) => {
+        if (!multiplayerGame || move.game_id !== multiplayerGame.game_id) return;
+        if (move.seq !== multiplayerGame.seq + 1) {
+            // Missed a move; ask for everything after the last one applied
+            socket.emit('resync_game', { game_id: multiplayerGame.game_id, since: multiplayerGame.seq });
+            return;
+        }
+        applyMultiplayerMove(move);
+        applyMultiplayerStatus(move);
+        if (move.sound && move.by !== multiplayerColor) {
+            soundManager.playSound(move.sound);
+        }
+    });
+    
+    socket.on('game_resync', applyMultiplayerBatch);
+    
+    // Spectators get coalesced batches of moves instead of every move_made
+    socket.on('spectator_update', applyMultiplayerBatch);
+    
+    socket.on('game_state', (state) => {
         multiplayerGame = state;
         currentFEN = state.fen;
+        legalMoveMap = state.legal_moves || null;
         renderBoard();
         updateMoveHistory(state.history);
         updateMultiplayerInfo();
-        
-        if (state.game_over) {
-            updateStatus(`Game Over! Result: ${state.result}`, 'success');
-            if (state.result.includes('checkmate')) {
-                soundManager.playComplexSound('checkmate');
-            } else {
-                soundManager.playSound('gameEnd');
-            }
-        }
-    });
-    
-    socket.on('play_sound', (data) => {
-        soundManager.playSound(data.sound);
     });
     
     socket.on('error', (data) => {
         updateStatus(data.message, 'error');
         soundManager.playSound('error');
     });
+    
+    socket.on('analysis_started', () => {
+        analysisRunning = true;
+        document.getElementById('analysisButton').textContent = 'Stop Analysis';
+    });
+    
+    socket.on('analysis_update', (data) => {
+        renderAnalysisLines(data);
+    });
+    
+    socket.on('analysis_done', (data) => {
+        analysisRunning = false;
+        document.getElementById('analysisButton').textContent = 'Start Analysis';
+        renderAnalysisLines(data);
+    });
+    
+    socket.on('analysis_error', (data) => {
+        analysisRunning = false;
+        document.getElementById('analysisButton').textContent = 'Start Analysis';
+        updateStatus(data.error, 'error');
+    });
+}
+
+// Append one ply received from the server to the local multiplayer game
+function applyMultiplayerMove(move) {
+    const history = multiplayerGame.history;
+    if (move.seq % 2 === 1) {
+        history.push({ number: (move.seq + 1) / 2, white: move.san, black: '' });
+    } else if (history.length) {
+        history[history.length - 1].black = move.san;
+    }
+    multiplayerGame.seq = move.seq;
+    multiplayerGame.fen = move.fen;
+    currentFEN = move.fen;
+}
+
+function applyMultiplayerBatch(data) {
+    if (!multiplayerGame || data.game_id !== multiplayerGame.game_id) return;
+    const before = multiplayerGame.seq;
+    data.moves.forEach(move => {
+        if (move.seq === multiplayerGame.seq + 1) {
+            applyMultiplayerMove(move);
+        }
+    });
+    if (multiplayerGame.seq < data.seq) {
+        // The batch started after our last move; fetch the gap
+        socket.emit('resync_game', { game_id: multiplayerGame.game_id, since: multiplayerGame.seq });
+        return;
+    }
+    applyMultiplayerStatus(data);
+    if (data.sound && multiplayerGame.seq > before) {
+        soundManager.playSound(data.sound);
+    }
+}
+
+function applyMultiplayerStatus(status) {
+    legalMoveMap = status.legal_moves || null;
+    multiplayerGame.current_turn = status.current_turn;
+    multiplayerGame.status = status.status;
+    multiplayerGame.game_over = status.game_over;
+    multiplayerGame.result = status.result;
+    renderBoard();
+    updateMoveHistory(multiplayerGame.history);
+    updateMultiplayerInfo();
+    
+    if (status.game_over) {
+        updateStatus(`Game Over! Result: ${status.result}`, 'success');
+        if (status.result.includes('checkmate')) {
+            soundManager.playComplexSound('checkmate');
+        } else {
+            soundManager.playSound('gameEnd');
+        }
+    }
 }
 
 // Initialize the application
@@ -245,14 +346,16 @@ async function init() {
         
         const response = await fetch(`${API_URL}/init`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' }
+            headers: apiHeaders()
         });
         const data = await response.json();
         
         if (data.success) {
             currentFEN = data.fen;
+            legalMoveMap = data.legal_moves || null;
             renderBoard();
-            updateStatus('Engine initialized successfully', 'success');
+            updateMoveHistory(data.move_history || []);
+            updateStatus(data.engine === 'ready' ? 'Engine initialized successfully' : 'Engine is starting...', 'success');
             soundManager.playSound('gameStart');
             fetchActiveGames();
         } else {
@@ -326,6 +429,49 @@ function renderBoard() {
     }
     
     highlightLastSuggestion();
+    updateExplorer();
+}
+
+// Move statistics for the position on the board from the server's opening
+// explorer index; the panel stays hidden when there is no index
+async function updateExplorer() {
+    if (!explorerAvailable || explorerFEN === currentFEN) return;
+    const fen = currentFEN;
+    explorerFEN = fen;
+    
+    try {
+        const response = await fetch(`${API_URL}/explorer?fen=${encodeURIComponent(fen)}`, {
+            headers: apiHeaders()
+        });
+        if (response.status === 404) {
+            explorerAvailable = false;
+        }
+        const data = await response.json();
+        if (fen === currentFEN) {
+            renderExplorer(data.success ? data.moves : []);
+        }
+    } catch (error) {
+        console.error('Error fetching explorer stats:', error);
+    }
+}
+
+function renderExplorer(moves) {
+    const explorerElement = document.getElementById('explorerMoves');
+    explorerElement.innerHTML = '';
+    
+    moves.forEach(move => {
+        const percent = count => Math.round(count * 100 / move.games);
+        const segment = (name, count) =>
+            `<span class="explorer-${name}" style="width: ${percent(count)}%">${percent(count) >= 15 ? percent(count) + '%' : ''}</span>`;
+        const row = document.createElement('div');
+        row.className = 'analysis-line';
+        row.innerHTML = `
+            <div class="analysis-score">${move.san}</div>
+            <div class="explorer-games">${move.games}</div>
+            <div class="explorer-results">${segment('white', move.white)}${segment('draws', move.draws)}${segment('black', move.black)}</div>
+        `;
+        explorerElement.appendChild(row);
+    });
 }
 
 // Parse FEN string
@@ -414,7 +560,7 @@ async function handleSquareClick(e) {
         selectedSquare = square;
         e.currentTarget.classList.add('highlight');
         if (preventIllegalMoves) {
-            fetchLegalMoves(square);
+            showLegalMoves(square);
         }
     }
 }
@@ -428,12 +574,22 @@ function canMakeMove() {
     return multiplayerGame.current_turn === multiplayerColor;
 }
 
+// Show legal moves for a piece from the map sent with the current position
+function showLegalMoves(square) {
+    if (!legalMoveMap) {
+        fetchLegalMoves(square);
+        return;
+    }
+    legalMoves = (legalMoveMap[square] || []).map(to => square + to);
+    highlightLegalMoves();
+}
+
 // Fetch legal moves for a piece
 async function fetchLegalMoves(square) {
     try {
         const response = await fetch(`${API_URL}/legal_moves`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: apiHeaders(),
             body: JSON.stringify({ square })
         });
         const data = await response.json();
@@ -505,13 +661,14 @@ async function makeMove(from, to, promotion = null) {
     try {
         const response = await fetch(`${API_URL}/move`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: apiHeaders(),
             body: JSON.stringify({ from, to, promotion })
         });
         const data = await response.json();
         
         if (data.success) {
             currentFEN = data.fen;
+            legalMoveMap = data.legal_moves || null;
             renderBoard();
             updateMoveHistory(data.move_history);
             
@@ -529,6 +686,7 @@ async function makeMove(from, to, promotion = null) {
             if (data.computer_move) {
                 setTimeout(() => {
                     currentFEN = data.fen;
+                    legalMoveMap = data.legal_moves || null;
                     renderBoard();
                     updateMoveHistory(data.move_history);
                     // Play sound for computer move
@@ -697,14 +855,15 @@ async function suggestMove() {
         updateStatus('Calculating best move...', '');
         const response = await fetch(`${API_URL}/suggest`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' }
+            headers: apiHeaders()
         });
         const data = await response.json();
         
         if (data.success && data.suggestion) {
             lastSuggestion = data.suggestion;
             highlightLastSuggestion();
-            updateStatus(`Best move: ${data.suggestion.from} to ${data.suggestion.to}`, 'success');
+            const source = data.suggestion.source === 'book' ? ' (opening book)' : '';
+            updateStatus(`Best move: ${data.suggestion.from} to ${data.suggestion.to}${source}`, 'success');
         } else {
             updateStatus('No suggestion available', 'error');
         }
@@ -713,6 +872,102 @@ async function suggestMove() {
     }
 }
 
+// Start or stop live engine analysis of the current position
+function toggleAnalysis() {
+    if (analysisRunning) {
+        socket.emit('stop_analysis');
+        return;
+    }
+    socket.emit('start_analysis', {
+        session_id: gameMode === 'multiplayer' ? null : sessionId,
+        fen: currentFEN,
+        multipv: 3
+    });
+}
+
+function formatScore(score, fen) {
+    if (!score) return '';
+    // Scores arrive from the side to move's view; show them from White's
+    const sign = fen.split(' ')[1] === 'b' ? -1 : 1;
+    if (score.mate !== undefined) {
+        return `#${score.mate * sign}`;
+    }
+    const pawns = (score.cp * sign / 100).toFixed(2);
+    return pawns > 0 ? `+${pawns}` : pawns;
+}
+
+function renderAnalysisLines(data) {
+    const linesElement = document.getElementById('analysisLines');
+    linesElement.innerHTML = '';
+    
+    data.lines.forEach(line => {
+        const row = document.createElement('div');
+        row.className = 'analysis-line';
+        row.innerHTML = `
+            <div class="analysis-score">${formatScore(line.score, data.fen)}</div>
+            <div class="analysis-pv">d${line.depth} ${line.san}</div>
+        `;
+        linesElement.appendChild(row);
+    });
+}
+
+// Analyze the whole game, rendering each ply as the server streams it
+async function analyzeGame() {
+    document.getElementById('gameAnalysis').innerHTML = '';
+    updateStatus('Analyzing game...', '');
+    
+    try {
+        const response = await fetch(`${API_URL}/analyze_game`, {
+            method: 'POST',
+            headers: apiHeaders(),
+            body: JSON.stringify({})
+        });
+        if (!response.ok) {
+            const data = await response.json();
+            updateStatus(data.error || 'Game analysis failed', 'error');
+            return;
+        }
+        
+        // Newline-delimited JSON: one report per ply, then a summary
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            lines.filter(line => line.trim()).forEach(line => renderGameAnalysis(JSON.parse(line)));
+        }
+    } catch (error) {
+        updateStatus('Error analyzing game: ' + error.message, 'error');
+    }
+}
+
+function renderGameAnalysis(report) {
+    const analysisElement = document.getElementById('gameAnalysis');
+    
+    if (report.type === 'ply') {
+        const row = document.createElement('div');
+        row.className = 'move-row';
+        const number = report.color === 'white' ? `${report.move_number}.` : `${report.move_number}...`;
+        const label = report.label ? `${report.label}, best ${report.best_move}` : '';
+        row.innerHTML = `
+            <div class="move-number">${number}</div>
+            <div class="move-white">${report.san}</div>
+            <div class="analysis-score">${(report.eval / 100).toFixed(2)}</div>
+            <div class="move-black analysis-label ${report.label || ''}">${label}</div>
+        `;
+        analysisElement.appendChild(row);
+    } else if (report.type === 'summary') {
+        updateStatus(`Accuracy - White: ${report.white.accuracy}% (${report.white.blunders} blunders), ` +
+                     `Black: ${report.black.accuracy}% (${report.black.blunders} blunders)`, 'success');
+    } else if (report.type === 'error') {
+        updateStatus(report.error, 'error');
+    }
+}
+
 // Highlight last suggestion
 function highlightLastSuggestion() {
     if (lastSuggestion) {
@@ -782,13 +1037,14 @@ async function updateConfig() {
         mode: document.getElementById('gameMode').value,
         time: parseFloat(document.getElementById('time').value),
         threads: parseInt(document.getElementById('threads').value),
-        memory: parseInt(document.getElementById('memory').value)
+        memory: parseInt(document.getElementById('memory').value),
+        preanalyze: document.getElementById('preanalyze').checked
     };
     
     try {
         await fetch(`${API_URL}/config`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: apiHeaders(),
             body: JSON.stringify(config)
         });
         playerColor = config.player_color;
@@ -809,12 +1065,13 @@ async function resetGame() {
     try {
         const response = await fetch(`${API_URL}/reset`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' }
+            headers: apiHeaders()
         });
         const data = await response.json();
         
         if (data.success) {
             currentFEN = data.fen;
+            legalMoveMap = data.legal_moves || null;
             renderBoard();
             updateMoveHistory([]);
             updateStatus('Game reset', 'success');
@@ -835,12 +1092,13 @@ async function undoMove() {
     try {
         const response = await fetch(`${API_URL}/undo`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' }
+            headers: apiHeaders()
         });
         const data = await response.json();
         
         if (data.success) {
             currentFEN = data.fen;
+            legalMoveMap = data.legal_moves || null;
             renderBoard();
             updateMoveHistory(data.move_history);
             updateStatus('Move undone', 'success');
@@ -864,13 +1122,14 @@ async function loadFEN() {
     try {
         const response = await fetch(`${API_URL}/fen`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: apiHeaders(),
             body: JSON.stringify({ fen: fenInput })
         });
         const data = await response.json();
         
         if (data.success) {
             currentFEN = data.fen;
+            legalMoveMap = data.legal_moves || null;
             renderBoard();
             updateStatus('FEN position loaded', 'success');
             document.getElementById('fenInput').value = '';
@@ -889,7 +1148,7 @@ async function saveGame() {
     try {
         const response = await fetch(`${API_URL}/save`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: apiHeaders(),
             body: JSON.stringify({ format })
         });
         const data = await response.json();
@@ -933,6 +1192,12 @@ async function loadGame(event) {
     const file = event.target.files[0];
     if (!file) return;
     
+    if (file.name.endsWith('.pgn')) {
+        await uploadPgn(file);
+        event.target.value = '';
+        return;
+    }
+    
     const reader = new FileReader();
     reader.onload = async (e) => {
         const content = e.target.result;
@@ -941,13 +1206,14 @@ async function loadGame(event) {
         try {
             const response = await fetch(`${API_URL}/load`, {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                headers: apiHeaders(),
                 body: JSON.stringify({ content, format })
             });
             const data = await response.json();
             
             if (data.success) {
                 currentFEN = data.fen;
+                legalMoveMap = data.legal_moves || null;
                 renderBoard();
                 updateStatus('Game loaded successfully', 'success');
                 lastSuggestion = null;
@@ -962,6 +1228,62 @@ async function loadGame(event) {
     event.target.value = '';
 }
 
+// Upload a PGN file as-is; the server indexes every game in it
+async function uploadPgn(file) {
+    try {
+        updateStatus('Uploading games...', '');
+        const response = await fetch(`${API_URL}/pgn/upload`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/x-chess-pgn', 'X-Session-ID': sessionId },
+            body: file
+        });
+        const data = await response.json();
+        
+        if (data.success && data.total > 0) {
+            pgnDatabaseId = data.database_id;
+            const select = document.getElementById('pgnGames');
+            select.innerHTML = '';
+            data.games.forEach(game => {
+                const option = document.createElement('option');
+                option.value = game.number;
+                option.textContent = `${game.number}. ${game.headers.White || '?'} - ${game.headers.Black || '?'} ` +
+                                     `${game.headers.Result || ''} ${game.headers.Date || ''}`;
+                select.appendChild(option);
+            });
+            document.getElementById('pgnGamesGroup').style.display = data.total > 1 ? 'block' : 'none';
+            await loadPgnGame(1, data.total);
+        } else {
+            updateStatus(data.error || 'No games found in file', 'error');
+        }
+    } catch (error) {
+        updateStatus('Error loading game', 'error');
+    }
+}
+
+async function loadPgnGame(number, total = null) {
+    try {
+        const response = await fetch(`${API_URL}/pgn/${pgnDatabaseId}/load`, {
+            method: 'POST',
+            headers: apiHeaders(),
+            body: JSON.stringify({ number: parseInt(number) })
+        });
+        const data = await response.json();
+        
+        if (data.success) {
+            currentFEN = data.fen;
+            legalMoveMap = data.legal_moves || null;
+            renderBoard();
+            updateMoveHistory(data.move_history);
+            updateStatus(total > 1 ? `Loaded game 1 of ${total}` : 'Game loaded successfully', 'success');
+            lastSuggestion = null;
+        } else {
+            updateStatus(data.error || 'Error loading game', 'error');
+        }
+    } catch (error) {
+        updateStatus('Error loading game', 'error');
+    }
+}
+
 // Update slider values
 document.addEventListener('DOMContentLoaded', function() {
     document.getElementById('time').addEventListener('input', (e) => {
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_ENGINE = os.path.join(ROOT, 'bench', 'fake_engine.py')
+
+# Settled before app is imported: the fake engine instead of Stockfish, and
+# no optional files read or written next to the code
+os.environ['STOCKFISH_PATH'] = FAKE_ENGINE
+os.environ['GAME_JOURNAL'] = ''
+os.environ['GAME_STORE'] = 'memory'
+os.environ.pop('EVAL_CACHE_FILE', None)
+os.environ.pop('OPENING_BOOK', None)
+os.environ.pop('OPENING_EXPLORER', None)
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def engine_pool(monkeypatch):
+    """A started pool of fake engines installed as app.engine_pool, with an empty eval cache."""
+    import app
+    import core
+    pool = app.EnginePool(FAKE_ENGINE, 2, {})
+    pool.start()
+    assert pool.wait_ready(30)
+    monkeypatch.setattr(app, 'engine_pool', pool)
+    monkeypatch.setattr(core, 'eval_cache', core.PositionCache(max_entries=1000, path=None))
+    yield pool
+    pool.close()
@@ -0,0 +1,107 @@
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import chess
+import chess.engine
+import app
+import core
+from core import PositionCache, info_to_dict
+
+
+class ScriptedAnalysis:
+    """Stands in for chess.engine.SimpleAnalysisResult, replaying fixed info lines."""
+
+    def __init__(self, infos, best):
+        self.infos = list(infos)
+        self.best = best
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def would_block(self):
+        return False
+
+    def get(self):
+        if not self.infos:
+            raise chess.engine.AnalysisComplete()
+        return self.infos.pop(0)
+
+    def stop(self):
+        self.infos = []
+
+    def wait(self):
+        return chess.engine.BestMove(self.best, None)
+
+
+class ScriptedPool:
+    def __init__(self, analysis):
+        self.analysis = analysis
+
+    @contextmanager
+    def acquire(self, *args, **kwargs):
+        yield SimpleNamespace(engine=SimpleNamespace(analysis=lambda board, limit, **options: self.analysis))
+
+
+def line(multipv, depth, cp, ucis):
+    return {'multipv': multipv, 'depth': depth, 'seldepth': depth + 2, 'nodes': 1000 * depth, 'nps': 100000,
+            'time': depth / 10, 'score': chess.engine.PovScore(chess.engine.Cp(cp), chess.WHITE),
+            'pv': [chess.Move.from_uci(uci) for uci in ucis]}
+
+
+def received(client, name, timeout=5):
+    deadline = time.monotonic() + timeout
+    events = []
+    while time.monotonic() < deadline:
+        events += client.get_received()
+        if any(event['name'] == name for event in events):
+            return events
+        time.sleep(0.01)
+    raise AssertionError(f'no {name} event in {events}')
+
+
+def test_info_to_dict():
+    info = info_to_dict(chess.Board(), line(2, 12, 35, ['e2e4', 'e7e5', 'g1f3']))
+    assert info['multipv'] == 2
+    assert info['score'] == {'cp': 35}
+    assert info['pv'] == ['e2e4', 'e7e5', 'g1f3']
+    assert info['san'] == '1. e4 e5 2. Nf3'
+
+
+def test_start_analysis_validates_requests(monkeypatch):
+    client = app.socketio.test_client(app.app)
+    monkeypatch.setattr(app, 'engine_pool', None)
+    client.emit('start_analysis', {})
+    assert client.get_received()[-1]['args'][0]['error'] == 'Engine not initialized'
+    monkeypatch.setattr(app, 'engine_pool', ScriptedPool(None))
+    client.emit('start_analysis', {'fen': 'not a position'})
+    assert client.get_received()[-1]['args'][0]['error'].startswith('Invalid analysis request')
+    for think_time in ('soon', 'nan', 'inf'):
+        client.emit('start_analysis', {'fen': chess.STARTING_FEN, 'time': think_time})
+        assert client.get_received()[-1]['args'][0]['error'].startswith('Invalid analysis request')
+    client.emit('start_analysis', 'not an object')
+    assert client.get_received()[-1]['args'][0]['error'].startswith('Invalid analysis request')
+    client.disconnect()
+
+
+def test_analysis_streams_lines_and_caches_the_result(monkeypatch):
+    infos = [line(1, 10, 20, ['e2e4', 'e7e5']), line(2, 10, 10, ['d2d4']),
+             {'depth': 11, 'currmove': chess.Move.from_uci('e2e4')},  # no pv or score: skipped
+             line(1, 12, 25, ['e2e4', 'c7c5']), line(2, 12, 15, ['d2d4', 'd7d5'])]
+    monkeypatch.setattr(app, 'engine_pool', ScriptedPool(ScriptedAnalysis(infos, chess.Move.from_uci('e2e4'))))
+    monkeypatch.setattr(core, 'eval_cache', PositionCache(max_entries=10, path=None))
+    client = app.socketio.test_client(app.app)
+    client.emit('start_analysis', {'fen': chess.STARTING_FEN, 'time': 1, 'multipv': 2})
+    events = received(client, 'analysis_done')
+    started = next(event for event in events if event['name'] == 'analysis_started')['args'][0]
+    done = next(event for event in events if event['name'] == 'analysis_done')['args'][0]
+    assert done['analysis_id'] == started['analysis_id']
+    assert done['bestmove'] == 'e2e4'
+    # Only the latest line per slot is sent
+    assert [(info['multipv'], info['depth']) for info in done['lines']] == [(1, 12), (2, 12)]
+    entry = core.eval_cache.get(chess.Board(), chess.engine.Limit(depth=12))
+    assert entry['move'] == 'e2e4' and entry['pv'] == ['e2e4', 'c7c5']
+    client.disconnect()
@@ -0,0 +1,117 @@
+import asyncio
+
+import chess
+import socketio
+from aiohttp.test_utils import TestClient, TestServer
+
+import core
+import app_async
+from conftest import FAKE_ENGINE
+
+
+def run(scenario, monkeypatch):
+    # No engine: the startup hook finds nothing to launch
+    monkeypatch.setattr(core, 'STOCKFISH_PATH', None)
+    monkeypatch.setattr(core, 'game_store', core.MemoryGameStore())
+
+    async def main():
+        async with TestClient(TestServer(app_async.create_app())) as client:
+            await scenario(client)
+    asyncio.run(main())
+
+
+def test_sessions_are_kept_apart(monkeypatch):
+    async def scenario(client):
+        first = {'X-Session-ID': 'async-first'}
+        second = {'X-Session-ID': 'async-second'}
+        response = await client.post('/api/move', json={'from': 'e2', 'to': 'e4'}, headers=first)
+        data = await response.json()
+        assert data['success'] and data['move_history'][0]['white'] == 'e4'
+        assert data['legal_moves']['e7'] == ['e6', 'e5']
+        response = await client.post('/api/move', json={'from': 'e2', 'to': 'e5'}, headers=second)
+        assert response.status == 400
+        data = await (await client.get('/api/fen', headers=second)).json()
+        assert data['fen'] == chess.STARTING_FEN
+        # Browsers without the header get a cookie
+        response = await client.post('/api/init')
+        assert 'session_id' in response.cookies
+    run(scenario, monkeypatch)
+
+
+def test_suggest_answers_from_the_cache(monkeypatch):
+    board = chess.Board()
+    monkeypatch.setattr(core, 'eval_cache', core.PositionCache(max_entries=10, path=None))
+    core.eval_cache.put(board, {'move': 'g1f3', 'score': {'cp': 25}, 'pv': ['g1f3'], 'depth': 30,
+                                'time': 60.0, 'nodes': 10 ** 9})
+
+    async def scenario(client):
+        response = await client.post('/api/suggest', headers={'X-Session-ID': 'async-suggest'})
+        suggestion = (await response.json())['suggestion']
+        assert suggestion['uci'] == 'g1f3' and suggestion['cached']
+    run(scenario, monkeypatch)
+
+
+def test_multiplayer_moves_reach_both_players(monkeypatch):
+    async def scenario(client):
+        players = [socketio.AsyncClient(), socketio.AsyncClient()]
+        events = [asyncio.Queue(), asyncio.Queue()]
+        for player, queue in zip(players, events):
+            player.on('*', lambda event, data, queue=queue: queue.put_nowait((event, data)))
+            await player.connect(str(client.make_url('/')), transports=['websocket'])
+
+        async def wait_for(index, name):
+            while True:
+                event, data = await asyncio.wait_for(events[index].get(), 5)
+                if event == name:
+                    return data
+
+        await players[0].emit('create_game', {'color': 'white'})
+        game_id = (await wait_for(0, 'game_created'))['game_id']
+        await players[1].emit('join_game', {'game_id': game_id})
+        assert (await wait_for(1, 'game_joined'))['color'] == 'black'
+        await players[1].emit('make_multiplayer_move', {'game_id': game_id, 'from': 'e7', 'to': 'e5'})
+        assert (await wait_for(1, 'error'))['message'] == 'Not your turn'
+        await players[0].emit('make_multiplayer_move', {'game_id': game_id, 'from': 'e2', 'to': 'e4'})
+        for index in (0, 1):
+            delta = await wait_for(index, 'move_made')
+            assert delta['seq'] == 1 and delta['san'] == 'e4'
+        await players[1].emit('resync_game', {'game_id': game_id, 'since': 0})
+        assert [move['uci'] for move in (await wait_for(1, 'game_resync'))['moves']] == ['e2e4']
+        for player in players:
+            await player.disconnect()
+    run(scenario, monkeypatch)
+
+
+def test_pgn_upload_search_and_load(tmp_path, monkeypatch):
+    monkeypatch.setattr(core, 'PGN_DATA_DIR', str(tmp_path))
+    pgn = b'[White "Al"]\n[Result "1-0"]\n\n1. e4 e5 1-0\n\n[White "Bo"]\n[Result "0-1"]\n\n1. d4 d5 0-1\n'
+
+    async def scenario(client):
+        headers = {'X-Session-ID': 'async-pgn'}
+        uploaded = await (await client.post('/api/pgn/upload', data=pgn, headers=headers)).json()
+        assert uploaded['total'] == 2
+        database_id = uploaded['database_id']
+        found = await (await client.get(f'/api/pgn/{database_id}/games', params={'white': 'bo'})).json()
+        assert [game['number'] for game in found['games']] == [2]
+        loaded = await (await client.post(f'/api/pgn/{database_id}/load', json={'number': 2}, headers=headers)).json()
+        assert loaded['fen'] == 'rnbqkbnr/ppp1pppp/8/3p4/3P4/8/PPP1PPPP/RNBQKBNR w KQkq - 0 2'
+        assert (await client.get('/api/pgn/000000000000/games')).status == 404
+    run(scenario, monkeypatch)
+
+
+def test_async_pool_replaces_crashed_workers():
+    async def main():
+        pool = app_async.AsyncEnginePool(FAKE_ENGINE, 1, {})
+        pool.start()
+        assert pool.status() == 'starting'
+        try:
+            worker = await asyncio.wait_for(pool.checkout(), 30)
+            assert pool.status() == 'ready'
+            await pool.checkin(worker, broken=True)
+            replacement = await asyncio.wait_for(pool.checkout(), 30)
+            assert replacement is not worker
+            assert pool.stats()['restarts'] == 1
+            await pool.checkin(replacement)
+        finally:
+            await pool.close()
+    asyncio.run(main())
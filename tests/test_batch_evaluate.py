@@ -0,0 +1,83 @@
+import json
+
+import chess
+
+import app
+import core
+from core import batch_positions
+
+ITALIAN = 'r1bqkbnr/pppp1ppp/2n5/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R b KQkq - 3 3'
+
+
+def test_batch_groups_transpositions_and_clock_variants():
+    entries = [
+        chess.STARTING_FEN,
+        ITALIAN,
+        'not a position',
+        # Same position, other move clocks
+        ITALIAN.replace(' 3 3', ' 0 9'),
+        # EPD with an operation
+        'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - id "start";',
+        # Both kings missing
+        '8/8/8/8/8/8/8/8 w - - 0 1',
+    ]
+    positions, errors = batch_positions(entries)
+    assert [indices for _, indices in positions] == [[0, 4], [1, 3]]
+    assert [error['indices'] for error in errors] == [[2], [5]]
+
+
+def evaluate(client, **body):
+    response = client.post('/api/evaluate', json=body, headers={'X-Session-ID': 'batch'})
+    return response.status_code, [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_evaluate_streams_one_result_per_position(engine_pool):
+    client = app.app.test_client()
+    # The last entry is checkmate
+    entries = [chess.STARTING_FEN, ITALIAN, chess.STARTING_FEN, 'junk', 'R5k1/5ppp/8/8/8/8/8/6K1 b - - 1 1']
+    status, lines = evaluate(client, positions=entries, time=0.05)
+    assert status == 200
+    summary = lines.pop()
+    assert summary == {'type': 'summary', 'positions': 5, 'unique': 3, 'cached': 0, 'errors': 1}
+    reports = {tuple(line['indices']): line for line in lines}
+    assert sorted(reports) == [(0, 2), (1,), (3,), (4,)]
+    assert reports[(3,)]['type'] == 'error'
+    assert chess.Move.from_uci(reports[(0, 2)]['move']) in chess.Board().legal_moves
+    # A finished game needs no search
+    assert reports[(4,)]['move'] is None
+
+    status, lines = evaluate(client, positions=[chess.STARTING_FEN], time=0.05)
+    assert lines[0]['cached'] and lines[-1]['cached'] == 1
+
+
+def test_evaluate_rejects_bad_requests(engine_pool):
+    client = app.app.test_client()
+    assert evaluate(client, positions=[])[0] == 400
+    assert evaluate(client, positions=[chess.STARTING_FEN], time=1, depth=5)[0] == 400
+    assert evaluate(client, positions=[chess.STARTING_FEN] * (core.EVAL_BATCH_MAX_POSITIONS + 1))[0] == 400
+    for think_time in ('nan', 'inf', 'soon'):
+        assert evaluate(client, positions=[chess.STARTING_FEN], time=think_time)[0] == 400
+
+
+def test_batch_limit_clamps_the_think_time():
+    assert core.batch_limit({'time': -1}, 1.0).time == core.MIN_THINK_TIME
+    assert core.batch_limit({'time': 1e9}, 1.0).time == core.ANALYSIS_MAX_TIME
+    assert core.batch_limit({}, 0.5).time == 0.5
+    assert core.batch_limit({'depth': -3}, 1.0).depth == 1
+
+
+def test_jobs_the_quota_cannot_cover_are_refused_up_front(engine_pool, monkeypatch):
+    monkeypatch.setattr(core, 'ENGINE_SESSION_CPU_QUOTA', 1.0)
+    client = app.app.test_client()
+    status, lines = evaluate(client, positions=[chess.STARTING_FEN, ITALIAN], time=0.6)
+    assert status == 503
+    assert 'engine CPU-seconds' in lines[0]['error']
+    assert evaluate(client, positions=[chess.STARTING_FEN, ITALIAN], time=0.3)[0] == 200
+    # Less than 0.6 CPU-seconds are left, but the cache answers both positions now
+    assert evaluate(client, positions=[chess.STARTING_FEN, ITALIAN], time=0.3)[0] == 200
+    fresh = []
+    for uci in ('e2e4', 'd2d4'):
+        board = chess.Board()
+        board.push_uci(uci)
+        fresh.append(board.fen())
+    assert evaluate(client, positions=[chess.STARTING_FEN] + fresh, time=0.3)[0] == 503
@@ -0,0 +1,78 @@
+import pytest
+
+import app
+import core
+from conftest import FAKE_ENGINE
+
+PROFILES = {'big': {'Threads': 2, 'Hash': 64}}
+
+
+@pytest.fixture
+def pool():
+    pool = app.EnginePool(FAKE_ENGINE, 2, {'Threads': 1, 'Hash': 16},
+                          profile=lambda session_id: PROFILES.get(session_id, {}))
+    pool.start()
+    assert pool.wait_ready(30)
+    yield pool
+    pool.close()
+
+
+def search(pool, session_id):
+    worker = pool.checkout(session_id=session_id)
+    pool.checkin(worker)
+    return worker
+
+
+def test_sessions_stay_on_their_engines(pool):
+    first = search(pool, 'a')
+    second = search(pool, 'b')
+    # The other session's engine is left alone while an unbound one is idle
+    assert second is not first
+    for _ in range(3):
+        assert search(pool, 'a') is first
+        assert search(pool, 'b') is second
+
+
+def test_a_second_search_keeps_the_binding(pool):
+    first = search(pool, 'a')
+    running = pool.checkout(session_id='a')
+    assert running is first
+    # Alongside the running search, on the other engine
+    assert search(pool, 'a') is not first
+    pool.checkin(running)
+    assert search(pool, 'a') is first
+
+
+def test_profiles_only_change_the_engine_that_needs_them(pool):
+    plain = search(pool, 'a')
+    big = search(pool, 'big')
+    assert big is not plain
+    assert big.options == {'Threads': 2, 'Hash': 64}
+    assert plain.options == {'Threads': 1, 'Hash': 16}
+    # Both sessions keep their engines, so nothing is reconfigured again
+    for _ in range(2):
+        assert search(pool, 'a') is plain
+        assert search(pool, 'big') is big
+    assert plain.options == {'Threads': 1, 'Hash': 16}
+
+
+class Worker:
+    ticket = None
+
+
+def test_bindings_are_bounded_and_forgotten_with_their_engine():
+    affinity = core.EngineAffinity(limit=2)
+    for session_id in ('a', 'b', 'c'):
+        affinity.bind(core.EngineTicket(session_id, core.PRIORITY_SUGGEST), Worker())
+    assert list(affinity.bound) == ['b', 'c']
+    crashed = Worker()
+    affinity.bind(core.EngineTicket('d', core.PRIORITY_SUGGEST), crashed)
+    affinity.forget(crashed)
+    assert 'd' not in affinity.bound and crashed not in affinity.load
+
+
+def test_session_settings_are_clamped_to_the_engine(monkeypatch):
+    monkeypatch.setattr(core, 'ENGINE_MAX_THREADS', 4)
+    limits = {'Threads': (1, 1024), 'Hash': (1, 512)}
+    assert core.parse_config({'threads': 64, 'memory': 4096}, limits) == {'threads': 4, 'memory': 512}
+    assert core.parse_config({'threads': 0}, limits) == {'threads': 1}
@@ -0,0 +1,109 @@
+import threading
+
+import chess
+import chess.engine
+import pytest
+
+import app
+
+
+class FakeEngine:
+    def __init__(self, launcher):
+        self.launcher = launcher
+        self.options = {}
+        self.warmed = []
+
+    def ping(self):
+        self.launcher.gate.wait(5)
+
+    def configure(self, options):
+        pass
+
+    def analyse(self, board, limit):
+        self.warmed.append(board.fen())
+
+    def quit(self):
+        pass
+
+
+class Launcher:
+    """Stands in for popen_uci; the first `failures` launches fail."""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.gate = threading.Event()
+        self.gate.set()
+        self.engines = []
+
+    def __call__(self, path):
+        if self.failures:
+            self.failures -= 1
+            raise FileNotFoundError(path)
+        engine = FakeEngine(self)
+        self.engines.append(engine)
+        return engine
+
+
+@pytest.fixture
+def launcher(monkeypatch):
+    launcher = Launcher()
+    monkeypatch.setattr(chess.engine.SimpleEngine, 'popen_uci', launcher)
+    monkeypatch.setattr(app, 'ENGINE_RESTART_MIN_DELAY', 0.01)
+    return launcher
+
+
+def test_start_returns_before_workers_are_ready(launcher):
+    launcher.gate.clear()
+    pool = app.EnginePool('stockfish', 2, {}, warmup=[chess.STARTING_FEN])
+    try:
+        pool.start()
+        assert pool.status() == 'starting'
+        assert not pool.wait_ready(0.05)
+        launcher.gate.set()
+        assert pool.wait_ready(5)
+        assert pool.status() == 'ready'
+        assert [engine.warmed for engine in launcher.engines] == [[chess.STARTING_FEN]] * 2
+    finally:
+        pool.close()
+
+
+def test_supervisor_replaces_crashed_workers(launcher):
+    pool = app.EnginePool('stockfish', 1, {})
+    try:
+        pool.start()
+        assert pool.wait_ready(5)
+        with pytest.raises(chess.engine.EngineTerminatedError):
+            with pool.acquire() as worker:
+                raise chess.engine.EngineTerminatedError('engine died')
+        replacement = pool.checkout(timeout=5)
+        assert replacement is not worker and len(launcher.engines) == 2
+        assert pool.stats()['restarts'] == 1
+        pool.checkin(replacement)
+    finally:
+        pool.close()
+
+
+def test_failed_starts_are_retried(launcher):
+    launcher.failures = 2
+    pool = app.EnginePool('stockfish', 1, {})
+    try:
+        pool.start()
+        assert pool.wait_ready(5)
+        assert len(launcher.engines) == 1 and pool.stats()['missing'] == 0
+    finally:
+        pool.close()
+
+
+def test_init_reports_engine_status_without_waiting(launcher, monkeypatch):
+    launcher.gate.clear()
+    monkeypatch.setattr(app, 'STOCKFISH_PATH', 'stockfish')
+    monkeypatch.setattr(app, 'engine_pool', None)
+    try:
+        data = app.app.test_client().post('/api/init', headers={'X-Session-ID': 'lazy-start'}).get_json()
+        assert data['success'] and data['engine'] == 'starting'
+        pool = app.engine_pool
+        app.init_engine()
+        assert app.engine_pool is pool
+    finally:
+        launcher.gate.set()
+        app.engine_pool.close()
@@ -0,0 +1,109 @@
+import chess
+import pytest
+
+import app
+import core
+from explorer import ExplorerIndex, IndexBuilder
+
+FIRST = """[Result "1-0"]
+
+1. e4 e5 2. Nf3 Nc6 1-0
+
+[Result "0-1"]
+
+1. e4 c5 2. Nf3 d6 0-1
+
+"""
+APPENDED = """[Result "1/2-1/2"]
+
+1. d4 d5 2. Nf3 e6 1/2-1/2
+
+"""
+SECOND = """[Result "1-0"]
+
+1. Nf3 d5 2. d4 Nf6 1-0
+
+[Result "*"]
+
+1. e4 e5 *
+
+"""
+
+
+def build(index_path, *pgn_paths, **options):
+    builder = IndexBuilder(str(index_path), **options)
+    games = sum(builder.add_file(str(path)) for path in pgn_paths)
+    builder.write()
+    return games
+
+
+def test_incremental_merge_matches_full_rebuild(tmp_path):
+    first = tmp_path / 'first.pgn'
+    second = tmp_path / 'second.pgn'
+    first.write_text(FIRST)
+    assert build(tmp_path / 'incremental.bin', first) == 2
+
+    # New games appended to a known file, plus a new file
+    with open(first, 'a') as handle:
+        handle.write(APPENDED)
+    second.write_text(SECOND)
+    assert build(tmp_path / 'incremental.bin', first, second) == 2
+    assert build(tmp_path / 'incremental.bin', first, second) == 0
+
+    assert build(tmp_path / 'full.bin', first, second) == 4
+    assert (tmp_path / 'incremental.bin').read_bytes() == (tmp_path / 'full.bin').read_bytes()
+    # Spilling every few counts to temporary runs gives the same file too
+    build(tmp_path / 'spilled.bin', first, second, buffer_entries=3)
+    assert (tmp_path / 'spilled.bin').read_bytes() == (tmp_path / 'full.bin').read_bytes()
+
+
+def test_lookup_counts_results(tmp_path):
+    pgn = tmp_path / 'games.pgn'
+    pgn.write_text(FIRST + APPENDED + SECOND)
+    build(tmp_path / 'index.bin', pgn)
+    index = ExplorerIndex(str(tmp_path / 'index.bin'))
+    try:
+        stats = {move.uci(): counts for move, *counts in index.lookup(chess.Board())}
+        # The unfinished game is not counted
+        assert stats == {'e2e4': [1, 0, 1], 'd2d4': [0, 1, 0], 'g1f3': [1, 0, 0]}
+        board = chess.Board()
+        for uci in ('g1f3', 'd7d5', 'd2d4'):
+            board.push_uci(uci)
+        # Also reached by 1. d4 d5 2. Nf3, which shares the entry
+        assert {move.uci(): counts for move, *counts in index.lookup(board)} == {'g8f6': [1, 0, 0],
+                                                                                 'e7e6': [0, 1, 0]}
+    finally:
+        index.close()
+
+
+def test_depth_is_fixed_by_the_first_build(tmp_path):
+    pgn = tmp_path / 'games.pgn'
+    pgn.write_text(FIRST)
+    build(tmp_path / 'index.bin', pgn, max_plies=2)
+    with pytest.raises(ValueError):
+        IndexBuilder(str(tmp_path / 'index.bin'), max_plies=4)
+    index = ExplorerIndex(str(tmp_path / 'index.bin'))
+    board = chess.Board()
+    board.push_uci('e2e4')
+    board.push_uci('e7e5')
+    assert index.lookup(board) == []
+    index.close()
+
+
+def test_endpoint_sorts_moves_by_popularity(tmp_path, monkeypatch):
+    client = app.app.test_client()
+    monkeypatch.setattr(core, 'opening_explorer', None)
+    assert client.get('/api/explorer').status_code == 404
+    pgn = tmp_path / 'games.pgn'
+    pgn.write_text(FIRST + APPENDED + SECOND)
+    build(tmp_path / 'index.bin', pgn)
+    index = ExplorerIndex(str(tmp_path / 'index.bin'))
+    monkeypatch.setattr(core, 'opening_explorer', index)
+    try:
+        data = client.get('/api/explorer', headers={'X-Session-ID': 'explorer'}).get_json()
+        assert data['moves'][0]['san'] == 'e4' and data['moves'][0]['games'] == 2
+        assert sorted(move['san'] for move in data['moves'][1:]) == ['Nf3', 'd4']
+        assert (data['games'], data['white'], data['draws'], data['black']) == (4, 2, 1, 1)
+        assert client.get('/api/explorer', query_string={'fen': 'bad'}).status_code == 400
+    finally:
+        index.close()
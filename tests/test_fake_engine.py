@@ -0,0 +1,32 @@
+import chess
+import chess.engine
+import pytest
+
+from conftest import FAKE_ENGINE
+
+
+@pytest.fixture
+def engine():
+    engine = chess.engine.SimpleEngine.popen_uci(FAKE_ENGINE)
+    yield engine
+    engine.quit()
+
+
+def test_same_position_same_move(engine):
+    board = chess.Board()
+    limit = chess.engine.Limit(time=0.01)
+    first = engine.play(board, limit)
+    assert first.move in board.legal_moves
+    assert engine.play(board, limit).move == first.move
+    board.push(first.move)
+    assert engine.play(board, limit).move in board.legal_moves
+
+
+def test_analysis_runs_until_stopped(engine):
+    with engine.analysis(chess.Board()) as analysis:
+        info = analysis.get()
+        while 'pv' not in info:
+            info = analysis.get()
+        analysis.stop()
+        best = analysis.wait()
+    assert best.move == info['pv'][0]
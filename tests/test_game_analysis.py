@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+
+import chess
+import chess.engine
+import pytest
+
+import app
+import core
+from app import analyse_game
+from core import PositionCache, clamped_cp, classify_move, move_accuracy, win_percent
+
+LIMIT = chess.engine.Limit(time=0.5)
+
+
+def test_classify_move_thresholds():
+    assert classify_move(0) is None
+    assert classify_move(49) is None
+    assert classify_move(50) == 'inaccuracy'
+    assert classify_move(100) == 'mistake'
+    assert classify_move(299) == 'mistake'
+    assert classify_move(300) == 'blunder'
+
+
+def test_accuracy_follows_lost_winning_chances():
+    assert win_percent(0) == pytest.approx(50)
+    assert win_percent(400) > 80 and win_percent(-400) < 20
+    assert move_accuracy(60, 60) == pytest.approx(100, abs=0.01)
+    assert move_accuracy(60, 70) == move_accuracy(60, 60)
+    assert move_accuracy(80, 40) < move_accuracy(80, 70) < 100
+    assert move_accuracy(100, 0) == 0
+
+
+def test_mates_are_clamped():
+    assert clamped_cp({'cp': 250}) == 250
+    assert clamped_cp({'cp': 5000}) == 1000
+    assert clamped_cp({'mate': 3}) == 1000
+    assert clamped_cp({'mate': -2}) == -1000
+    assert clamped_cp(None) == 0
+
+
+def searched(board, move, cp):
+    return board, {'move': move, 'score': {'cp': cp}, 'pv': [move], 'depth': 20, 'nodes': 1, 'time': 1.0}
+
+
+def test_analyse_game_labels_each_ply(monkeypatch):
+    moves = [chess.Move.from_uci(uci) for uci in ('e2e4', 'f7f6', 'a2a3')]
+    boards = [chess.Board()]
+    for move in moves:
+        boards.append(boards[-1].copy())
+        boards[-1].push(move)
+    cache = PositionCache(max_entries=10, path=None)
+    # Scores are from the side to move's point of view
+    for board, entry in (searched(boards[0], 'e2e4', 30), searched(boards[1], 'e7e5', -30),
+                         searched(boards[2], 'd2d4', 300), searched(boards[3], 'e7e5', 0)):
+        cache.put(board, entry)
+    monkeypatch.setattr(core, 'eval_cache', cache)
+    monkeypatch.setattr(app, 'engine_pool', SimpleNamespace(size=2, job_slots=lambda: 2))
+
+    *plies, summary = analyse_game(chess.Board(), moves, LIMIT)
+    assert [(ply['san'], ply['cp_loss'], ply['label']) for ply in plies] == [
+        ('e4', 0, None), ('f6', 270, 'mistake'), ('a3', 300, 'blunder')]
+    assert plies[1]['best_move'] == 'e5'
+    assert [ply['eval'] for ply in plies] == [30, 300, 0]
+    assert summary['white']['moves'] == 2 and summary['white']['acpl'] == 150
+    assert summary['white']['blunders'] == 1
+    assert summary['black']['mistakes'] == 1 and summary['black']['acpl'] == 270
+
+
+def test_finished_games_need_no_final_search(monkeypatch):
+    board = chess.Board()
+    moves = [chess.Move.from_uci(uci) for uci in ('f2f3', 'e7e5', 'g2g4', 'd8h4')]
+    cache = PositionCache(max_entries=10, path=None)
+    best = {0: 'e2e4', 1: 'e7e5', 2: 'd2d4', 3: 'd8h4'}
+    for ply, move in enumerate(moves):
+        cache.put(board, searched(board, best[ply], 0 if ply < 3 else 1000)[1])
+        board.push(move)
+    monkeypatch.setattr(core, 'eval_cache', cache)
+    monkeypatch.setattr(app, 'engine_pool', SimpleNamespace(size=2, job_slots=lambda: 2))
+    *plies, _ = analyse_game(chess.Board(), moves, LIMIT)
+    assert plies[-1]['san'] == 'Qh4#'
+    assert plies[-1]['cp_loss'] == 0 and plies[-1]['eval'] == -1000
+
+
+def test_analyze_game_endpoint_errors(monkeypatch):
+    client = app.app.test_client()
+    monkeypatch.setattr(app, 'engine_pool', None)
+    assert client.post('/api/analyze_game', json={}).status_code == 503
+    monkeypatch.setattr(app, 'engine_pool', SimpleNamespace(size=2, job_slots=lambda: 2))
+    assert client.post('/api/analyze_game', json={'time': 'slow'}).status_code == 400
@@ -0,0 +1,269 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import pytest
+
+import app
+import core
+from core import FileGameStore, GameJournal, MemoryGameStore, MultiplayerGame, RedisGameStore
+
+OPENING = ['e2e4', 'e7e5', 'g1f3', 'b8c6']
+
+
+def new_game(game_id='0123abcd'):
+    game = MultiplayerGame(game_id)
+    game.add_player('sid-white', 'white')
+    game.add_player('sid-black', 'black')
+    return game
+
+
+def play(game, ucis):
+    for uci in ucis:
+        assert game.make_move(uci[:2], uci[2:4])
+
+
+def test_games_round_trip_through_dicts():
+    game = new_game()
+    play(game, OPENING)
+    restored = MultiplayerGame.from_dict(game.to_dict())
+    assert restored.get_state() == game.get_state()
+
+
+def journal_rows(path, table):
+    db = sqlite3.connect(path)
+    try:
+        return db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+    finally:
+        db.close()
+
+
+def test_journal_recovers_games(tmp_path):
+    path = str(tmp_path / 'journal.db')
+    store = MemoryGameStore(GameJournal(path))
+    game = new_game()
+    store.add(game)
+    play(game, OPENING)
+    store.save(game)
+    gone = new_game('deadbeef')
+    store.add(gone)
+    store.delete('deadbeef')
+    store.close()
+
+    journal = GameJournal(path)
+    assert journal.recover() == {'0123abcd': OPENING}
+    journal.close()
+
+    restored = MemoryGameStore(GameJournal(path))
+    with restored.locked('0123abcd') as game:
+        assert [move.uci() for move in game.moves.moves()] == OPENING
+        assert game.players == {'white': None, 'black': None}
+    # Only moves made after recovery are logged again
+    play(game, ['f1b5'])
+    restored.save(game)
+    restored.close()
+    journal = GameJournal(path)
+    assert journal.recover() == {'0123abcd': OPENING + ['f1b5']}
+    journal.close()
+
+
+def test_journal_compacts_into_snapshots(tmp_path):
+    path = str(tmp_path / 'journal.db')
+    journal = GameJournal(path, batch_size=2, compact_rows=3)
+    journal.record('g1', 'create')
+    for uci in OPENING:
+        journal.record('g1', 'move', uci)
+    journal.close()
+    assert journal_rows(path, 'log') == 0
+    assert journal_rows(path, 'snapshots') == 1
+
+    # The process dies with a move in the log but not yet compacted
+    crashed = GameJournal(path, compact_rows=100)
+    crashed.record('g1', 'move', 'f1b5')
+    deadline = time.monotonic() + 5
+    while journal_rows(path, 'log') == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    journal = GameJournal(path)
+    assert journal.recover() == {'g1': OPENING + ['f1b5']}
+    assert journal.db.execute('SELECT COUNT(*) FROM log').fetchone()[0] == 0
+    journal.close()
+
+
+def test_journal_drops_stale_games(tmp_path):
+    path = str(tmp_path / 'journal.db')
+    journal = GameJournal(path)
+    journal.record('old', 'create')
+    journal.record('new', 'create')
+    journal.close()
+    journal = GameJournal(path, max_age=60)
+    with journal.db:
+        journal.db.execute("UPDATE snapshots SET updated = ? WHERE game_id = 'old'", (time.time() - 120,))
+    assert journal.recover() == {'new': []}
+    journal.close()
+
+
+def test_unclaimed_recovered_games_expire(tmp_path):
+    path = str(tmp_path / 'journal.db')
+    store = MemoryGameStore(GameJournal(path))
+    for game_id in ('0123abcd', 'deadbeef'):
+        store.add(new_game(game_id))
+    store.close()
+
+    restored = MemoryGameStore(GameJournal(path))
+    assert restored.unclaimed == {'0123abcd', 'deadbeef'}
+    with restored.locked('0123abcd') as game:
+        game.add_player('sid-back', 'white')
+        restored.save(game)
+    # The journal's max_age has passed since the restart
+    restored.unclaimed_until = time.monotonic()
+    assert [game.game_id for game in restored.all_games()] == ['0123abcd']
+    restored.close()
+    journal = GameJournal(path)
+    assert list(journal.recover()) == ['0123abcd']
+    journal.close()
+
+
+def hold_lock(store, game_id, acquired, release):
+    with store.locked(game_id):
+        acquired.set()
+        release.wait(5)
+
+
+def assert_lock_excludes(store, other, game_id):
+    acquired = threading.Event()
+    release = threading.Event()
+    holder = threading.Thread(target=hold_lock, args=(store, game_id, acquired, release))
+    holder.start()
+    assert acquired.wait(5)
+    entered = threading.Event()
+
+    def contend():
+        with other.locked(game_id):
+            entered.set()
+
+    contender = threading.Thread(target=contend)
+    contender.start()
+    assert not entered.wait(0.3)
+    release.set()
+    assert entered.wait(5)
+    holder.join()
+    contender.join()
+
+
+def test_memory_store_lock_excludes_other_holders():
+    store = MemoryGameStore()
+    store.add(new_game())
+    assert_lock_excludes(store, store, '0123abcd')
+
+
+def test_file_store_lock_excludes_other_holders(tmp_path):
+    store = FileGameStore(str(tmp_path))
+    store.add(new_game())
+    assert_lock_excludes(store, store, '0123abcd')
+    # A second store stands in for another worker process
+    assert_lock_excludes(store, FileGameStore(str(tmp_path)), '0123abcd')
+
+
+def test_file_store_reloads_changed_games(tmp_path):
+    store = FileGameStore(str(tmp_path))
+    other = FileGameStore(str(tmp_path))
+    store.add(new_game())
+    with store.locked('0123abcd') as first:
+        pass
+    with store.locked('0123abcd') as again:
+        assert again is first
+    with other.locked('0123abcd') as game:
+        play(game, OPENING[:2])
+        other.save(game)
+    with store.locked('0123abcd') as game:
+        assert [move.uci() for move in game.moves.moves()] == OPENING[:2]
+    with store.locked('../escape') as game:
+        assert game is None
+    store.delete('0123abcd')
+    assert not os.listdir(tmp_path)
+
+
+@pytest.fixture
+def redis_store():
+    redis = pytest.importorskip('redis')
+    store = RedisGameStore(os.environ.get('TEST_REDIS_URL', 'redis://localhost:6379/15'))
+    try:
+        store.client.ping()
+    except redis.exceptions.ConnectionError:
+        pytest.skip('Redis server not running')
+    yield store
+    store.close()
+
+
+def test_redis_store_lock_excludes_other_holders(redis_store):
+    game_id = uuid.uuid4().hex[:8]
+    redis_store.add(new_game(game_id))
+    try:
+        assert_lock_excludes(redis_store, redis_store, game_id)
+        with redis_store.locked(game_id) as game:
+            play(game, OPENING[:2])
+            redis_store.save(game)
+        with redis_store.locked(game_id) as game:
+            assert [move.uci() for move in game.moves.moves()] == OPENING[:2]
+    finally:
+        redis_store.delete(game_id)
+
+
+def test_redis_store_reuses_games_until_another_worker_saves(redis_store):
+    other = RedisGameStore(os.environ.get('TEST_REDIS_URL', 'redis://localhost:6379/15'))
+    game_id = uuid.uuid4().hex[:8]
+    redis_store.add(new_game(game_id))
+    try:
+        with redis_store.locked(game_id) as first:
+            pass
+        with redis_store.locked(game_id) as again:
+            assert again is first
+        with other.locked(game_id) as game:
+            play(game, OPENING[:2])
+            other.save(game)
+        with redis_store.locked(game_id) as game:
+            assert game is not first
+            assert [move.uci() for move in game.moves.moves()] == OPENING[:2]
+        assert [game.game_id for game in redis_store.all_games()].count(game_id) == 1
+    finally:
+        redis_store.delete(game_id)
+        other.close()
+
+
+def test_redis_lock_outlives_its_timeout_while_held(redis_store, monkeypatch):
+    monkeypatch.setattr(RedisGameStore, 'LOCK_TIMEOUT', 0.6)
+    store = RedisGameStore(os.environ.get('TEST_REDIS_URL', 'redis://localhost:6379/15'))
+    game_id = uuid.uuid4().hex[:8]
+    store.add(new_game(game_id))
+    try:
+        # Released without a LockError after twice the timeout
+        with store.locked(game_id):
+            time.sleep(1.2)
+            assert store.client.exists(f'chess:lock:{game_id}')
+    finally:
+        store.delete(game_id)
+        store.close()
+
+
+def test_disconnect_leaves_only_the_players_games(monkeypatch):
+    monkeypatch.setattr(core, 'game_store', MemoryGameStore())
+    monkeypatch.setattr(core, 'player_games', {})
+    host = app.socketio.test_client(app.app)
+    guest = app.socketio.test_client(app.app)
+    game_ids = []
+    for client in (host, guest):
+        client.emit('create_game', {'color': 'white'})
+        game_ids.append(next(event['args'][0]['game_id'] for event in client.get_received()
+                             if event['name'] == 'game_created'))
+    guest.emit('join_game', {'game_id': game_ids[0]})
+    assert sorted(map(len, core.player_games.values())) == [1, 2]
+
+    host.disconnect()
+    with core.game_store.locked(game_ids[0]) as game:
+        assert game.players['white'] is None and game.players['black'] is not None
+    assert list(core.player_games.values()) == [set(game_ids)]
+    guest.disconnect()
+    assert core.game_store.all_games() == []
+    assert core.player_games == {}
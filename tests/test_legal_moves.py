@@ -0,0 +1,39 @@
+import chess
+
+import app
+import core
+from core import get_legal_move_map
+
+
+def test_map_groups_targets_by_square():
+    moves = get_legal_move_map(chess.Board())
+    assert sorted(moves) == ['a2', 'b1', 'b2', 'c2', 'd2', 'e2', 'f2', 'g1', 'g2', 'h2']
+    assert moves['e2'] == ['e3', 'e4']
+    assert sorted(moves['g1']) == ['f3', 'h3']
+    assert sum(len(targets) for targets in moves.values()) == 20
+
+
+def test_promotions_share_a_target():
+    board = chess.Board('8/P6k/8/8/8/8/8/K7 w - - 0 1')
+    assert get_legal_move_map(board)['a7'] == ['a8']
+
+
+def test_maps_are_cached_by_position(monkeypatch):
+    monkeypatch.setattr(core, 'legal_move_cache', type(core.legal_move_cache)())
+    board = chess.Board()
+    first = get_legal_move_map(board)
+    # Reached by a different move order, same position
+    other = chess.Board()
+    for uci in ('g1f3', 'g8f6', 'f3g1', 'f6g8'):
+        other.push_uci(uci)
+    assert get_legal_move_map(other) is first
+    assert len(core.legal_move_cache) == 1
+
+
+def test_positions_come_with_their_map():
+    client = app.app.test_client()
+    headers = {'X-Session-ID': 'legal-moves'}
+    data = client.post('/api/fen', json={'fen': '4k3/8/8/8/8/8/8/4K2R w K - 0 1'}, headers=headers).get_json()
+    assert sorted(data['legal_moves']['e1']) == ['d1', 'd2', 'e2', 'f1', 'f2', 'g1']
+    assert client.get('/api/fen', headers=headers).get_json()['legal_moves'] == data['legal_moves']
+    assert client.post('/api/reset', headers=headers).get_json()['legal_moves']['e2'] == ['e3', 'e4']
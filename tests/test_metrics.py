@@ -0,0 +1,64 @@
+import time
+
+import app
+import core
+from core import Counter, Histogram, format_labels
+from conftest import FAKE_ENGINE
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram('latency_seconds', 'Latency.', ('route',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, '/api/move')
+    assert histogram.render() == [
+        '# HELP latency_seconds Latency.',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{route="/api/move",le="0.1"} 2',
+        'latency_seconds_bucket{route="/api/move",le="1.0"} 3',
+        'latency_seconds_bucket{route="/api/move",le="+Inf"} 4',
+        'latency_seconds_sum{route="/api/move"} 3.65',
+        'latency_seconds_count{route="/api/move"} 4',
+    ]
+
+
+def test_counter_and_label_escaping():
+    counter = Counter('lookups_total', 'Lookups.', ('cache',))
+    counter.inc(1, 'eval')
+    counter.inc(2, 'eval')
+    assert counter.render()[-1] == 'lookups_total{cache="eval"} 3'
+    assert format_labels(('name',), ('say "hi"\n',)) == '{name="say \\"hi\\"\\n"}'
+
+
+def test_metrics_endpoint_reports_requests_and_caches():
+    client = app.app.test_client()
+    client.post('/api/legal_moves', json={'square': 'e2'}, headers={'X-Session-ID': 'metrics'})
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'chess_http_request_duration_seconds_count{route="/api/legal_moves",method="POST",status="200"}' in text
+    assert '# TYPE chess_cache_hit_ratio gauge' in text
+    assert 'chess_sessions ' in text
+
+
+def test_profile_header_needs_the_token(monkeypatch, capsys):
+    monkeypatch.setattr(app, 'PROFILE_TOKEN', 'secret')
+    client = app.app.test_client()
+    assert 'Server-Timing' not in client.get('/api/fen', headers={'X-Profile': 'guess'}).headers
+    response = client.get('/api/fen', headers={'X-Profile': 'secret'})
+    assert response.headers['Server-Timing'].startswith('total;dur=')
+    assert 'Profile of GET /api/fen' in capsys.readouterr().out
+
+
+def test_engine_utilisation():
+    pool = app.EnginePool(FAKE_ENGINE, 1, {})
+    pool.start()
+    try:
+        assert pool.wait_ready(30)
+        with pool.acquire():
+            time.sleep(0.1)
+        busy_seconds, idle_seconds, ponder_seconds = pool.utilisation()
+        assert busy_seconds >= 0.1 and idle_seconds > 0 and ponder_seconds == 0
+        text = core.render_metrics(pool)
+        assert 'chess_engine_workers{state="idle"} 1' in text
+        assert 'chess_engine_workers{state="busy"} 0' in text
+        assert 'chess_engine_workers{state="pondering"} 0' in text
+    finally:
+        pool.close()
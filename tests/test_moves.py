@@ -0,0 +1,82 @@
+import chess
+
+from core import MoveList, MultiplayerGame, decode_move, encode_move
+
+GAME = 'e2e4 d7d5 e4d5 g8f6 f1b5 c8d7 b5d7 d8d7 g1f3 f6d5 e1g1 b8c6'.split()
+
+
+def test_encode_decode_round_trip():
+    moves = [chess.Move.from_uci(uci) for uci in ('a1h8', 'h8a1', 'e7e8q', 'b2a1n', 'e1g1')]
+    for move in moves:
+        assert decode_move(encode_move(move)) == move
+    assert encode_move(chess.Move.from_uci('e7e8q')) < 1 << 16
+
+
+def reference_boards(ucis, board=None):
+    board = board or chess.Board()
+    boards = [board.copy()]
+    for uci in ucis:
+        board.push_uci(uci)
+        boards.append(board.copy())
+    return boards
+
+
+def test_fens_and_san_match_a_board():
+    moves = MoveList()
+    for uci in GAME:
+        moves.push(chess.Move.from_uci(uci))
+    boards = reference_boards(GAME)
+    assert len(moves) == len(GAME)
+    assert moves.fen_range(0, len(GAME) + 1) == [board.fen() for board in boards]
+    assert moves.fen(5) == boards[5].fen()
+    assert moves.san_list() == [boards[ply].san(chess.Move.from_uci(uci)) for ply, uci in enumerate(GAME)]
+    assert moves.game_board().move_stack == [chess.Move.from_uci(uci) for uci in GAME]
+
+
+def test_pop_keeps_memoized_views_in_step():
+    moves = MoveList()
+    for uci in GAME:
+        moves.push(chess.Move.from_uci(uci))
+    moves.move_pairs()
+    moves.fen_range(0, len(GAME))
+    boards = reference_boards(GAME)
+    # Popping back past captures replays from the start position
+    for ply in range(len(GAME) - 1, 2, -1):
+        assert moves.pop() == chess.Move.from_uci(GAME[ply])
+        assert moves.board.fen() == boards[ply].fen()
+        assert moves.fen(ply) == boards[ply].fen()
+        assert len(moves.san_list()) == ply
+        pairs = moves.move_pairs()
+        assert len(pairs) == (ply + 1) // 2
+        assert pairs[-1]['black'] == ('' if ply % 2 else moves.san(ply - 1))
+    moves.push(chess.Move.from_uci(GAME[3]))
+    assert moves.fen(4) == boards[4].fen()
+    assert moves.move_pairs()[-1] == {'number': 2, 'white': 'exd5', 'black': 'Nf6'}
+
+
+def test_custom_start_position():
+    start = chess.Board('4k3/P7/8/8/8/8/8/4K3 w - - 0 1')
+    moves = MoveList(start)
+    moves.push(chess.Move.from_uci('a7a8q'))
+    assert moves.start_fen == start.fen()
+    assert moves.san(0) == 'a8=Q+'
+    assert moves.pop() == chess.Move.from_uci('a7a8q')
+    assert moves.board.fen() == start.fen()
+
+
+def test_multiplayer_moves_never_build_the_san_list():
+    game = MultiplayerGame('0123abcd')
+    boards = reference_boards(GAME)
+    for ply, uci in enumerate(GAME):
+        delta = game.make_move(uci[:2], uci[2:4])
+        assert delta['san'] == boards[ply].san(chess.Move.from_uci(uci))
+        assert delta['fen'] == boards[ply + 1].fen()
+    assert game.moves.sans is None
+
+    restored = MultiplayerGame.from_dict(game.to_dict())
+    assert restored.moves.sans is None
+    assert restored.board.fen() == boards[-1].fen()
+    # Once the list exists, later moves are added to it
+    restored.moves.san_list()
+    restored.make_move('f1', 'e1')
+    assert restored.moves.san_list()[-1] == 'Re1'
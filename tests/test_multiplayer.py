@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+import app
+import core
+
+
+def received(client, name):
+    return [event['args'][0] for event in client.get_received() if event['name'] == name]
+
+
+@pytest.fixture
+def players(monkeypatch):
+    monkeypatch.setattr(core, 'game_store', core.MemoryGameStore())
+    white = app.socketio.test_client(app.app)
+    black = app.socketio.test_client(app.app)
+    white.emit('create_game', {'color': 'white'})
+    game_id = received(white, 'game_created')[0]['game_id']
+    black.emit('join_game', {'game_id': game_id})
+    white.get_received()
+    black.get_received()
+    yield game_id, white, black
+    white.disconnect()
+    black.disconnect()
+
+
+def test_moves_go_out_as_numbered_deltas(players):
+    game_id, white, black = players
+    white.emit('make_multiplayer_move', {'game_id': game_id, 'from': 'e2', 'to': 'e4'})
+    black.emit('make_multiplayer_move', {'game_id': game_id, 'from': 'e7', 'to': 'e5'})
+    deltas = received(black, 'move_made')
+    assert [delta['seq'] for delta in deltas] == [1, 2]
+    assert [delta['san'] for delta in deltas] == ['e4', 'e5']
+    assert deltas[1]['uci'] == 'e7e5'
+    assert deltas[1]['fen'] == 'rnbqkbnr/pppp1ppp/8/4p3/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 2'
+    assert deltas[1]['current_turn'] == 'white' and not deltas[1]['game_over']
+    assert 'board' not in deltas[1]
+    assert received(white, 'move_made') == deltas
+
+
+def test_resync_sends_missed_moves_or_the_full_state(players):
+    game_id, white, black = players
+    for uci in ('e2e4', 'e7e5', 'g1f3'):
+        mover = white if uci[1] in '12' else black
+        mover.emit('make_multiplayer_move', {'game_id': game_id, 'from': uci[:2], 'to': uci[2:]})
+    black.get_received()
+
+    black.emit('resync_game', {'game_id': game_id, 'since': 1})
+    resync = received(black, 'game_resync')[0]
+    assert resync['seq'] == 3
+    assert [move['uci'] for move in resync['moves']] == ['e7e5', 'g1f3']
+    assert [move['seq'] for move in resync['moves']] == [2, 3]
+
+    # A client ahead of the server, or sending junk, gets the whole game
+    black.emit('resync_game', {'game_id': game_id, 'since': 9})
+    black.emit('resync_game', {'game_id': game_id, 'since': 'x'})
+    states = received(black, 'game_state')
+    assert len(states) == 2 and states[0]['seq'] == 3
+
+
+def test_spectators_get_coalesced_updates(players, monkeypatch):
+    monkeypatch.setattr(app, 'SPECTATOR_UPDATE_INTERVAL', 0.2)
+    game_id, white, black = players
+    spectator = app.socketio.test_client(app.app)
+    spectator.emit('join_game', {'game_id': game_id})
+    assert received(spectator, 'game_joined')[0]['color'] == 'spectator'
+    for uci in ('e2e4', 'e7e5', 'g1f3'):
+        mover = white if uci[1] in '12' else black
+        mover.emit('make_multiplayer_move', {'game_id': game_id, 'from': uci[:2], 'to': uci[2:]})
+    assert [delta['by'] for delta in received(black, 'move_made')] == ['white', 'black', 'white']
+
+    updates = []
+    deadline = time.monotonic() + 5
+    while not updates and time.monotonic() < deadline:
+        time.sleep(0.05)
+        events = spectator.get_received()
+        assert not [event for event in events if event['name'] == 'move_made']
+        updates = [event['args'][0] for event in events if event['name'] == 'spectator_update']
+    # One flush for all three plies, without the players' legal-move maps
+    assert len(updates) == 1
+    assert [move['uci'] for move in updates[0]['moves']] == ['e2e4', 'e7e5', 'g1f3']
+    assert updates[0]['seq'] == 3 and 'legal_moves' not in updates[0]
+    spectator.disconnect()
@@ -0,0 +1,49 @@
+import struct
+
+import chess
+import chess.polyglot
+import pytest
+
+import app
+import core
+
+
+def polyglot_move(uci):
+    move = chess.Move.from_uci(uci)
+    return (chess.square_file(move.to_square) | chess.square_rank(move.to_square) << 3 |
+            chess.square_file(move.from_square) << 6 | chess.square_rank(move.from_square) << 9)
+
+
+@pytest.fixture
+def book(tmp_path, monkeypatch):
+    start = chess.polyglot.zobrist_hash(chess.Board())
+    entries = sorted([(start, polyglot_move('e2e4'), 10), (start, polyglot_move('d2d4'), 30)])
+    path = tmp_path / 'book.bin'
+    path.write_bytes(b''.join(struct.pack('>QHHI', key, move, weight, 0) for key, move, weight in entries))
+    reader = chess.polyglot.open_reader(str(path))
+    monkeypatch.setattr(core, 'opening_book', reader)
+    # No engine at all: book moves must not need one
+    monkeypatch.setattr(app, 'engine_pool', None)
+    yield reader
+    reader.close()
+
+
+def test_suggest_plays_from_the_book(book):
+    client = app.app.test_client()
+    suggestion = client.post('/api/suggest', headers={'X-Session-ID': 'book'}).get_json()['suggestion']
+    assert suggestion['source'] == 'book'
+    assert suggestion['uci'] in ('e2e4', 'd2d4')
+    assert suggestion['depth'] == 0
+
+
+def test_best_mode_takes_the_heaviest_move(book, monkeypatch):
+    monkeypatch.setattr(core, 'OPENING_BOOK_MODE', 'best')
+    assert core.get_book_move(chess.Board()).move == chess.Move.from_uci('d2d4')
+
+
+def test_book_is_left_after_its_depth_or_its_positions(book, monkeypatch):
+    board = chess.Board()
+    board.push_uci('g1f3')
+    assert core.get_book_move(board) is None
+    monkeypatch.setattr(core, 'OPENING_BOOK_DEPTH', 0)
+    assert core.get_book_move(chess.Board()) is None
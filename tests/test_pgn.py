@@ -0,0 +1,94 @@
+import io
+
+import chess.pgn
+import pytest
+
+import app
+import core
+from core import PgnDatabase, PgnIndexer
+
+GAMES = [
+    b'[Event "First"]\n[White "Carlsen, Magnus"]\n[Black "Nakamura"]\n[Date "2023.05.01"]\n[Result "1-0"]\n'
+    b'\n1. e4 e5 2. Nf3 {a comment with [brackets] spanning\nlines} Nc6 1-0\n',
+    b'\n\n[Event "Quoted \\"name\\""]\n[White "Al"]\n[Black "Carlsen, Magnus"]\n[Result "0-1"]\n'
+    b'\n1. d4 d5\n2. c4 0-1\n',
+    # No tags, so only the previous game's result marks where it starts
+    b'\n1. c4 c5 *\n',
+    b'[Event "Last"]\r\n[White "Bo"]\r\n[Black "Cy"]\r\n[Date "2024.01.02"]\r\n[Result "1/2-1/2"]\r\n'
+    b'\r\n1. Nf3 Nf6 1/2-1/2',
+]
+DATA = b''.join(GAMES)
+
+
+def index(data, chunk_size):
+    found = []
+    indexer = PgnIndexer(lambda offset, headers: found.append((offset, headers)))
+    for start in range(0, len(data), chunk_size):
+        indexer.feed(data[start:start + chunk_size])
+    indexer.close()
+    return found
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, len(DATA)])
+def test_offsets_point_at_each_game(chunk_size):
+    found = index(DATA, chunk_size)
+    assert len(found) == len(GAMES)
+    starts = []
+    position = 0
+    for game in GAMES:
+        starts.append(position + len(game) - len(game.lstrip()))
+        position += len(game)
+    assert [offset for offset, _ in found] == starts
+    assert found[0][1]['White'] == 'Carlsen, Magnus'
+    assert found[1][1]['Event'] == 'Quoted "name"'
+    assert found[2][1] == {}
+    assert found[3][1]['Result'] == '1/2-1/2'
+
+
+def test_rest_of_line_comments_and_escape_lines():
+    data = (b'% exported by some tool\n; a collection\n[Event "One"]\n[White "Al"]\n\n'
+            b'1. e4 ; not over yet: 1-0 {\n%[Event "Escaped"]\n1... e5 {a ; inside} 2. Nf3 *\n'
+            b'; next\n[Event "Two"]\n[White "Bo"]\n\n1. d4 1-0\n')
+    found = index(data, 5)
+    assert [headers['Event'] for _, headers in found] == ['One', 'Two']
+    assert [offset for offset, _ in found] == [data.index(b'[Event "One"]'), data.index(b'[Event "Two"]')]
+    for offset, headers in found:
+        game = chess.pgn.read_game(io.TextIOWrapper(io.BytesIO(data[offset:]), encoding='utf-8'))
+        assert game.headers['White'] == headers['White']
+
+
+def test_offsets_open_the_right_game():
+    for offset, headers in index(DATA, 64):
+        game = chess.pgn.read_game(io.TextIOWrapper(io.BytesIO(DATA[offset:]), encoding='utf-8'))
+        assert game.headers['White'] == headers.get('White', '?')
+
+
+def test_database_search_and_read(tmp_path, monkeypatch):
+    monkeypatch.setattr(core, 'PGN_DATA_DIR', str(tmp_path))
+    database = PgnDatabase.create(io.BytesIO(DATA))
+    assert PgnDatabase(database.database_id).exists()
+    total, games = database.find(player='carlsen, magnus')
+    assert total == 2 and [game['number'] for game in games] == [1, 2]
+    assert database.find(date='2024')[0] == 1
+    assert database.find(result='0-1', black='carlsen, magnus')[0] == 1
+    total, games = database.find(offset=1, limit=2)
+    assert total == 4 and [game['number'] for game in games] == [2, 3]
+    game = database.read_game(4)
+    assert [move.uci() for move in game.mainline_moves()] == ['g1f3', 'g8f6']
+    assert database.read_game(5) is None
+    with pytest.raises(ValueError):
+        PgnDatabase('../../etc/passwd')
+
+
+def test_upload_then_load_a_game(tmp_path, monkeypatch):
+    monkeypatch.setattr(core, 'PGN_DATA_DIR', str(tmp_path))
+    client = app.app.test_client()
+    uploaded = client.post('/api/pgn/upload', data=DATA, headers={'X-Session-ID': 'pgn'}).get_json()
+    assert uploaded['total'] == 4
+    database_id = uploaded['database_id']
+    found = client.get(f'/api/pgn/{database_id}/games?white=bo').get_json()
+    assert [game['number'] for game in found['games']] == [4]
+    loaded = client.post(f'/api/pgn/{database_id}/load', json={'number': 4}, headers={'X-Session-ID': 'pgn'}).get_json()
+    assert loaded['fen'] == 'rnbqkb1r/pppppppp/5n2/8/8/5N2/PPPPPPPP/RNBQKB1R w KQkq - 2 2'
+    assert loaded['headers']['Event'] == 'Last'
+    assert client.get('/api/pgn/000000000000/games').status_code == 404
@@ -0,0 +1,93 @@
+import time
+
+import chess
+import chess.engine
+import chess.polyglot
+
+import app
+import core
+
+
+def ponder_results():
+    return {result: count for (result,), count in core.PONDER_RESULTS.values.items()}
+
+
+def expected_reply(pool, board):
+    """The player's move the parked worker is pondering on."""
+    (worker,) = pool.pondering.values()
+    for move in board.legal_moves:
+        board.push(move)
+        expected = chess.polyglot.zobrist_hash(board) == worker.pondering[1]
+        board.pop()
+        if expected:
+            return move
+
+
+def reply(board, think_time=0.2):
+    entry, cached = app.ponder_position('ponder', board, chess.engine.Limit(time=think_time))
+    assert not cached
+    return entry
+
+
+def test_expected_reply_is_a_ponderhit(engine_pool):
+    board = chess.Board()
+    entry = reply(board)
+    assert engine_pool.stats()['pondering'] == 1
+    assert engine_pool.stats()['idle'] == 1
+    before = ponder_results()
+    board.push_uci(entry['move'])
+    board.push(expected_reply(engine_pool, board))
+    # The ponder search has already had the whole think time
+    time.sleep(0.3)
+    started = time.monotonic()
+    entry = reply(board)
+    assert time.monotonic() - started < 0.15
+    assert chess.Move.from_uci(entry['move']) in board.legal_moves
+    assert ponder_results().get('hit', 0) == before.get('hit', 0) + 1
+
+
+def test_unexpected_reply_searches_from_scratch(engine_pool):
+    board = chess.Board()
+    entry = reply(board, 0.05)
+    board.push_uci(entry['move'])
+    expected = expected_reply(engine_pool, board)
+    board.push(next(move for move in board.legal_moves if move != expected))
+    before = ponder_results()
+    entry = reply(board, 0.05)
+    assert chess.Move.from_uci(entry['move']) in board.legal_moves
+    assert ponder_results().get('miss', 0) == before.get('miss', 0) + 1
+
+
+def test_stop_pondering_frees_the_worker(engine_pool):
+    reply(chess.Board(), 0.05)
+    app.stop_pondering('ponder')
+    assert engine_pool.stats()['pondering'] == 0
+    assert engine_pool.stats()['idle'] == 2
+    # Another session's reply is not counted as a ponder result
+    before = ponder_results()
+    app.ponder_position('other', chess.Board(), chess.engine.Limit(time=0.01))
+    assert ponder_results() == before
+
+
+def test_ponder_time_is_charged_to_the_session(engine_pool, monkeypatch):
+    # No refill during the test
+    monkeypatch.setattr(core, 'ENGINE_QUOTA_WINDOW', 1e9)
+    reply(chess.Board(), 0.05)
+    used = engine_pool.scheduler.used('ponder', time.monotonic())
+    time.sleep(0.2)
+    app.stop_pondering('ponder')
+    assert engine_pool.scheduler.used('ponder', time.monotonic()) >= used + 0.15
+    assert engine_pool.utilisation()[2] >= 0.2
+
+
+def test_a_session_ponders_on_one_engine_at_a_time(engine_pool):
+    board = chess.Board()
+    first = engine_pool.checkout(session_id='ponder')
+    second = engine_pool.checkout(session_id='ponder')
+    for worker in (first, second):
+        result = worker.engine.play(board, chess.engine.Limit(time=0.01), ponder=True)
+        engine_pool.checkin(worker, pondering=core.ponder_target('ponder', board, result))
+    # The older ponder search was stopped and its engine is idle again
+    assert engine_pool.pondering == {'ponder': second}
+    assert engine_pool.idle == [first] and first.pondering is None
+    assert not engine_pool.busy
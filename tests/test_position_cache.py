@@ -0,0 +1,77 @@
+import chess
+import chess.engine
+
+import app
+import core
+from core import PositionCache
+
+
+def entry(move, depth=10, time=0.5, nodes=100000):
+    return {'move': move, 'score': {'cp': 20}, 'pv': [move], 'depth': depth, 'time': time, 'nodes': nodes}
+
+
+def test_satisfies_deeper_or_longer_searches_only():
+    searched = entry('e2e4', depth=12, time=1.0, nodes=50000)
+    assert PositionCache.satisfies(searched, chess.engine.Limit(depth=12))
+    assert not PositionCache.satisfies(searched, chess.engine.Limit(depth=13))
+    assert PositionCache.satisfies(searched, chess.engine.Limit(time=0.5))
+    assert not PositionCache.satisfies(searched, chess.engine.Limit(time=2.0))
+    assert PositionCache.satisfies(searched, chess.engine.Limit(nodes=50000))
+    assert not PositionCache.satisfies(searched, chess.engine.Limit(nodes=50001))
+    # Either bound of a combined limit is enough
+    assert PositionCache.satisfies(searched, chess.engine.Limit(depth=20, time=1.0))
+    assert not PositionCache.satisfies(searched, chess.engine.Limit())
+
+
+def test_get_checks_limit_and_legality():
+    cache = PositionCache(max_entries=10, path=None)
+    board = chess.Board()
+    cache.put(board, entry('e2e4', depth=10))
+    assert cache.get(board, chess.engine.Limit(depth=8))['move'] == 'e2e4'
+    assert cache.get(board, chess.engine.Limit(depth=18)) is None
+    # A shallower result never replaces a deeper one
+    cache.put(board, entry('d2d4', depth=5))
+    assert cache.get(board, chess.engine.Limit(depth=8))['move'] == 'e2e4'
+    cache.put(board, entry('e7e5', depth=20))
+    assert cache.get(board, chess.engine.Limit(depth=8)) is None
+    assert cache.stats()['hits'] == 2
+
+
+def positions(count):
+    board = chess.Board()
+    boards = []
+    for move in list(board.legal_moves)[:count]:
+        child = board.copy()
+        child.push(move)
+        boards.append(child)
+    return boards
+
+
+def test_evicted_entries_spill_to_disk(tmp_path):
+    path = str(tmp_path / 'evals.db')
+    boards = positions(4)
+    cache = PositionCache(max_entries=2, path=path)
+    for board in boards:
+        cache.put(board, entry(next(iter(board.legal_moves)).uci()))
+    assert len(cache.entries) == 2
+    assert cache.db.execute('SELECT COUNT(*) FROM evals').fetchone()[0] == 2
+    # The oldest entry comes back from disk
+    limit = chess.engine.Limit(depth=5)
+    assert cache.get(boards[0], limit)['move'] == next(iter(boards[0].legal_moves)).uci()
+    assert len(cache.entries) == 2
+    cache.close()
+
+    reopened = PositionCache(max_entries=10, path=path)
+    for board in boards:
+        assert reopened.get(board, limit)['move'] == next(iter(board.legal_moves)).uci()
+    reopened.close()
+
+
+def test_suggest_answers_from_the_cache_without_an_engine(monkeypatch):
+    monkeypatch.setattr(core, 'eval_cache', PositionCache(max_entries=10, path=None))
+    monkeypatch.setattr(app, 'engine_pool', None)
+    core.eval_cache.put(chess.Board(), entry('g1f3', time=5.0))
+    client = app.app.test_client()
+    suggestion = client.post('/api/suggest', headers={'X-Session-ID': 'cached'}).get_json()['suggestion']
+    assert suggestion['uci'] == 'g1f3'
+    assert suggestion['cached'] is True
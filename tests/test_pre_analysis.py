@@ -0,0 +1,57 @@
+import chess
+import chess.engine
+import pytest
+
+import app
+import core
+
+ITALIAN = 'r1bqkbnr/pppp1ppp/2n5/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R b KQkq - 3 3'
+
+
+@pytest.fixture
+def client(engine_pool):
+    client = app.app.test_client()
+    client.environ_base['HTTP_X_SESSION_ID'] = 'think-ahead'
+    client.post('/api/config', json={'mode': 'suggest', 'preanalyze': True, 'time': 0.2})
+    yield client
+    client.post('/api/config', json={'preanalyze': False})
+
+
+def job_for(session_id):
+    with app.pre_analysis_lock:
+        return app.pre_analysis_jobs.get(session_id)
+
+
+def test_new_positions_are_searched_ahead(client):
+    client.post('/api/fen', json={'fen': ITALIAN})
+    job = job_for('think-ahead')
+    assert job and job.board.fen() == ITALIAN
+    assert job.done.wait(5)
+    assert core.eval_cache.get(chess.Board(ITALIAN), chess.engine.Limit(time=0.2)) is not None
+    suggestion = client.post('/api/suggest').get_json()['suggestion']
+    assert suggestion['cached']
+
+
+def test_a_new_position_supersedes_the_search(client):
+    client.post('/api/fen', json={'fen': ITALIAN})
+    first = job_for('think-ahead')
+    client.post('/api/reset')
+    second = job_for('think-ahead')
+    assert second is not first and second.board == chess.Board()
+    # Stopped early, so its result does not count for the full budget
+    assert first.done.wait(5)
+    assert core.eval_cache.get(chess.Board(ITALIAN), chess.engine.Limit(time=0.2)) is None
+    assert second.done.wait(5)
+
+
+def test_background_search_never_queues(engine_pool):
+    workers = [engine_pool.checkout(), engine_pool.checkout()]
+    with pytest.raises(core.EngineBusy):
+        engine_pool.checkout(timeout=0)
+    assert engine_pool.waiting == 0
+    job = app.PreAnalysisJob('busy', chess.Board(), chess.engine.Limit(time=0.1))
+    job.run()
+    assert job.done.is_set()
+    assert core.eval_cache.get(chess.Board(), chess.engine.Limit(time=0.1)) is None
+    for worker in workers:
+        engine_pool.checkin(worker)
@@ -0,0 +1,187 @@
+import threading
+import time
+
+import pytest
+
+import app
+import core
+from core import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, PRIORITY_SUGGEST, EngineBusy, EngineScheduler, EngineTicket
+from conftest import FAKE_ENGINE
+
+
+def queue_tickets(scheduler, session_id, priority, count):
+    tickets = []
+    for _ in range(count):
+        ticket = EngineTicket(session_id, scheduler.admit(session_id, priority, 0.0))
+        scheduler.enqueue(ticket)
+        tickets.append(ticket)
+    return tickets
+
+
+def run_next(scheduler):
+    ticket = scheduler.next_ticket()
+    if ticket is not None:
+        scheduler.start(ticket)
+    return ticket
+
+
+def test_classes_share_engines_by_weight():
+    scheduler = EngineScheduler(size=4, queue_limit=1000)
+    queue_tickets(scheduler, None, PRIORITY_INTERACTIVE, 40)
+    queue_tickets(scheduler, None, PRIORITY_SUGGEST, 40)
+    order = []
+    for _ in range(21):
+        ticket = scheduler.next_ticket()
+        order.append(ticket.priority)
+    # Weights 16:4 interleave suggestions rather than starving them
+    assert order.count(PRIORITY_INTERACTIVE) == 17
+    assert order.count(PRIORITY_SUGGEST) == 4
+    assert order[0] == PRIORITY_INTERACTIVE
+
+
+def test_idle_class_does_not_catch_up():
+    scheduler = EngineScheduler(size=4, queue_limit=1000)
+    queue_tickets(scheduler, None, PRIORITY_INTERACTIVE, 20)
+    for _ in range(20):
+        scheduler.next_ticket()
+    queue_tickets(scheduler, None, PRIORITY_INTERACTIVE, 5)
+    queue_tickets(scheduler, None, PRIORITY_SUGGEST, 5)
+    order = [scheduler.next_ticket().priority for _ in range(10)]
+    assert order.index(PRIORITY_SUGGEST) < 5
+
+
+def test_sessions_take_turns_within_a_class():
+    scheduler = EngineScheduler(size=4, queue_limit=1000)
+    queue_tickets(scheduler, 'a', PRIORITY_SUGGEST, 2)
+    queue_tickets(scheduler, 'b', PRIORITY_SUGGEST, 2)
+    order = [run_next(scheduler).session_id for _ in range(4)]
+    assert order == ['a', 'b', 'a', 'b']
+
+
+def test_session_concurrency_limit():
+    scheduler = EngineScheduler(size=4, queue_limit=1000)
+    queue_tickets(scheduler, 'a', PRIORITY_SUGGEST, scheduler.session_limit)
+    with pytest.raises(EngineBusy):
+        scheduler.admit('a', PRIORITY_SUGGEST, 0.0)
+    running = [run_next(scheduler) for _ in range(scheduler.session_limit)]
+    queue_tickets(scheduler, 'a', PRIORITY_SUGGEST, 1)
+    # Queued, but not started while the session has its limit running
+    assert scheduler.next_ticket() is None
+    scheduler.finish(running[0], 0.0, 0.0)
+    assert scheduler.next_ticket().session_id == 'a'
+
+
+def test_background_work_leaves_reserved_workers(monkeypatch):
+    monkeypatch.setattr(core, 'ENGINE_RESERVED_WORKERS', 1)
+    scheduler = EngineScheduler(size=3, queue_limit=1000)
+    queue_tickets(scheduler, None, PRIORITY_BACKGROUND, 3)
+    assert run_next(scheduler) and run_next(scheduler)
+    assert scheduler.next_ticket() is None
+    queue_tickets(scheduler, None, PRIORITY_INTERACTIVE, 1)
+    assert run_next(scheduler).priority == PRIORITY_INTERACTIVE
+
+
+def test_jobs_use_spare_engines_past_the_session_limit(monkeypatch):
+    monkeypatch.setattr(core, 'ENGINE_RESERVED_WORKERS', 1)
+    scheduler = EngineScheduler(size=5, queue_limit=1000)
+    queue_tickets(scheduler, 'job', PRIORITY_BACKGROUND, scheduler.background_limit)
+    running = [run_next(scheduler) for _ in range(scheduler.session_limit)]
+    queue_tickets(scheduler, 'other', PRIORITY_BACKGROUND, 1)
+    # Another session's work goes first; past that the job takes what is left
+    assert run_next(scheduler).session_id == 'other'
+    spare = run_next(scheduler)
+    assert spare.session_id == 'job' and spare.spare
+    assert scheduler.next_ticket() is None
+    # The job's spare searches do not hold up the session's own suggestions
+    queue_tickets(scheduler, 'job', PRIORITY_SUGGEST, 1)
+    assert scheduler.next_ticket() is None
+    scheduler.finish(running[0], 0.0, 0.0)
+    assert run_next(scheduler).priority == PRIORITY_SUGGEST
+    scheduler.finish(spare, 0.0, 0.0)
+    assert scheduler.spare == {}
+
+
+def test_background_share_of_queue_and_queue_limit():
+    scheduler = EngineScheduler(size=2, queue_limit=4)
+    queue_tickets(scheduler, None, PRIORITY_BACKGROUND, 2)
+    with pytest.raises(EngineBusy):
+        scheduler.admit(None, PRIORITY_BACKGROUND, 0.0)
+    queue_tickets(scheduler, None, PRIORITY_INTERACTIVE, 2)
+    with pytest.raises(EngineBusy):
+        scheduler.admit(None, PRIORITY_INTERACTIVE, 0.0)
+    assert len(scheduler.drain()) == 4
+    assert scheduler.queued == 0
+
+
+def test_cpu_quota(monkeypatch):
+    monkeypatch.setattr(core, 'ENGINE_SESSION_CPU_QUOTA', 10.0)
+    monkeypatch.setattr(core, 'ENGINE_QUOTA_WINDOW', 100.0)
+    scheduler = EngineScheduler(size=2, queue_limit=100)
+    ticket = queue_tickets(scheduler, 'a', PRIORITY_SUGGEST, 1)[0]
+    run_next(scheduler)
+    scheduler.finish(ticket, 12.0, 0.0)
+    with pytest.raises(EngineBusy, match=r'try again in 20s'):
+        scheduler.admit('a', PRIORITY_SUGGEST, 0.0)
+    # The player's own game goes on, at background priority
+    assert scheduler.admit('a', PRIORITY_INTERACTIVE, 0.0) == PRIORITY_BACKGROUND
+    assert scheduler.admit('b', PRIORITY_SUGGEST, 0.0) == PRIORITY_SUGGEST
+    # The quota refills at 0.1 CPU-seconds per second
+    assert scheduler.used('a', 10.0) == pytest.approx(11.0)
+    assert scheduler.admit('a', PRIORITY_SUGGEST, 30.0) == PRIORITY_SUGGEST
+
+
+def test_victim_is_less_urgent_preemptible_work():
+    class Worker:
+        def __init__(self, ticket):
+            self.ticket = ticket
+            self.preempted = False
+
+    busy = [Worker(EngineTicket('a', PRIORITY_SUGGEST, preemptible=True)),
+            Worker(EngineTicket('b', PRIORITY_BACKGROUND)),
+            Worker(EngineTicket('c', PRIORITY_BACKGROUND, preemptible=True))]
+    scheduler = EngineScheduler(size=3, queue_limit=10)
+    assert scheduler.victim(EngineTicket('d', PRIORITY_SUGGEST), busy) is busy[2]
+    assert scheduler.victim(EngineTicket('d', PRIORITY_BACKGROUND), busy) is None
+
+
+@pytest.fixture
+def pool():
+    pool = app.EnginePool(FAKE_ENGINE, 1, {'Threads': 1, 'Hash': 16}, queue_timeout=10,
+                          profile=lambda session_id: {'Threads': 100000} if session_id == 'bad' else {})
+    pool.start()
+    assert pool.wait_ready(30)
+    yield pool
+    pool.close()
+
+
+def test_pool_serves_queued_requests_by_priority(pool):
+    worker = pool.checkout(session_id='holder')
+    order = []
+
+    def request(session_id, priority):
+        taken = pool.checkout(session_id=session_id, priority=priority)
+        order.append(priority)
+        pool.checkin(taken)
+
+    threads = [threading.Thread(target=request, args=('bg', PRIORITY_BACKGROUND)),
+               threading.Thread(target=request, args=('play', PRIORITY_INTERACTIVE))]
+    threads[0].start()
+    while pool.waiting < 1:
+        time.sleep(0.01)
+    threads[1].start()
+    while pool.waiting < 2:
+        time.sleep(0.01)
+    pool.checkin(worker)
+    for thread in threads:
+        thread.join(10)
+    assert order == [PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND]
+
+
+def test_pool_rejects_bad_options_and_keeps_the_engine(pool):
+    with pytest.raises(core.EngineOptionError) as error:
+        pool.checkout(session_id='bad')
+    assert error.value.status == 400
+    worker = pool.checkout(session_id='good', timeout=0)
+    assert pool.restarts == 0
+    worker.engine.ping()
+    pool.checkin(worker)
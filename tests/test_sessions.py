@@ -0,0 +1,55 @@
+import chess
+import pytest
+
+import app
+from core import GameSession, SessionStore
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def test_idle_sessions_expire():
+    store = SessionStore(idle_ttl=60)
+    store.get('old').last_access -= 120
+    store.get('recent')
+    assert set(store.sessions) == {'recent'}
+    assert store.total_size == GameSession.BASE_BYTES
+
+
+def test_memory_ceiling_evicts_least_recently_used():
+    store = SessionStore(memory_limit=3 * GameSession.BASE_BYTES)
+    for session_id in ('a', 'b', 'c'):
+        store.get(session_id)
+    store.get('a')
+    store.get('d')
+    assert list(store.sessions) == ['c', 'a', 'd']
+    assert store.stats()['estimated_bytes'] == 3 * GameSession.BASE_BYTES
+
+
+def test_growing_session_is_accounted_and_kept():
+    store = SessionStore(memory_limit=2 * GameSession.BASE_BYTES + GameSession.PLY_BYTES)
+    store.get('other')
+    with store.locked('player') as session:
+        for uci in ('e2e4', 'e7e5', 'g1f3'):
+            session.push_move(chess.Move.from_uci(uci))
+    # The session that grew stays; the idle one makes room
+    assert list(store.sessions) == ['player']
+    assert store.total_size == session.estimate_size()
+
+
+def test_sessions_do_not_share_boards(client):
+    moved = client.post('/api/move', json={'from': 'e2', 'to': 'e4'}, headers={'X-Session-ID': 'first'}).get_json()
+    assert moved['move_history'] == [{'number': 1, 'white': 'e4', 'black': ''}]
+    first = client.post('/api/init', headers={'X-Session-ID': 'first'}).get_json()
+    second = client.post('/api/init', headers={'X-Session-ID': 'second'}).get_json()
+    assert first['fen'] == 'rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1'
+    assert second['fen'] == chess.STARTING_FEN
+
+
+def test_browsers_without_a_header_get_a_cookie(client):
+    response = client.post('/api/init')
+    assert 'session_id=' in response.headers['Set-Cookie']
+    client.post('/api/move', json={'from': 'd2', 'to': 'd4'})
+    assert client.post('/api/init').get_json()['fen'].startswith('rnbqkbnr/pppppppp/8/8/3P4')
@@ -0,0 +1,45 @@
+import gzip
+import re
+
+import app
+from core import accepts_gzip, etag_matches, minify_css, minify_js
+
+
+def test_minify_js_keeps_lines_and_template_literals():
+    source = '// header\nfunction f() {\n    return `a\n    b`;\n}\n\n    // note\nf();\n'
+    assert minify_js(source) == 'function f() {\nreturn `a\n    b`;\n}\nf();\n'
+
+
+def test_minify_css_keeps_descendant_combinators():
+    source = '/* theme */\n.board .square:hover {\n    color : red;\n    margin: 0 auto;\n}\n'
+    assert minify_css(source) == '.board .square:hover{color :red;margin:0 auto}\n'
+
+
+def test_header_parsing():
+    assert accepts_gzip('gzip, deflate, br')
+    assert accepts_gzip('br;q=1.0, *;q=0.5')
+    assert not accepts_gzip('gzip;q=0')
+    assert not accepts_gzip(None)
+    assert etag_matches('"a", W/"b"', '"b"')
+    assert not etag_matches('"a"', '"b"')
+
+
+def test_page_links_fingerprinted_assets_that_revalidate_with_304():
+    client = app.app.test_client()
+    page = client.get('/')
+    assert page.headers['Cache-Control'] == 'no-cache'
+    script = re.search(r'src="(/assets/script\.[0-9a-f]{10}\.js)"', page.get_data(as_text=True)).group(1)
+
+    response = client.get(script, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'immutable' in response.headers['Cache-Control']
+    body = gzip.decompress(response.get_data())
+    assert body == client.get('/script.js').get_data()
+    etag = response.headers['ETag']
+    assert etag.endswith('-gzip"')
+
+    again = client.get(script, headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert again.status_code == 304 and again.get_data() == b''
+    # The plain representation has its own tag
+    assert client.get(script, headers={'If-None-Match': etag}).status_code == 200
+    assert client.get('/assets/script.0000000000.js').status_code == 404